@@ -0,0 +1,5 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+from swift.llm import dataset_cache_main
+
+if __name__ == '__main__':
+    dataset_cache_main()
@@ -10,7 +10,8 @@ ROUTE_MAPPING: Dict[str, str] = {
     'infer': 'swift.cli.infer',
     'app-ui': 'swift.cli.app_ui',
     'merge-lora': 'swift.cli.merge_lora',
-    'web-ui': 'swift.cli.web_ui'
+    'web-ui': 'swift.cli.web_ui',
+    'dataset-cache': 'swift.cli.dataset_cache'
 }
 
 ROUTE_MAPPING.update(
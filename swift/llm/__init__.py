@@ -3,6 +3,7 @@ from .app_ui import gradio_chat_demo, gradio_generation_demo, llm_app_ui
 from .infer import llm_infer, merge_lora, prepare_model_template
 from .rome import rome_infer
 # Recommend using `xxx_main`
-from .run import app_ui_main, infer_main, merge_lora_main, rome_main, sft_main
+from .run import (app_ui_main, dataset_cache_main, infer_main, merge_lora_main,
+                  rome_main, sft_main)
 from .sft import llm_sft
 from .utils import *
@@ -1,8 +1,8 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
-from typing import Tuple
+from typing import Optional, Tuple
 
 from .infer import merge_lora, prepare_model_template
-from .utils import (History, InferArguments, inference_stream,
+from .utils import (History, InferArguments, KVCacheSession, inference_stream,
                     limit_history_length)
 
 
@@ -53,7 +53,8 @@ def gradio_chat_demo(args: InferArguments) -> None:
     else:
         model, template = prepare_model_template(args)
 
-    def model_chat(query: str, history: History) -> Tuple[str, History]:
+    def model_chat(query: str, history: History,
+                   session: Optional[KVCacheSession]) -> Tuple[str, History]:
         old_history, history = limit_history_length(template, query, history,
                                                     args.max_length)
         if args.infer_backend == 'vllm':
@@ -67,7 +68,8 @@ def gradio_chat_demo(args: InferArguments) -> None:
                 total_history = old_history + history
                 yield '', total_history
         else:
-            gen = inference_stream(model, template, query, history)
+            gen = inference_stream(
+                model, template, query, history, session=session)
             for _, history in gen:
                 total_history = old_history + history
                 yield '', total_history
@@ -78,11 +80,18 @@ def gradio_chat_demo(args: InferArguments) -> None:
 
         chatbot = gr.Chatbot(label=f'{model_name}')
         message = gr.Textbox(lines=2, label='Input')
+        session = None
+        if args.kv_cache_session and args.infer_backend != 'vllm':
+            session = KVCacheSession()
+        # gr.State: Each user has a copy of the session.
+        session = gr.State(session)
         with gr.Row():
             clear_history = gr.Button('🧹 清除历史对话')
             send = gr.Button('🚀 发送')
         send.click(
-            model_chat, inputs=[message, chatbot], outputs=[message, chatbot])
+            model_chat,
+            inputs=[message, chatbot, session],
+            outputs=[message, chatbot])
         clear_history.click(
             fn=clear_session, inputs=[], outputs=[chatbot], queue=False)
     demo.queue().launch(height=1000, share=args.share)
@@ -13,9 +13,12 @@ from transformers import PreTrainedModel
 from swift.tuners import Swift
 from swift.utils import (append_to_jsonl, get_logger, get_model_info,
                          read_multi_line, seed_everything, show_layers)
-from .utils import (InferArguments, Template, get_additional_saved_files,
-                    get_dataset, get_model_tokenizer, get_template, inference,
-                    inference_stream, set_generation_config)
+from .utils import (InferArguments, KVCacheSession, PrefixKVCache, Template,
+                    get_additional_saved_files, get_dataset,
+                    get_model_tokenizer, get_template, inference,
+                    inference_batch, inference_stream,
+                    set_dataset_load_num_workers, set_generation_config,
+                    set_kv_cache_max_memory)
 
 logger = get_logger()
 
@@ -153,6 +156,13 @@ def prepare_model_template(
         model=model)
     args.system = template.default_system
     logger.info(f'system: {args.system}')
+    if args.prefix_kv_cache:
+        model.prefix_kv_cache = PrefixKVCache(args.prefix_kv_cache_max_size)
+        prefix = model.prefix_kv_cache.add(model, template, pin=True)
+        prefix_len = 0 if prefix is None else len(prefix[0])
+        logger.info(f'prefix_kv_cache: {prefix_len} tokens')
+    set_kv_cache_max_memory(args.kv_cache_max_memory,
+                            args.kv_cache_max_cpu_memory)
     return model, template
 
 
@@ -183,6 +193,9 @@ def llm_infer(args: InferArguments) -> None:
             logger.info(
                 'The current template only supports single-round dialogues.')
         history = []
+        session = None
+        if args.kv_cache_session and args.infer_backend != 'vllm':
+            session = KVCacheSession()
         if 'cogagent' in args.model_type:
             image = input('Input an image url<<< ')
             from PIL import Image
@@ -198,6 +211,8 @@ def llm_infer(args: InferArguments) -> None:
                 break
             elif query.strip().lower() == 'clear':
                 history = []
+                if session is not None:
+                    session.clear()
                 continue
             if input_mode == 'S' and query.strip().lower() == 'multi-line':
                 input_mode = 'M'
@@ -225,7 +240,12 @@ def llm_infer(args: InferArguments) -> None:
                         print_idx = len(response)
             else:
                 gen = inference_stream(
-                    model, template, query, history, image=image)
+                    model,
+                    template,
+                    query,
+                    history,
+                    image=image,
+                    session=session)
                 for response, new_history in gen:
                     if len(response) > print_idx:
                         print(response[print_idx:], end='', flush=True)
@@ -242,6 +262,7 @@ def llm_infer(args: InferArguments) -> None:
                 append_to_jsonl(jsonl_path, obj)
             result.append(obj)
     else:
+        set_dataset_load_num_workers(args.dataset_load_num_workers)
         _, val_dataset = get_dataset(args.dataset, args.dataset_test_ratio,
                                      args.dataset_seed)
         if args.val_dataset_sample >= 0:
@@ -254,11 +275,12 @@ def llm_infer(args: InferArguments) -> None:
             else:
                 args.verbose = True
             logger.info(f'Setting args.verbose: {args.verbose}')
-        if not args.verbose and args.stream:
+        use_batch = args.infer_backend != 'vllm' and args.infer_batch_size > 1
+        if (not args.verbose or use_batch) and args.stream:
             args.stream = False
             logger.info(f'Setting args.stream: {args.stream}')
 
-        if args.infer_backend == 'vllm' and not args.stream:
+        if (args.infer_backend == 'vllm' and not args.stream) or use_batch:
             if args.verbose:
                 args.verbose = False
                 logger.info('Setting args.verbose: False')
@@ -267,8 +289,16 @@ def llm_infer(args: InferArguments) -> None:
                 label_list = val_dataset['response']
             val_dataset = val_dataset.remove_columns('response')
             request_list = val_dataset.to_list()
-            resp_list = inference_vllm(
-                llm_engine, template, request_list, use_tqdm=True)
+            if use_batch:
+                resp_list = inference_batch(
+                    model,
+                    template,
+                    request_list,
+                    batch_size=args.infer_batch_size,
+                    use_tqdm=True)
+            else:
+                resp_list = inference_vllm(
+                    llm_engine, template, request_list, use_tqdm=True)
             result = []
             if label_list is not None:
                 for request, label in zip(request_list, label_list):
@@ -4,10 +4,12 @@ from .app_ui import llm_app_ui
 from .infer import llm_infer, merge_lora
 from .rome import rome_infer
 from .sft import llm_sft
-from .utils import InferArguments, RomeArguments, SftArguments
+from .utils import (DatasetCacheArguments, InferArguments, RomeArguments,
+                    SftArguments, llm_dataset_cache)
 
 sft_main = get_main(SftArguments, llm_sft)
 infer_main = get_main(InferArguments, llm_infer)
 rome_main = get_main(RomeArguments, rome_infer)
 app_ui_main = get_main(InferArguments, llm_app_ui)
 merge_lora_main = get_main(InferArguments, merge_lora)
+dataset_cache_main = get_main(DatasetCacheArguments, llm_dataset_cache)
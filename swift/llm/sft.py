@@ -1,11 +1,13 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
 import os
 from functools import partial
-from typing import Any, Dict, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import json
 import numpy as np
 import torch
+from datasets import Dataset as HfDataset
+from datasets import concatenate_datasets
 from modelscope import BitsAndBytesConfig, GenerationConfig
 
 from swift.trainers import (IntervalStrategy, Seq2SeqTrainer,
@@ -14,20 +16,206 @@ from swift.tuners import (LongLoRAConfig, LongLoRAModelType, LoraConfig,
                           LoRAConfig, NEFTuneConfig, Swift)
 from swift.utils import (check_json_format, compute_acc_metrics,
                          compute_nlg_metrics, freeze_model_parameters,
-                         get_dist_setting, get_logger, get_model_info,
-                         is_ddp_plus_mp, is_dist, is_master, plot_images,
+                         get_dataset_lengths, get_dist_setting, get_logger,
+                         get_model_info, get_seed, is_ddp_plus_mp, is_dist,
+                         is_local_master, is_master, plot_images,
                          preprocess_logits_for_metrics, seed_everything,
                          show_layers)
-from .utils import (LazyLLMDataset, SftArguments, Template,
-                    add_self_cognition_dataset, data_collate_fn, dataset_map,
-                    find_all_linear_for_lora, fix_fp16_trainable_bug,
-                    get_additional_saved_files, get_dataset,
-                    get_model_tokenizer, get_template, print_example,
-                    set_generation_config, sort_by_max_length, stat_dataset)
+from .utils import (LazyLLMDataset, LLMDataset, SftArguments, Template,
+                    add_self_cognition_dataset, check_encode_strategy,
+                    concat_llm_datasets, data_collate_fn, dataset_map,
+                    dataset_map_distributed, find_all_linear_for_lora,
+                    fix_fp16_trainable_bug, get_additional_saved_files,
+                    get_dataset, get_dataset_cache_key, get_model_tokenizer,
+                    get_streaming_dataset, get_template, load_dataset_cache,
+                    pack_dataset, patch_packing_attention, prefetch_datasets,
+                    print_example, save_dataset_cache,
+                    set_dataset_load_num_workers, set_generation_config,
+                    set_preprocess_num_proc, share_dataset_in_node,
+                    sort_by_max_length, stat_dataset, StreamingLLMDataset)
 
 logger = get_logger()
 
 
+def _is_dataset_mixing(args: SftArguments) -> bool:
+    return args.dataset_weights is not None or args.dataset_temperature != 1
+
+
+def _get_train_val_dataset(
+    args: SftArguments, template: Template
+) -> Tuple[Union[HfDataset, List[Optional[HfDataset]]], Optional[HfDataset]]:
+    """When mixing the datasets, the train_dataset is the list of the train datasets of each source."""
+    # Loading Dataset
+    set_preprocess_num_proc(args.preprocess_num_proc)
+    set_dataset_load_num_workers(args.dataset_load_num_workers)
+    random_state = np.random.RandomState(args.dataset_seed)
+    val_dataset_sample = args.val_dataset_sample
+    if _is_dataset_mixing(args):
+        # The datasets are loaded and encoded separately, and sampled by `WeightedSourceSampler`.
+        # Each dataset uses its own seed.
+        seed_list = [get_seed(random_state) for _ in args.dataset]
+        # The datasets are downloaded in parallel, and then preprocessed in the main thread.
+        prefetch_datasets(args.dataset)
+        dataset_list = [
+            get_dataset([dataset_name],
+                        args.dataset_test_ratio,
+                        seed,
+                        check_dataset_strategy=args.check_dataset_strategy)
+            for dataset_name, seed in zip(args.dataset, seed_list)
+        ]
+        train_dataset = []
+        val_dataset_list = []
+        for train_d, val_d in dataset_list:
+            train_dataset.append(train_d)
+            if val_d is not None:
+                val_dataset_list.append(val_d)
+        val_dataset = None
+        if len(val_dataset_list) > 0:
+            val_dataset = concatenate_datasets(val_dataset_list)
+        logger.info(
+            '`train_dataset_sample` is ignored when mixing the datasets.')
+    else:
+        train_dataset, val_dataset = get_dataset(
+            args.dataset,
+            args.dataset_test_ratio,
+            random_state,
+            check_dataset_strategy=args.check_dataset_strategy)
+        if train_dataset is not None and args.train_dataset_sample >= 0:
+            train_dataset_sample = min(args.train_dataset_sample,
+                                       train_dataset.shape[0])
+            if train_dataset.shape[0] > train_dataset_sample:
+                logger.info(f'train_dataset_sample: {train_dataset_sample}')
+                train_idxs = random_state.permutation(train_dataset_sample)
+                train_dataset = train_dataset.select(train_idxs)
+            if val_dataset_sample is None:
+                val_dataset_sample = max(
+                    int(train_dataset_sample * args.dataset_test_ratio), 1)
+    if val_dataset is not None and val_dataset_sample is not None and val_dataset_sample >= 0:
+        if val_dataset.shape[0] > val_dataset_sample:
+            logger.info(f'val_dataset_sample: {val_dataset_sample}')
+            val_dataset = val_dataset.select(range(val_dataset_sample))
+    # add self-cognition dataset
+    if args.self_cognition_sample > 0:
+        if isinstance(train_dataset, list):
+            train_dataset.append(
+                add_self_cognition_dataset(None, args.self_cognition_sample,
+                                           args.model_name, args.model_author))
+        else:
+            train_dataset = add_self_cognition_dataset(
+                train_dataset, args.self_cognition_sample, args.model_name,
+                args.model_author)
+
+    logger.info(f'train_dataset: {train_dataset}')
+    logger.info(f'val_dataset: {val_dataset}')
+    if template.encode_strategy == 'single_pass':
+        example_dataset = train_dataset
+        if isinstance(train_dataset, list):
+            example_dataset = next(d for d in train_dataset if d is not None)
+        example_list = list(
+            example_dataset.select(range(min(100, len(example_dataset)))))
+        res = check_encode_strategy(template, example_list)
+        logger.info(f'check_encode_strategy: {res}')
+    return train_dataset, val_dataset
+
+
+def _set_source_probs(
+        args: SftArguments, train_dataset: Union[LLMDataset,
+                                                 LazyLLMDataset]) -> None:
+    """Set the sampling probabilities of the sources and log the statistics of each source."""
+    source_names = list(args.dataset)
+    if args.self_cognition_sample > 0:
+        source_names.append('self-cognition')
+    sources = train_dataset.sources
+    counts = np.bincount(sources, minlength=len(source_names))
+    if args.dataset_weights is None:
+        # The sizes of the datasets are used as the weights.
+        weights = counts.astype(np.float64)
+    else:
+        weights = np.array(args.dataset_weights, dtype=np.float64)
+        weights[counts[:len(weights)] == 0] = 0
+    probs = weights**(1 / args.dataset_temperature)
+    probs /= probs.sum()
+    if len(probs) < len(source_names):
+        # The self-cognition dataset is sampled in proportion to its size.
+        self_cognition_prob = counts[-1] / counts.sum()
+        probs = np.append(probs * (1 - self_cognition_prob),
+                          self_cognition_prob)
+    train_dataset.source_probs = probs.tolist()
+    lengths = get_dataset_lengths(train_dataset)
+    tokens = None
+    if lengths is not None:
+        tokens = np.bincount(
+            sources, weights=lengths, minlength=len(source_names))
+    for i, source_name in enumerate(source_names):
+        # The expected number of the examples/tokens sampled from the source in an epoch.
+        n_sampled = probs[i] * len(train_dataset)
+        stat_str = (f'examples: {counts[i]}, prob: {probs[i]:.4f}, '
+                    f'sampled examples per epoch: {n_sampled:.0f}')
+        if tokens is not None and counts[i] > 0:
+            n_tokens = tokens[i] / counts[i] * n_sampled
+            stat_str += (f', tokens: {int(tokens[i])}, '
+                         f'sampled tokens per epoch: {n_tokens:.0f}')
+        logger.info(f'[{source_name}] {stat_str}')
+
+
+def _get_streaming_dataset(
+        args: SftArguments,
+        template: Template) -> Tuple[StreamingLLMDataset, Optional[HfDataset]]:
+    set_preprocess_num_proc(args.preprocess_num_proc)
+    set_dataset_load_num_workers(args.dataset_load_num_workers)
+    source_list, val_dataset = get_streaming_dataset(args.dataset)
+    logger.info('`train_dataset_sample` and `dataset_test_ratio` are ignored '
+                'when using `--streaming true`.')
+    if val_dataset is not None and args.val_dataset_sample is not None and args.val_dataset_sample >= 0:
+        if val_dataset.shape[0] > args.val_dataset_sample:
+            logger.info(f'val_dataset_sample: {args.val_dataset_sample}')
+            val_dataset = val_dataset.select(range(args.val_dataset_sample))
+    # add self-cognition dataset
+    if args.self_cognition_sample > 0:
+        self_cognition_dataset = add_self_cognition_dataset(
+            None, args.self_cognition_sample, args.model_name,
+            args.model_author)
+        source_list.append((self_cognition_dataset, None))
+    train_dataset = StreamingLLMDataset(
+        source_list,
+        template,
+        shuffle_buffer_size=args.streaming_buffer_size,
+        seed=args.dataset_seed)
+    if args.resume_from_checkpoint is not None:
+        rank = max(get_dist_setting()[0], 0)
+        dataset_state_path = os.path.join(args.resume_from_checkpoint,
+                                          f'dataset_state_{rank}.json')
+        if os.path.exists(dataset_state_path):
+            with open(dataset_state_path, 'r') as f:
+                train_dataset.load_state_dict(json.load(f))
+        else:
+            # Assuming that the checkpoint is in the first epoch.
+            logger.warning(
+                f'The dataset state is not found: {dataset_state_path}.')
+            trainer_state_path = os.path.join(args.resume_from_checkpoint,
+                                              'trainer_state.json')
+            with open(trainer_state_path, 'r') as f:
+                global_step = json.load(f)['global_step']
+            num_examples = (
+                global_step * args.batch_size
+                * args.gradient_accumulation_steps)
+            train_dataset.load_state_dict({
+                'epoch': 0,
+                'num_examples': num_examples
+            })
+        logger.info(f'resume_epoch: {train_dataset.resume_epoch}, '
+                    f'skip_examples: {train_dataset.skip_examples}')
+    logger.info(f'train_dataset sources: {[s[0] for s in source_list]}')
+    logger.info(f'val_dataset: {val_dataset}')
+    if val_dataset is not None:
+        val_dataset = dataset_map(
+            val_dataset,
+            template.encode_batch,
+            args.preprocess_num_proc,
+            batched=True)
+    return train_dataset, val_dataset
+
+
 def llm_sft(args: SftArguments) -> Dict[str, Union[str, Any]]:
     logger.info(f'args: {args}')
     print(f'device_count: {torch.cuda.device_count()}')
@@ -60,6 +248,8 @@ def llm_sft(args: SftArguments) -> Dict[str, Union[str, Any]]:
     model, tokenizer = get_model_tokenizer(args.model_type, args.torch_dtype,
                                            model_kwargs, **kwargs)
     logger.info(f'model_config: {model.config}')
+    if args.packing:
+        patch_packing_attention(model)
     generation_config = GenerationConfig(
         max_new_tokens=args.max_new_tokens,
         temperature=args.temperature,
@@ -142,68 +332,124 @@ def llm_sft(args: SftArguments) -> Dict[str, Union[str, Any]]:
     logger.info(model_info)
     logger.info(model)
 
-    # Loading Dataset
-    random_state = np.random.RandomState(args.dataset_seed)
-    train_dataset, val_dataset = get_dataset(
-        args.dataset,
-        args.dataset_test_ratio,
-        random_state,
-        check_dataset_strategy=args.check_dataset_strategy)
-    val_dataset_sample = args.val_dataset_sample
-    if train_dataset is not None and args.train_dataset_sample >= 0:
-        train_dataset_sample = min(args.train_dataset_sample,
-                                   train_dataset.shape[0])
-        if train_dataset.shape[0] > train_dataset_sample:
-            logger.info(f'train_dataset_sample: {train_dataset_sample}')
-            train_idxs = random_state.permutation(train_dataset_sample)
-            train_dataset = train_dataset.select(train_idxs)
-        if val_dataset_sample is None:
-            val_dataset_sample = max(
-                int(train_dataset_sample * args.dataset_test_ratio), 1)
-    if val_dataset is not None and val_dataset_sample is not None and val_dataset_sample >= 0:
-        if val_dataset.shape[0] > val_dataset_sample:
-            logger.info(f'val_dataset_sample: {val_dataset_sample}')
-            val_dataset = val_dataset.select(range(val_dataset_sample))
-    # add self-cognition dataset
-    if args.self_cognition_sample > 0:
-        train_dataset = add_self_cognition_dataset(train_dataset,
-                                                   args.self_cognition_sample,
-                                                   args.model_name,
-                                                   args.model_author)
-
-    logger.info(f'train_dataset: {train_dataset}')
-    logger.info(f'val_dataset: {val_dataset}')
     template: Template = get_template(
         args.template_type,
         tokenizer,
         args.system,
         args.max_length,
         args.truncation_strategy,
+        encode_strategy=args.encode_strategy,
         model=model)
     args.system = template.default_system
     logger.info(f'system: {args.system}')
-    if not args.lazy_tokenize:
-        logger.info(f'Using num_proc: {args.preprocess_num_proc}')
-        train_dataset = dataset_map(train_dataset, template.encode,
-                                    args.preprocess_num_proc)
+    dataset_cache_key, dataset_cache = None, None
+    if args.dataset_cache_dir is not None and not args.lazy_tokenize and not args.streaming:
+        dataset_cache_key = get_dataset_cache_key(args, tokenizer)
+        logger.info(f'dataset_cache_key: {dataset_cache_key}')
+
+        def _load_dataset_cache() -> List[Optional[LLMDataset]]:
+            dataset_cache = load_dataset_cache(args.dataset_cache_dir,
+                                               dataset_cache_key)
+            if dataset_cache is None:
+                return [None, None]
+            if _is_dataset_mixing(args) and dataset_cache[0].sources is None:
+                logger.warning(
+                    'The dataset cache does not contain the sources of the examples, ignoring it.'
+                )
+                return [None, None]
+            return list(dataset_cache)
+
+        if args.share_dataset or args.distributed_preprocess:
+            # Loaded by the local master, to keep one copy on each node.
+            dataset_cache = share_dataset_in_node(_load_dataset_cache)
+        else:
+            dataset_cache = _load_dataset_cache()
+        if dataset_cache[0] is None:
+            dataset_cache = None
+    if args.streaming:
+        # The train_dataset is read and tokenized on the fly during training.
+        train_dataset, val_dataset = _get_streaming_dataset(args, template)
         if val_dataset is not None:
-            val_dataset = dataset_map(val_dataset, template.encode,
-                                      args.preprocess_num_proc)
+            stat_dataset(val_dataset, args.eval_batch_size)
+    elif args.lazy_tokenize:
+        train_dataset, val_dataset = _get_train_val_dataset(args, template)
+        sources = None
+        if isinstance(train_dataset, list):
+            source_sizes = [0 if d is None else len(d) for d in train_dataset]
+            sources = np.repeat(np.arange(len(source_sizes)), source_sizes)
+            train_dataset = concatenate_datasets(
+                [d for d in train_dataset if d is not None])
+        train_dataset = LazyLLMDataset(
+            train_dataset, template, cache_size=args.lazy_tokenize_cache_size)
+        train_dataset.sources = sources
+        if val_dataset is not None:
+            val_dataset = LazyLLMDataset(
+                val_dataset,
+                template,
+                cache_size=args.lazy_tokenize_cache_size)
+    else:
+        if dataset_cache is None:
+
+            def _prepare_dataset() -> List[Optional[LLMDataset]]:
+                train_dataset, val_dataset = _get_train_val_dataset(
+                    args, template)
+                logger.info(f'Using num_proc: {args.preprocess_num_proc}')
+                # Each rank only encodes `1/world_size` of the rows when using `distributed_preprocess`.
+                _dataset_map = partial(
+                    dataset_map_distributed
+                    if args.distributed_preprocess else dataset_map,
+                    map_func=template.encode_batch,
+                    num_proc=args.preprocess_num_proc,
+                    batched=True)
+                if isinstance(train_dataset, list):
+                    dataset_list = [
+                        None if d is None else _dataset_map(d)
+                        for d in train_dataset
+                    ]
+                    if args.distributed_preprocess:
+                        # Concatenated on the local master, to keep one copy on each node.
+                        train_dataset = share_dataset_in_node(
+                            lambda: [concat_llm_datasets(dataset_list)])[0]
+                    else:
+                        train_dataset = concat_llm_datasets(dataset_list)
+                    del dataset_list
+                else:
+                    train_dataset = _dataset_map(train_dataset)
+                if val_dataset is not None:
+                    val_dataset = _dataset_map(val_dataset)
+                if dataset_cache_key is not None and is_local_master():
+                    save_dataset_cache(args.dataset_cache_dir,
+                                       dataset_cache_key, train_dataset,
+                                       val_dataset, args)
+                return [train_dataset, val_dataset]
+
+            if args.share_dataset:
+                train_dataset, val_dataset = share_dataset_in_node(
+                    _prepare_dataset)
+            else:
+                train_dataset, val_dataset = _prepare_dataset()
+        else:
+            train_dataset, val_dataset = dataset_cache
+        if args.packing:
+            train_dataset = pack_dataset(train_dataset, args.max_length)
+            if val_dataset is not None and not args.predict_with_generate:
+                val_dataset = pack_dataset(val_dataset, args.max_length)
         if args.test_oom_error:
             train_dataset = sort_by_max_length(train_dataset, 20000)
+    if _is_dataset_mixing(args):
+        _set_source_probs(args, train_dataset)
+    if not args.streaming and not args.lazy_tokenize:
         # Data analysis
         print_example(train_dataset[0], tokenizer)
-        stat_dataset(train_dataset)
+        stat_dataset(train_dataset, args.batch_size)
         if val_dataset is not None:
-            stat_dataset(val_dataset)
-    else:
-        train_dataset = LazyLLMDataset(train_dataset, template)
-        val_dataset = LazyLLMDataset(val_dataset, template)
+            stat_dataset(val_dataset, args.eval_batch_size)
 
     data_collator = partial(
         data_collate_fn,
         tokenizer=tokenizer,
-        padding_to=args.max_length if args.sft_type == 'longlora' else None)
+        padding_to=args.max_length if args.sft_type == 'longlora' else None,
+        pad_to_multiple_of=args.pad_to_multiple_of)
     # Setting training_args
     evaluation_strategy = IntervalStrategy.STEPS
     load_best_model_at_end = True
@@ -236,11 +482,18 @@ def llm_sft(args: SftArguments) -> Dict[str, Union[str, Any]]:
         fp16=args.fp16,
         eval_steps=args.eval_steps,
         dataloader_num_workers=args.dataloader_num_workers,
+        # Keep the LRU cache of LazyLLMDataset in the workers across the epochs.
+        dataloader_persistent_workers=args.lazy_tokenize
+        and args.lazy_tokenize_cache_size > 0
+        and args.dataloader_num_workers > 0,
         load_best_model_at_end=load_best_model_at_end,
         metric_for_best_model='rouge-l'
         if args.predict_with_generate else 'loss',
         greater_is_better=args.predict_with_generate,
-        sortish_sampler=True,
+        group_by_length=args.group_by_length,
+        max_tokens_per_batch=args.max_tokens_per_batch,
+        sampler_seed=args.dataset_seed,
+        ignore_data_skip=args.streaming,
         optim=args.optim,
         hub_model_id=args.hub_model_id,
         hub_private_repo=args.hub_private_repo,
@@ -1,9 +1,11 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
-from .argument import InferArguments, RomeArguments, SftArguments
+from .argument import (DatasetCacheArguments, InferArguments, RomeArguments,
+                       SftArguments)
 from .dataset import (DATASET_MAPPING, DatasetName, GetDatasetFunction,
                       HfDataset, add_self_cognition_dataset, get_dataset,
                       get_dataset_from_repo, load_dataset_from_local,
-                      load_ms_dataset, register_dataset)
+                      load_ms_dataset, prefetch_datasets, register_dataset,
+                      set_dataset_load_num_workers)
 from .model import (MODEL_MAPPING, GetModelTokenizerFunction, LoRATM,
                     ModelType, get_additional_saved_files,
                     get_default_lora_target_modules, get_default_template_type,
@@ -13,15 +15,24 @@ from .preprocess import (AlpacaPreprocessor, ClsPreprocessor,
                          ComposePreprocessor, ConversationsPreprocessor,
                          PreprocessFunc, RenameColumnsPreprocessor,
                          SmartPreprocessor, SwiftPreprocessor,
-                         TextGenerationPreprocessor)
+                         TextGenerationPreprocessor, set_preprocess_num_proc)
+from .streaming import StreamingLLMDataset, get_streaming_dataset
 from .template import (DEFAULT_SYSTEM, TEMPLATE_MAPPING, History, Prompt,
-                       Template, TemplateType, get_template, register_template)
-from .utils import (LazyLLMDataset, LLMDataset, data_collate_fn, dataset_map,
-                    download_dataset, find_all_linear_for_lora,
-                    fix_fp16_trainable_bug, history_to_messages, inference,
-                    inference_stream, is_vllm_available, limit_history_length,
-                    messages_to_history, print_example, set_generation_config,
-                    sort_by_max_length, stat_dataset)
+                       Template, TemplateType, check_encode_strategy,
+                       get_template, register_template)
+from .dataset_cache import (get_dataset_cache_key, list_dataset_cache,
+                            llm_dataset_cache, load_dataset_cache,
+                            prune_dataset_cache, save_dataset_cache)
+from .utils import (
+    IncrementalDetokenizer, KVCacheSession, LazyLLMDataset, LLMDataset,
+    PackedLLMDataset, PrefixKVCache, concat_llm_datasets, data_collate_fn,
+    dataset_map, dataset_map_distributed, download_dataset,
+    find_all_linear_for_lora, fix_fp16_trainable_bug, history_to_messages,
+    inference, inference_batch, inference_stream, is_vllm_available,
+    limit_history_length, messages_to_history, pack_dataset,
+    patch_packing_attention, print_example, set_generation_config,
+    set_kv_cache_max_memory, share_dataset_in_node, sort_by_max_length,
+    stat_dataset)
 
 try:
     if is_vllm_available():
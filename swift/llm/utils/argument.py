@@ -63,10 +63,16 @@ class SftArguments:
     dataset_test_ratio: float = 0.01
     train_dataset_sample: int = 20000  # -1: all dataset
     val_dataset_sample: Optional[int] = None  # -1: all dataset
+    # The temperature of the sampling probabilities of the datasets (mixing).
+    dataset_temperature: float = 1.0
     system: Optional[str] = None
     max_length: int = 2048  # -1: no limit
     truncation_strategy: str = field(
         default='delete', metadata={'choices': ['delete', 'truncation_left']})
+    encode_strategy: str = field(
+        default='context', metadata={'choices': ['context', 'single_pass']})
+    # The directory of the encoded dataset cache. None: no cache.
+    dataset_cache_dir: Optional[str] = None
     check_dataset_strategy: str = field(
         default='none',
         metadata={'choices': ['none', 'discard', 'error', 'warning']})
@@ -145,7 +151,17 @@ class SftArguments:
         })
     disable_tqdm: bool = False
     lazy_tokenize: bool = False
+    lazy_tokenize_cache_size: int = 0
     preprocess_num_proc: int = 1
+    dataset_load_num_workers: int = 1
+    share_dataset: bool = True
+    distributed_preprocess: bool = False
+    packing: bool = False
+    group_by_length: bool = False
+    max_tokens_per_batch: Optional[int] = None
+    pad_to_multiple_of: Optional[int] = None
+    streaming: bool = False
+    streaming_buffer_size: int = 10000
     use_flash_attn: Optional[bool] = None
     ignore_args_error: bool = False  # True: notebook compatibility
     logging_dir: Optional[str] = None
@@ -168,6 +184,7 @@ class SftArguments:
 
     def __post_init__(self) -> None:
         handle_compatibility(self)
+        handle_dataset_weights(self)
         handle_path(self)
         set_model_type(self)
         register_custom_dataset(self)
@@ -275,6 +292,33 @@ class SftArguments:
             self.save_total_limit = None
         if self.max_length == -1:
             self.max_length = None
+        if self.packing:
+            if self.lazy_tokenize:
+                raise ValueError(
+                    '`--packing true` is not compatible with `--lazy_tokenize true`.'
+                )
+            if self.max_length is None:
+                raise ValueError(
+                    'Please set `--max_length` when using `--packing true`.')
+        if self.dataset_weights is not None or self.dataset_temperature != 1:
+            if self.packing or self.streaming or self.group_by_length or self.max_tokens_per_batch is not None:
+                raise ValueError(
+                    'The dataset mixing (the dataset weights or `--dataset_temperature`) is not compatible with '
+                    '`--packing`, `--streaming`, `--group_by_length` or `--max_tokens_per_batch`.'
+                )
+            if self.dataset_weights is not None and len(
+                    self.dataset_weights) != len(self.dataset):
+                raise ValueError(
+                    'Please set the weight of the custom dataset, e.g. `--dataset _custom_dataset:0.5`.'
+                )
+        if self.streaming:
+            if self.max_steps <= 0:
+                raise ValueError(
+                    'Please set `--max_steps` when using `--streaming true`.')
+            if self.packing or self.lazy_tokenize:
+                raise ValueError(
+                    '`--streaming true` is not compatible with `--packing true` or `--lazy_tokenize true`.'
+                )
 
         self.deepspeed = None
         if self.deepspeed_config_path is not None:
@@ -300,6 +344,10 @@ class SftArguments:
             logger.info(
                 f'Setting self.preprocess_num_proc: {self.preprocess_num_proc}'
             )
+        if self.distributed_preprocess and self.share_dataset:
+            # All the ranks take part in the preprocessing.
+            self.share_dataset = False
+            logger.info(f'Setting self.share_dataset: {self.share_dataset}')
         model_info = MODEL_MAPPING[self.model_type]
         support_gradient_checkpointing = model_info.get(
             'support_gradient_checkpointing', True)
@@ -330,6 +378,7 @@ class InferArguments:
         })
     infer_backend: str = field(
         default='AUTO', metadata={'choices': ['AUTO', 'vllm', 'pt']})
+    infer_batch_size: int = 1
     ckpt_dir: Optional[str] = field(
         default=None, metadata={'help': '/path/to/your/vx_xxx/checkpoint-xxx'})
     load_args_from_ckpt_dir: bool = True
@@ -356,6 +405,7 @@ class InferArguments:
         metadata={'choices': ['none', 'discard', 'error', 'warning']})
     custom_train_dataset_path: Optional[List[str]] = None
     custom_val_dataset_path: Optional[List[str]] = None
+    dataset_load_num_workers: int = 1
 
     quantization_bit: int = field(default=0, metadata={'choices': [0, 4, 8]})
     bnb_4bit_comp_dtype: str = field(
@@ -381,6 +431,12 @@ class InferArguments:
     verbose: Optional[bool] = None
     # app-ui
     share: bool = False
+    # kv cache
+    kv_cache_session: bool = False
+    kv_cache_max_memory: float = 4.  # GiB
+    kv_cache_max_cpu_memory: float = 0.  # GiB
+    prefix_kv_cache: bool = False
+    prefix_kv_cache_max_size: int = 4
     # vllm
     gpu_memory_utilization: float = 0.9
     tensor_parallel_size: int = 1
@@ -395,6 +451,7 @@ class InferArguments:
                 f'The checkpoint dir {self.ckpt_dir} passed in is invalid, please make sure'
                 'the dir contains a `configuration.json` file.')
         handle_compatibility(self)
+        handle_dataset_weights(self)
         handle_path(self)
         logger.info(f'ckpt_dir: {self.ckpt_dir}')
         if self.ckpt_dir is None and self.load_args_from_ckpt_dir:
@@ -495,6 +552,25 @@ class RomeArguments(InferArguments):
             self.max_length = None
 
 
+@dataclass
+class DatasetCacheArguments:
+    action: str = field(
+        default='list', metadata={'choices': ['list', 'prune']})
+    dataset_cache_dir: Optional[str] = None
+    # prune: delete the entries not used in the last `max_age_days` days.
+    max_age_days: Optional[float] = None
+    # prune: delete the least recently used entries until the total size <= `max_size_gb`.
+    max_size_gb: Optional[float] = None
+    # prune: delete the specified entries.
+    cache_key: Optional[List[str]] = None
+
+    def __post_init__(self) -> None:
+        if self.dataset_cache_dir is None:
+            raise ValueError('Please set `--dataset_cache_dir`.')
+        self.dataset_cache_dir = _check_path('dataset_cache_dir',
+                                             self.dataset_cache_dir, set())
+
+
 dtype_mapping_reversed = {v: k for k, v in dtype_mapping.items()}
 
 
@@ -586,6 +662,36 @@ def handle_compatibility(args: Union[SftArguments, InferArguments]) -> None:
         args.save_safetensors = args.safe_serialization
 
 
+def handle_dataset_weights(args: Union[SftArguments, InferArguments]) -> None:
+    """Parse the sampling weights of the datasets, e.g. `--dataset alpaca-zh:0.3 blossom-math-zh:0.7`."""
+    args.dataset_weights = None
+    if args.dataset is None:
+        return
+    dataset, dataset_weights = [], []
+    for d in args.dataset:
+        weight = None
+        if ':' in d:
+            name, weight_str = d.rsplit(':', 1)
+            try:
+                weight = float(weight_str)
+            except ValueError:
+                pass
+            else:
+                d = name
+                if weight < 0:
+                    raise ValueError(f'The dataset weight must be >= 0: {d}')
+        dataset.append(d)
+        dataset_weights.append(weight)
+    args.dataset = dataset
+    if all(weight is None for weight in dataset_weights):
+        return
+    if any(weight is None for weight in dataset_weights):
+        raise ValueError(
+            'Please set the weights of all the datasets or none of them, '
+            f'dataset_weights: {dataset_weights}')
+    args.dataset_weights = dataset_weights
+
+
 def set_model_type(args: Union[SftArguments, InferArguments]) -> None:
     assert args.model_type is None or args.model_id_or_path is None
     if args.model_id_or_path is not None:
@@ -668,7 +774,7 @@ def handle_path(args: Union[SftArguments, InferArguments]) -> None:
             or args.model_id_or_path.startswith('/')):
         check_exist_path.append('model_id_or_path')
     check_exist_path_set = set(check_exist_path)
-    other_path = ['output_dir', 'logging_dir']
+    other_path = ['output_dir', 'logging_dir', 'dataset_cache_dir']
     for k in check_exist_path + other_path:
         value = getattr(args, k, None)
         if value is None:
@@ -2,27 +2,26 @@
 import ast
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, Union
 
 import json
 import numpy as np
-import pandas as pd
+import pyarrow as pa
 from datasets import Dataset as HfDataset
-from datasets import concatenate_datasets
+from datasets import Value, concatenate_datasets
 from modelscope import MsDataset
 from numpy.random import RandomState
-from pandas import DataFrame
 from tqdm.auto import tqdm
 
-from swift.utils import (get_logger, get_seed, read_from_jsonl,
-                         transform_jsonl_to_df)
+from swift.utils import get_logger, get_seed
 from .preprocess import (AlpacaPreprocessor, ClsPreprocessor,
                          ComposePreprocessor, ConversationsPreprocessor,
                          PreprocessFunc, RenameColumnsPreprocessor,
                          SmartPreprocessor, TextGenerationPreprocessor)
 from .template import History
-from .utils import download_dataset
+from .utils import _use_msdataset_ddp_barrier, download_dataset
 
 
 def _remove_useless_columns(dataset: HfDataset) -> HfDataset:
@@ -34,6 +33,36 @@ def _remove_useless_columns(dataset: HfDataset) -> HfDataset:
     return dataset
 
 
+_dataset_load_num_workers: int = 1
+
+
+def set_dataset_load_num_workers(num_workers: int) -> None:
+    """Set the number of the threads used to load the subsets (`load_ms_dataset`) and the datasets (`get_dataset`)."""
+    global _dataset_load_num_workers
+    _dataset_load_num_workers = num_workers
+
+
+def _get_dataset_load_num_workers(n: int) -> int:
+    if _use_msdataset_ddp_barrier():
+        # The barriers of `MsDataset.load` (see `_msdataset_ddp_load`) are paired across the ranks in the call order,
+        # so the ranks must load the datasets in the same order.
+        return 1
+    return min(_dataset_load_num_workers, n)
+
+
+def _thread_map(func: Callable[[Any], Any], args_list: List[Any]) -> List[Any]:
+    """The results are in the order of `args_list`, regardless of the completion order.
+
+    `func` should only load the datasets: the preprocessing (e.g. `HfDataset.map(num_proc>1)`, which forks)
+    runs in the main thread.
+    """
+    num_workers = _get_dataset_load_num_workers(len(args_list))
+    if num_workers <= 1:
+        return [func(args) for args in args_list]
+    with ThreadPoolExecutor(num_workers) as executor:
+        return list(executor.map(func, args_list))
+
+
 GetDatasetFunction = Callable[[], Union[HfDataset, Tuple[HfDataset,
                                                          Optional[HfDataset]]]]
 SubsetSplit = Union[str, Tuple[str, str], List[str]]
@@ -177,18 +206,42 @@ def load_ms_dataset(
         subset_split_list: Optional[List[SubsetSplit]]) -> Optional[HfDataset]:
     if subset_split_list is None or len(subset_split_list) == 0:
         return None
-    dataset_list = []
-    for subset_split in subset_split_list:
-        if isinstance(subset_split, str):
-            subset_split = ('default', subset_split)
-        assert len(subset_split) == 2
-        subset_name, split = subset_split
-        dataset = MsDataset.load(
-            dataset_id, subset_name=subset_name, split=split).to_hf_dataset()
-        dataset_list.append(dataset)
+
+    # The subsets are downloaded and loaded in parallel.
+    dataset_list = _thread_map(
+        partial(_load_ms_subset, dataset_id), subset_split_list)
     return concatenate_datasets(dataset_list)
 
 
+def _load_ms_subset(dataset_id: str, subset_split: SubsetSplit) -> HfDataset:
+    if isinstance(subset_split, str):
+        subset_split = ('default', subset_split)
+    assert len(subset_split) == 2
+    subset_name, split = subset_split
+    return MsDataset.load(
+        dataset_id, subset_name=subset_name, split=split).to_hf_dataset()
+
+
+def prefetch_datasets(dataset_name_list: List[str]) -> None:
+    """Download the subsets of the datasets on ModelScope in parallel threads (see `set_dataset_load_num_workers`),
+    so that the following `get_dataset` (loading and preprocessing in the main thread) hits the cache."""
+    args_list = []
+    for dataset_name in dataset_name_list:
+        dataset_info = DATASET_MAPPING[dataset_name]
+        get_function = dataset_info['get_function']
+        while isinstance(get_function, partial):
+            get_function = get_function.func
+        if get_function is not get_dataset_from_repo:
+            continue
+        for subset_split in (list(dataset_info['train_subset_split_list'])
+                             + list(dataset_info['val_subset_split_list'])):
+            args_list.append(
+                (dataset_info['dataset_id_or_path'], subset_split))
+    if _get_dataset_load_num_workers(len(args_list)) <= 1:
+        return
+    _thread_map(lambda args: _load_ms_subset(*args), args_list)
+
+
 @register_dataset(
     DatasetName.text2sql_en,
     'AI-ModelScope/texttosqlv2_25000_v2', ['train'],
@@ -930,61 +983,53 @@ def add_self_cognition_dataset(
         return concatenate_datasets([train_dataset, dataset])
 
 
+def _get_invalid_mask(dataset: HfDataset, key: str) -> np.ndarray:
+    """Check the types of a column with Arrow, instead of iterating the rows in Python."""
+    column = dataset.with_format('arrow')[key]
+    is_null = column.is_null().to_numpy(zero_copy_only=False)
+    if key == 'history':
+        # list or None
+        if pa.types.is_list(column.type) or pa.types.is_large_list(
+                column.type) or pa.types.is_null(column.type):
+            return np.zeros(len(dataset), dtype=np.bool_)
+        return ~is_null
+    # str
+    if pa.types.is_string(column.type) or pa.types.is_large_string(
+            column.type):
+        return is_null
+    return np.ones(len(dataset), dtype=np.bool_)
+
+
 def _check_dataset(
     dataset: Optional[None],
     check_dataset_strategy: Literal['none', 'discard', 'error', 'warning']
 ) -> HfDataset:
     if check_dataset_strategy == 'none' or dataset is None:
         return dataset
-    idx_list = []
     if check_dataset_strategy == 'error':
         assert len(
             set(dataset.features.keys())
             - set(['query', 'response', 'system', 'history'])) == 0
-    has_query = 'query' in dataset.features
-    has_history = 'history' in dataset.features
-    has_system = 'system' in dataset.features
-    is_modified = False
-    for i, d in enumerate(tqdm(dataset)):
-        if not isinstance(d['response'], str):
-            is_modified = True
-            if check_dataset_strategy == 'discard':
-                continue
-            elif check_dataset_strategy == 'warning':
-                logger.warning(f"d['response']: {d['response']}, i: {i}")
-                continue
-            else:
-                raise ValueError(f"d['response']: {d['response']}, i: {i}")
-        if has_query and not isinstance(d['response'], str):
-            is_modified = True
-            if check_dataset_strategy == 'discard':
-                continue
-            elif check_dataset_strategy == 'warning':
-                logger.warning(f"d['query']: {d['query']}, i: {i}")
-                continue
-            else:
-                raise ValueError(f"d['query']: {d['query']}, i: {i}")
-        if has_history and not isinstance(d['history'], (list, type(None))):
-            is_modified = True
-            if check_dataset_strategy == 'discard':
-                continue
-            elif check_dataset_strategy == 'warning':
-                logger.warning(f"d['history']: {d['history']}, i: {i}")
-                continue
-            else:
-                raise ValueError(f"d['history']: {d['history']}, i: {i}")
-        if has_system and not isinstance(d['system'], str):
-            is_modified = True
-            if check_dataset_strategy == 'discard':
-                continue
-            elif check_dataset_strategy == 'warning':
-                logger.warning(f"d['system']: {d['system']}, i: {i}")
-                continue
-            else:
-                raise ValueError(f"d['system']: {d['system']}, i: {i}")
-        idx_list.append(i)
-    if is_modified:
-        dataset = dataset.select(idx_list)
+    invalid_mask = np.zeros(len(dataset), dtype=np.bool_)
+    for key in ['response', 'query', 'history', 'system']:
+        if key not in dataset.features:
+            continue
+        key_invalid_mask = _get_invalid_mask(dataset, key)
+        n_invalid = int(key_invalid_mask.sum())
+        if n_invalid == 0:
+            continue
+        idx_list = np.flatnonzero(key_invalid_mask)[:10].tolist()
+        msg = (
+            f"d['{key}'] is invalid: {n_invalid} rows, indices: {idx_list}, "
+            f"e.g. d['{key}']: {dataset[idx_list[0]][key]!r}")
+        if check_dataset_strategy == 'error':
+            raise ValueError(msg)
+        elif check_dataset_strategy == 'warning':
+            logger.warning(msg)
+        invalid_mask |= key_invalid_mask
+    if invalid_mask.any():
+        logger.info(f'Discard {int(invalid_mask.sum())} rows.')
+        dataset = dataset.select(np.flatnonzero(~invalid_mask))
     assert len(dataset) > 0
     return dataset
 
@@ -1004,14 +1049,23 @@ def get_dataset(
     random_state = dataset_seed
     if isinstance(dataset_seed, int):
         random_state = RandomState(dataset_seed)
-    for dataset_name in dataset_name_list:
+
+    def _load_dataset(dataset_name: str) -> Any:
         dataset_info = DATASET_MAPPING[dataset_name]
         get_function: GetDatasetFunction = dataset_info['get_function']
-        dataset = get_function(
+        return get_function(
             dataset_info['dataset_id_or_path'],
             train_subset_split_list=dataset_info['train_subset_split_list'],
             val_subset_split_list=dataset_info['val_subset_split_list'],
             preprocess_func=dataset_info['preprocess_func'])
+
+    # The datasets are downloaded in parallel, and then loaded and preprocessed in the main thread.
+    # The split uses `random_state` in the order of `dataset_name_list`.
+    prefetch_datasets(dataset_name_list)
+    dataset_list = [
+        _load_dataset(dataset_name) for dataset_name in dataset_name_list
+    ]
+    for dataset in dataset_list:
         train_d: HfDataset
         if isinstance(dataset, (list, tuple)):
             train_d, val_d = dataset
@@ -1041,6 +1095,28 @@ def get_dataset(
     return train_dataset, val_dataset
 
 
+def _load_local_file(dataset_path: str) -> HfDataset:
+    """The file is read in chunks into a memory-mapped Arrow dataset (cached in the `datasets` cache)."""
+    assert isinstance(dataset_path, str)
+    if dataset_path.endswith('.csv'):
+        dataset = HfDataset.from_csv(dataset_path)
+        # pandas may infer `large_string`, which can not be concatenated with `string`.
+        features = dataset.features.copy()
+        for k, v in features.items():
+            if isinstance(v, Value) and v.dtype == 'large_string':
+                features[k] = Value('string')
+        if features != dataset.features:
+            dataset = dataset.cast(features)
+        return dataset
+    elif dataset_path.endswith('.jsonl') or dataset_path.endswith('.json'):
+        return HfDataset.from_json(dataset_path)
+    else:
+        raise ValueError(
+            'The custom dataset only supports CSV format or JSONL format. You can refer to the link '
+            '`https://github.com/modelscope/swift/blob/main/docs/source/LLM/自定义与拓展.md#注册数据集的方式` '
+            'for more information.')
+
+
 def load_dataset_from_local(
         dataset_path_list: Optional[Union[str, List[str]]],
         preprocess_func: PreprocessFunc) -> Optional[HfDataset]:
@@ -1050,25 +1126,15 @@ def load_dataset_from_local(
         return None
     assert isinstance(dataset_path_list, (list, tuple))
 
-    dataset_list = []
-    for dataset_path in dataset_path_list:
-        assert isinstance(dataset_path, str)
-        df: DataFrame
-        if dataset_path.endswith('.csv'):
-            df = pd.read_csv(dataset_path)
-        elif dataset_path.endswith('.jsonl'):
-            df = transform_jsonl_to_df(read_from_jsonl(dataset_path))
-        elif dataset_path.endswith('.json'):
-            with open(dataset_path, 'r', encoding='utf-8') as f:
-                obj_list = json.load(f)
-            df = transform_jsonl_to_df(obj_list)
-        else:
-            raise ValueError(
-                'The custom dataset only supports CSV format or JSONL format. You can refer to the link '
-                '`https://github.com/modelscope/swift/blob/main/docs/source/LLM/自定义与拓展.md#注册数据集的方式` '
-                'for more information.')
-        dataset = HfDataset.from_dict(df.to_dict(orient='list'))
-        dataset_list.append(preprocess_func(dataset))
+    if len(dataset_path_list) == 1:
+        dataset_list = [_load_local_file(dataset_path_list[0])]
+    else:
+        # The files are read in parallel (pyarrow releases the GIL).
+        max_workers = min(len(dataset_path_list), os.cpu_count() or 1, 8)
+        with ThreadPoolExecutor(max_workers) as executor:
+            dataset_list = list(
+                executor.map(_load_local_file, dataset_path_list))
+    dataset_list = [preprocess_func(dataset) for dataset in dataset_list]
     return concatenate_datasets(dataset_list)
 
 
@@ -0,0 +1,329 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import hashlib
+import inspect
+import os
+import shutil
+import socket
+import time
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import Dataset as HfDataset
+from datasets.fingerprint import generate_random_fingerprint
+from transformers import PreTrainedTokenizerBase
+
+import swift
+from swift.utils import get_logger
+from .argument import DatasetCacheArguments, SftArguments
+from .dataset import DATASET_MAPPING
+from .utils import LLMDataset
+
+logger = get_logger()
+
+# The arguments of SftArguments that affect the encoded dataset.
+DATASET_CACHE_ARGS = [
+    'model_type', 'dataset', 'dataset_seed', 'dataset_test_ratio',
+    'train_dataset_sample', 'val_dataset_sample', 'check_dataset_strategy',
+    'self_cognition_sample', 'model_name', 'model_author', 'template_type',
+    'system', 'max_length', 'truncation_strategy', 'encode_strategy',
+    'dataset_weights', 'dataset_temperature'
+]
+_INFO_FNAME = 'cache_info.json'
+_TOKENIZER_FNAME_PREFIX = ('tokenizer', 'vocab', 'merges', 'special_tokens',
+                           'added_tokens')
+_TOKENIZER_FNAME_SUFFIX = ('.model', '.tiktoken')
+
+
+def _update_hash(hasher: 'hashlib._Hash', obj: Any) -> None:
+    """Hash the content (source code for functions and classes) instead of the object id."""
+    if isinstance(obj, (list, tuple)):
+        hasher.update(f'{type(obj).__name__}{len(obj)}'.encode())
+        for o in obj:
+            _update_hash(hasher, o)
+    elif isinstance(obj, dict):
+        hasher.update(f'dict{len(obj)}'.encode())
+        for k in sorted(obj.keys(), key=str):
+            hasher.update(str(k).encode())
+            _update_hash(hasher, obj[k])
+    elif obj is None or isinstance(obj, (str, int, float, bool)):
+        hasher.update(repr(obj).encode())
+        # local files
+        if isinstance(obj, str) and os.path.isfile(obj):
+            stat = os.stat(obj)
+            hasher.update(f'{stat.st_size}-{stat.st_mtime_ns}'.encode())
+    elif isinstance(obj, partial):
+        _update_hash(hasher, [obj.func, obj.args, obj.keywords])
+    elif inspect.isfunction(obj) or inspect.ismethod(obj) or inspect.isclass(
+            obj):
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            source = f'{obj.__module__}.{obj.__qualname__}'
+        hasher.update(source.encode())
+    else:
+        _update_hash(hasher, type(obj))
+        _update_hash(hasher, getattr(obj, '__dict__', repr(obj)))
+
+
+def _update_tokenizer_hash(hasher: 'hashlib._Hash',
+                           tokenizer: PreTrainedTokenizerBase) -> None:
+    tokenizer_dir = tokenizer.name_or_path
+    fname_list = []
+    if os.path.isdir(tokenizer_dir):
+        fname_list = [
+            fname for fname in sorted(os.listdir(tokenizer_dir))
+            if fname.startswith(_TOKENIZER_FNAME_PREFIX)
+            or fname.endswith(_TOKENIZER_FNAME_SUFFIX)
+        ]
+    for fname in fname_list:
+        hasher.update(fname.encode())
+        with open(os.path.join(tokenizer_dir, fname), 'rb') as f:
+            hasher.update(f.read())
+    if len(fname_list) == 0:
+        _update_hash(hasher, sorted(tokenizer.get_vocab().items()))
+    # The special tokens may be modified in `get_model_tokenizer`.
+    _update_hash(hasher, tokenizer.special_tokens_map)
+
+
+def get_dataset_cache_key(args: SftArguments,
+                          tokenizer: PreTrainedTokenizerBase) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(swift.__version__.encode())
+    _update_hash(hasher, {k: getattr(args, k) for k in DATASET_CACHE_ARGS})
+    for dataset_name in args.dataset:
+        _update_hash(hasher, DATASET_MAPPING[dataset_name])
+    _update_tokenizer_hash(hasher, tokenizer)
+    return hasher.hexdigest()[:32]
+
+
+def _get_dir_size(dir_path: str) -> int:
+    size = 0
+    for root, _, fname_list in os.walk(dir_path):
+        for fname in fname_list:
+            size += os.path.getsize(os.path.join(root, fname))
+    return size
+
+
+def _to_columnar_array(
+        column: pa.ChunkedArray) -> Tuple[np.ndarray, np.ndarray]:
+    """The flat int32 array and the lengths (-1: None) of a list column."""
+    lengths = np.concatenate([
+        pc.list_value_length(chunk).fill_null(-1).to_numpy(
+            zero_copy_only=False).astype(np.int64) for chunk in column.chunks
+    ] or [np.zeros(0, dtype=np.int64)])
+    values = np.concatenate([
+        pc.list_flatten(chunk).to_numpy(zero_copy_only=False).astype(
+            np.int32, copy=False) for chunk in column.chunks
+    ] or [np.zeros(0, dtype=np.int32)])
+    return values, lengths
+
+
+def _from_hf_dataset(dataset: HfDataset) -> LLMDataset:
+    table = dataset.with_format('arrow')[:]
+    input_ids = _to_columnar_array(table['input_ids'])
+    if 'labels' in table.column_names:
+        labels = _to_columnar_array(table['labels'])
+    else:
+        labels = (np.zeros(0, dtype=np.int32),
+                  np.full(len(dataset), -1, dtype=np.int64))
+    return LLMDataset.from_columnar({'input_ids': input_ids, 'labels': labels})
+
+
+def load_dataset_cache(
+        dataset_cache_dir: str,
+        cache_key: str) -> Optional[Tuple[LLMDataset, Optional[LLMDataset]]]:
+    """Returns None if the cache is missing.
+
+    If the train_dataset is mixed from several sources (see `concat_llm_datasets`),
+    its `source_offsets` are restored.
+    """
+    cache_dir = os.path.join(dataset_cache_dir, cache_key)
+    info_path = os.path.join(cache_dir, _INFO_FNAME)
+    if not os.path.exists(info_path):
+        return None
+    with open(info_path, 'r') as f:
+        info = json.load(f)
+    res = []
+    for split in ['train', 'val']:
+        split_dir = os.path.join(cache_dir, split)
+        dataset = None
+        if os.path.isdir(split_dir):
+            dataset = _from_hf_dataset(HfDataset.load_from_disk(split_dir))
+            source_offsets = info.get(f'{split}_source_offsets')
+            if source_offsets is not None:
+                dataset.source_offsets = np.array(
+                    source_offsets, dtype=np.int64)
+        res.append(dataset)
+    os.utime(info_path)  # last used time
+    logger.info(f'Loading the dataset cache: {cache_dir}')
+    return tuple(res)
+
+
+# The offsets of the arrow list<int32> are int32.
+_MAX_CHUNK_VALUES = 2**31 - 1
+
+
+def _to_list_array(values: np.ndarray,
+                   offsets: np.ndarray,
+                   mask: Optional[np.ndarray] = None) -> pa.ChunkedArray:
+    """Build the list<int32> column from the flat buffer and the offsets,
+    without converting the tokens to python objects."""
+    n = len(offsets) - 1
+    bounds = [0]
+    while bounds[-1] < n:
+        start = bounds[-1]
+        end = np.searchsorted(
+            offsets, offsets[start] + _MAX_CHUNK_VALUES, side='right') - 1
+        bounds.append(min(max(end, start + 1), n))
+    chunks = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        chunk_offsets = (offsets[start:end + 1] - offsets[start]).astype(
+            np.int32)
+        chunk_values = values[offsets[start]:offsets[end]]
+        chunk_mask = None if mask is None else pa.array(mask[start:end])
+        chunks.append(
+            pa.ListArray.from_arrays(
+                pa.array(chunk_offsets),
+                pa.array(chunk_values, type=pa.int32()),
+                mask=chunk_mask))
+    return pa.chunked_array(chunks, type=pa.list_(pa.int32()))
+
+
+def _to_hf_dataset(llm_dataset: Optional[LLMDataset]) -> Optional[HfDataset]:
+    if llm_dataset is None:
+        return None
+    columns = {
+        'input_ids':
+        _to_list_array(llm_dataset.input_ids, llm_dataset.input_ids_offsets)
+    }
+    if llm_dataset.has_labels.any():
+        columns['labels'] = _to_list_array(llm_dataset.labels,
+                                           llm_dataset.labels_offsets,
+                                           ~llm_dataset.has_labels)
+    table = pa.table(columns)
+    if llm_dataset.idx is not None:
+        table = table.take(pa.array(llm_dataset.idx))
+    # Hashing the table for the fingerprint would pickle all the tokens.
+    return HfDataset(table, fingerprint=generate_random_fingerprint())
+
+
+def save_dataset_cache(dataset_cache_dir: str, cache_key: str,
+                       train_dataset: LLMDataset,
+                       val_dataset: Optional[LLMDataset],
+                       args: SftArguments) -> None:
+    for dataset in [train_dataset, val_dataset]:
+        if dataset is None or len(dataset) == 0:
+            continue
+        keys = set(dataset[0].keys()) - {'input_ids', 'labels'}
+        if len(keys) > 0:
+            logger.warning(f'The dataset cache does not support the keys: '
+                           f'{keys}. Skipping saving the dataset cache.')
+            return
+    cache_dir = os.path.join(dataset_cache_dir, cache_key)
+    if os.path.exists(cache_dir):
+        return
+    # Written to a temporary directory first, and then renamed (atomic).
+    tmp_dir = os.path.join(
+        dataset_cache_dir,
+        f'.tmp-{cache_key}-{socket.gethostname()}-{os.getpid()}')
+    try:
+        info = {
+            'cache_key': cache_key,
+            'created_time': time.time(),
+            'args': {k: getattr(args, k)
+                     for k in DATASET_CACHE_ARGS}
+        }
+        for split, dataset in zip(['train', 'val'],
+                                  [train_dataset, val_dataset]):
+            dataset = _to_hf_dataset(dataset)
+            if dataset is None:
+                continue
+            dataset.save_to_disk(os.path.join(tmp_dir, split))
+            info[f'{split}_dataset_len'] = len(dataset)
+        source_offsets = getattr(train_dataset, 'source_offsets', None)
+        if source_offsets is not None:
+            info['train_source_offsets'] = source_offsets.tolist()
+        with open(os.path.join(tmp_dir, _INFO_FNAME), 'w') as f:
+            json.dump(info, f, ensure_ascii=False, indent=2)
+        os.rename(tmp_dir, cache_dir)
+        logger.info(f'Saving the dataset cache: {cache_dir}')
+    except OSError as e:
+        # e.g. Another process has saved the cache.
+        logger.warning(f'Saving the dataset cache failed: {e}')
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def list_dataset_cache(dataset_cache_dir: str) -> List[Dict[str, Any]]:
+    """Returns the information of the cache entries, sorted by the last used time (descending)."""
+    res = []
+    if not os.path.isdir(dataset_cache_dir):
+        return res
+    for cache_key in os.listdir(dataset_cache_dir):
+        cache_dir = os.path.join(dataset_cache_dir, cache_key)
+        info_path = os.path.join(cache_dir, _INFO_FNAME)
+        if not os.path.isfile(info_path):
+            continue
+        with open(info_path, 'r') as f:
+            info = json.load(f)
+        info['cache_dir'] = cache_dir
+        info['last_used_time'] = os.path.getmtime(info_path)
+        info['size'] = _get_dir_size(cache_dir)
+        res.append(info)
+    res.sort(key=lambda info: info['last_used_time'], reverse=True)
+    return res
+
+
+def prune_dataset_cache(dataset_cache_dir: str,
+                        max_age_days: Optional[float] = None,
+                        max_size_gb: Optional[float] = None,
+                        cache_key: Optional[List[str]] = None) -> List[str]:
+    """Delete the entries in `cache_key`, the entries not used in the last `max_age_days` days,
+    and the least recently used entries until the total size <= `max_size_gb`.
+
+    Returns: The deleted cache_dir list.
+    """
+    cache_info_list = list_dataset_cache(dataset_cache_dir)
+    cache_key_set = set(cache_key or [])
+    total_size = sum(info['size'] for info in cache_info_list)
+    res = []
+    # from the least recently used
+    for info in reversed(cache_info_list):
+        age_days = (time.time() - info['last_used_time']) / 86400
+        if not (info['cache_key'] in cache_key_set or
+                (max_age_days is not None and age_days > max_age_days) or
+                (max_size_gb is not None and total_size > max_size_gb * 1e9)):
+            continue
+        shutil.rmtree(info['cache_dir'])
+        total_size -= info['size']
+        res.append(info['cache_dir'])
+    return res
+
+
+def llm_dataset_cache(args: DatasetCacheArguments) -> List[Dict[str, Any]]:
+    if args.action == 'list':
+        cache_info_list = list_dataset_cache(args.dataset_cache_dir)
+        for info in cache_info_list:
+            last_used_time = time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(info['last_used_time']))
+            logger.info(
+                f"cache_key: {info['cache_key']}, size: {info['size'] / 1e9:.3f}GB, "
+                f'last_used_time: {last_used_time}, '
+                f"train_dataset_len: {info.get('train_dataset_len')}, "
+                f"val_dataset_len: {info.get('val_dataset_len')}, "
+                f"args: {info['args']}")
+        logger.info(f'Number of entries: {len(cache_info_list)}')
+        return cache_info_list
+    else:
+        deleted_list = prune_dataset_cache(args.dataset_cache_dir,
+                                           args.max_age_days, args.max_size_gb,
+                                           args.cache_key)
+        for cache_dir in deleted_list:
+            logger.info(f'Deleted: {cache_dir}')
+        logger.info(f'Number of deleted entries: {len(deleted_list)}')
+        return [{'cache_dir': cache_dir} for cache_dir in deleted_list]
@@ -1,32 +1,107 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
 import ast
-from typing import Callable, Dict, List, Literal, Optional
+import re
+from typing import Any, Callable, Dict, List, Literal, Optional
 
+import json
+import pyarrow as pa
+import pyarrow.compute as pc
 from datasets import Dataset as HfDataset
-from tqdm import tqdm
+from datasets import Features, Sequence, Value
 
 from .template import History
 
 PreprocessFunc = Callable[[HfDataset], HfDataset]
+BatchedPreprocessFunc = Callable[[Dict[str, List[Any]]], Dict[str, List[Any]]]
+
+_preprocess_num_proc: int = 1
+
+
+def set_preprocess_num_proc(num_proc: int) -> None:
+    """Set the number of the processes used by the preprocessors (`HfDataset.map(num_proc=...)`)."""
+    global _preprocess_num_proc
+    _preprocess_num_proc = num_proc
+
+
+_HISTORY_FEATURE = Sequence(Sequence(Value('string')))
+# The JSON escapes which are decoded differently by `ast.literal_eval`.
+_JSON_UNSAFE_PATTERN = re.compile(r'\\/|\\u[dD][89a-fA-F]')
+
+
+def _reject_json_constant(s: str) -> Any:
+    raise ValueError(f'Not a Python literal: {s}')
+
+
+def _has_json_literal(obj: Any) -> bool:
+    """`true`, `false` and `null` are not Python literals."""
+    if obj is None or isinstance(obj, bool):
+        return True
+    if isinstance(obj, list):
+        return any(_has_json_literal(x) for x in obj)
+    if isinstance(obj, dict):
+        return any(_has_json_literal(x) for x in obj.values())
+    return False
+
+
+def _literal_eval(s: str) -> Any:
+    """The same as `ast.literal_eval`, but try `json.loads` first (which is much faster).
+    The JSON-only syntax (`true`, `false`, `null`, `NaN`, `Infinity`) is left to `ast.literal_eval`."""
+    if _JSON_UNSAFE_PATTERN.search(s) is None:
+        try:
+            res = json.loads(s, parse_constant=_reject_json_constant)
+        except ValueError:
+            pass
+        else:
+            if not _has_json_literal(res):
+                return res
+    return ast.literal_eval(s)
+
+
+def _map_batched(dataset: HfDataset,
+                 batched_func: BatchedPreprocessFunc,
+                 features: Optional[Features] = None,
+                 remove_columns: bool = True) -> HfDataset:
+    """The rows are processed in batches (column-oriented) in `_preprocess_num_proc` processes.
+    remove_columns: Whether to remove the original columns."""
+    num_proc = min(_preprocess_num_proc, max(len(dataset) // 1000, 1))
+    return dataset.map(
+        batched_func,
+        batched=True,
+        num_proc=num_proc if num_proc > 1 else None,
+        remove_columns=dataset.column_names if remove_columns else None,
+        features=features)
+
+
+def _is_all_null(dataset: HfDataset, key: str) -> bool:
+    return dataset.with_format('arrow')[key].null_count == len(dataset)
+
+
+def _is_all_empty(dataset: HfDataset, key: str) -> bool:
+    length = pc.list_value_length(dataset.with_format('arrow')[key])
+    return len(dataset) == 0 or (pc.max(length).as_py() or 0) == 0
 
 
 class SwiftPreprocessor:
 
+    @staticmethod
+    def _preprocess_batch(batch: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+        history = [
+            None if h is None else _literal_eval(h) for h in batch['history']
+        ]
+        return {'history': history}
+
     def __call__(self, dataset: HfDataset) -> HfDataset:
         if 'history' in dataset.features:
-            old_history = dataset['history']
-
-            history: List[History] = []
-            for old_h in tqdm(old_history):
-                if isinstance(old_h, list):
-                    break
-                h = None
-                if old_h is not None:
-                    h = ast.literal_eval(old_h)
-                history.append(h)
-            else:
-                dataset = dataset.remove_columns(['history']).add_column(
-                    'history', history)
+            history_type = dataset.data.schema.field('history').type
+            if pa.types.is_string(history_type) or pa.types.is_large_string(
+                    history_type):
+                features = dataset.features.copy()
+                features['history'] = _HISTORY_FEATURE
+                dataset = _map_batched(
+                    dataset,
+                    self._preprocess_batch,
+                    features,
+                    remove_columns=False)
         return dataset
 
 
@@ -36,12 +111,15 @@ class AlpacaPreprocessor:
                  concat_inst_inp: Optional[Callable[[str, str], str]] = None):
         self.concat_inst_inp = concat_inst_inp
 
-    def __call__(self, dataset: HfDataset) -> HfDataset:
+    def _preprocess_batch(self,
+                          batch: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
         query: List[str] = []
         response = []
-        for d in tqdm(dataset):
-            inst, inp, output = d['instruction'], d.get('input',
-                                                        None), d['output']
+        input_list = batch.get('input')
+        if input_list is None:
+            input_list = [None] * len(batch['instruction'])
+        for inst, inp, output in zip(batch['instruction'], input_list,
+                                     batch['output']):
             if output is None:
                 continue
             if inp is None or len(inp) == 0:
@@ -52,13 +130,19 @@ class AlpacaPreprocessor:
                 q = f'{inst}\n{inp}'
             query.append(q)
             response.append(output)
-        dataset = HfDataset.from_dict({'query': query, 'response': response})
-        return dataset
+        return {'query': query, 'response': response}
+
+    def __call__(self, dataset: HfDataset) -> HfDataset:
+        features = Features({
+            'query': Value('string'),
+            'response': Value('string')
+        })
+        return _map_batched(dataset, self._preprocess_batch, features)
 
 
 def _default_repair_conversations(s: str) -> Dict[str, str]:
     if isinstance(s, str):
-        return ast.literal_eval(s)
+        return _literal_eval(s)
     return s
 
 
@@ -83,17 +167,15 @@ class ConversationsPreprocessor:
         self.repair_conversations = repair_conversations
         self.error_strategy = error_strategy
 
-    def __call__(self, dataset: HfDataset) -> HfDataset:
+    def _preprocess_batch(self,
+                          batch: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
         query: List[str] = []
         response: List[str] = []
         system: List[Optional[str]] = []
-        has_system = False
         history: List[History] = []
-        has_history = False
 
-        for d in tqdm(dataset):
+        for conversations in batch[self.conversations_key]:
             try:
-                conversations = d[self.conversations_key]
                 conversations = self.repair_conversations(conversations)
                 if conversations is None:
                     continue
@@ -101,7 +183,6 @@ class ConversationsPreprocessor:
                 sys = None
                 h: History = []
                 if conversations[0][self.from_key] == self.system_role:
-                    has_system = True
                     lo += 1
                     sys = conversations[0][self.value_key]
                 assert conversations[-2][self.from_key] == self.user_role
@@ -112,8 +193,6 @@ class ConversationsPreprocessor:
                     assert q[self.from_key] == self.user_role
                     assert r[self.from_key] == self.assistant_role
                     h.append([q[self.value_key], r[self.value_key]])
-                if len(h) > 0:
-                    has_history = True
                 query.append(conversations[-2][self.value_key])
                 response.append(conversations[-1][self.value_key])
                 system.append(sys)
@@ -121,16 +200,29 @@ class ConversationsPreprocessor:
             except AssertionError:
                 if self.error_strategy == 'raise':
                     raise ValueError(f'conversations: {conversations}')
-        kwargs = {}
-        if has_system:
-            kwargs['system'] = system
-        if has_history:
-            kwargs['history'] = history
-        kwargs.update({
+        return {
+            'system': system,
+            'history': history,
             'query': query,
-            'response': response,
+            'response': response
+        }
+
+    def __call__(self, dataset: HfDataset) -> HfDataset:
+        features = Features({
+            'system': Value('string'),
+            'history': _HISTORY_FEATURE,
+            'query': Value('string'),
+            'response': Value('string')
         })
-        dataset = HfDataset.from_dict({**kwargs})
+        dataset = _map_batched(dataset, self._preprocess_batch, features)
+        # Only keep the columns used by some rows.
+        remove_columns = []
+        if _is_all_null(dataset, 'system'):
+            remove_columns.append('system')
+        if _is_all_empty(dataset, 'history'):
+            remove_columns.append('history')
+        if len(remove_columns) > 0:
+            dataset = dataset.remove_columns(remove_columns)
         return dataset
 
 
@@ -209,14 +301,13 @@ class TextGenerationPreprocessor:
         self.query_key = query_key
         self.response_key = response_key
 
+    def _preprocess_batch(self,
+                          batch: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+        query = [self.prompt.format(query=q) for q in batch[self.query_key]]
+        return {'query': query, 'response': batch[self.response_key]}
+
     def __call__(self, dataset: HfDataset) -> HfDataset:
-        query = []
-        for d in tqdm(dataset):
-            query.append(self.prompt.format(query=d[self.query_key]))
-        return HfDataset.from_dict({
-            'query': query,
-            'response': dataset[self.response_key]
-        })
+        return _map_batched(dataset, self._preprocess_batch)
 
 
 class ClsPreprocessor:
@@ -236,17 +327,22 @@ Output: """
         self.task_name = task_name
         self.is_pair_seq = is_pair_seq
 
-    def __call__(self, dataset: HfDataset) -> HfDataset:
+    def _preprocess_batch(self,
+                          batch: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
         query = []
         response = []
-        for d in tqdm(dataset):
-            if d['label'] is None:  # ignore dataset error
+        for i, label in enumerate(batch['label']):
+            if label is None:  # ignore dataset error
                 continue
             if self.is_pair_seq:
                 q = self.prompt.format(
-                    sentence1=d['sentence1'], sentence2=d['sentence2'])
+                    sentence1=batch['sentence1'][i],
+                    sentence2=batch['sentence2'][i])
             else:
-                q = self.prompt.format(sentence=d['sentence'])
+                q = self.prompt.format(sentence=batch['sentence'][i])
             query.append(q)
-            response.append(self.labels[int(d['label'])])
-        return HfDataset.from_dict({'query': query, 'response': response})
+            response.append(self.labels[int(label)])
+        return {'query': query, 'response': response}
+
+    def __call__(self, dataset: HfDataset) -> HfDataset:
+        return _map_batched(dataset, self._preprocess_batch)
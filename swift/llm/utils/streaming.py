@@ -0,0 +1,233 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import json
+import pandas as pd
+from datasets import Dataset as HfDataset
+from datasets import concatenate_datasets
+from numpy.random import RandomState
+from torch.utils.data import IterableDataset, get_worker_info
+
+from swift.utils import get_dist_setting, get_logger
+from .dataset import (DATASET_MAPPING, get_custom_dataset, get_dataset,
+                      load_dataset_from_local)
+from .preprocess import PreprocessFunc
+from .template import Template
+from .utils import _postprocess_map
+
+logger = get_logger()
+
+# (dataset_path, preprocess_func) or (HfDataset, None)
+StreamingSource = Tuple[Union[str, HfDataset], Optional[PreprocessFunc]]
+
+
+def _iter_jsonl(dataset_path: str, start: int,
+                end: int) -> Iterator[Dict[str, Any]]:
+    """Iterate the lines starting in the byte range [start, end)."""
+    with open(dataset_path, 'rb') as f:
+        if start > 0:
+            # Skip the line that starts before `start`.
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _check_streaming_path(dataset_path: str) -> None:
+    if dataset_path.endswith('.json'):
+        # A JSON array cannot be read incrementally, so every worker of every rank would load the whole file.
+        raise ValueError(
+            f'The streaming mode does not support JSON files: {dataset_path}. '
+            'Please convert it to JSONL (one object per line), e.g. '
+            "`pd.read_json(path).to_json(path + 'l', orient='records', lines=True, force_ascii=False)`."
+        )
+    if not dataset_path.endswith(('.jsonl', '.csv')):
+        raise ValueError(
+            f'The streaming mode only supports CSV/JSONL: {dataset_path}')
+
+
+def _iter_chunks(source: StreamingSource, shard_id: int, num_shards: int,
+                 chunk_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """Iterate the chunks of the raw rows of the shard `shard_id`.
+
+    JSONL files are sharded by byte ranges, so each shard only reads its part of the file.
+    CSV fields may contain newlines, so every shard parses the whole CSV file and keeps its chunks
+    (round-robin): the parsing cost is multiplied by the number of shards (world_size * num_workers).
+    Prefer JSONL for large files.
+    """
+    dataset, _ = source
+    if isinstance(dataset, HfDataset):
+        start = len(dataset) * shard_id // num_shards
+        end = len(dataset) * (shard_id + 1) // num_shards
+        for i in range(start, end, chunk_size):
+            yield dataset.select(range(i, min(i + chunk_size, end))).to_list()
+        return
+    dataset_path = dataset
+    if dataset_path.endswith('.jsonl'):
+        # Each shard only reads its byte range of the file.
+        file_size = os.path.getsize(dataset_path)
+        start = file_size * shard_id // num_shards
+        end = file_size * (shard_id + 1) // num_shards
+        chunk = []
+        for row in _iter_jsonl(dataset_path, start, end):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+        return
+    _check_streaming_path(dataset_path)
+    chunk_iter = (
+        df.to_dict(orient='records')
+        for df in pd.read_csv(dataset_path, chunksize=chunk_size))
+    for i, chunk in enumerate(chunk_iter):
+        if i % num_shards == shard_id:
+            yield chunk
+
+
+def get_streaming_dataset(
+    dataset_name_list: List[str]
+) -> Tuple[List[StreamingSource], Optional[HfDataset]]:
+    """Returns the streaming sources of the train datasets and the (in-memory) val_dataset.
+
+    The local files (CSV/JSONL) of the custom datasets are read lazily. The other datasets (e.g. on ModelScope)
+    are loaded as memory-mapped HfDataset and then streamed.
+    The val_dataset is only loaded from the val splits (`dataset_test_ratio` is not supported).
+    """
+    source_list = []
+    val_dataset_list = []
+    for dataset_name in dataset_name_list:
+        dataset_info = DATASET_MAPPING[dataset_name]
+        if dataset_info['get_function'] is get_custom_dataset:
+            preprocess_func = dataset_info['preprocess_func']
+            dataset_path_list = dataset_info['train_subset_split_list']
+            if isinstance(dataset_path_list, str):
+                dataset_path_list = [dataset_path_list]
+            for dataset_path in dataset_path_list:
+                _check_streaming_path(dataset_path)
+                source_list.append((dataset_path, preprocess_func))
+            val_dataset = load_dataset_from_local(
+                dataset_info['val_subset_split_list'], preprocess_func)
+        else:
+            logger.info(
+                f'Loading the dataset before streaming: {dataset_name}')
+            train_dataset, val_dataset = get_dataset([dataset_name])
+            if train_dataset is not None:
+                source_list.append((train_dataset, None))
+        if val_dataset is not None:
+            val_dataset_list.append(val_dataset)
+    val_dataset = None
+    if len(val_dataset_list) > 0:
+        val_dataset = concatenate_datasets(val_dataset_list)
+    return source_list, val_dataset
+
+
+class StreamingLLMDataset(IterableDataset):
+    """The pipeline: shard readers -> preprocess_func -> template.encode -> shuffle buffer.
+
+    The rows are sharded across the DDP ranks and the DataLoader workers (`shard_by_rank`),
+    so each process only reads and tokenizes its own part. The chunks of the sources are interleaved
+    (a random unfinished source for each chunk), so that the shuffle buffer mixes the datasets.
+    The memory is bounded by `chunk_size` and `shuffle_buffer_size`.
+    The order only depends on `seed`, the epoch (see `set_epoch`), world_size and num_workers.
+
+    When resuming (see `load_state_dict`), the examples of each rank consumed in the resumed epoch
+    are skipped inside the workers, and the following epochs are read from the start.
+    """
+    shard_by_rank = True
+
+    def __init__(self,
+                 source_list: List[StreamingSource],
+                 template: Template,
+                 *,
+                 shuffle_buffer_size: int = 10000,
+                 chunk_size: int = 1000,
+                 seed: int = 42) -> None:
+        self.source_list = source_list
+        self.template = template
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.epoch = 0
+        # The number of examples of this rank consumed in the current epoch (counted in the main process).
+        self.num_examples = 0
+        self.resume_epoch = 0
+        self.skip_examples = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        # The trainer counts the epochs from 0 again after resuming.
+        self.epoch = self.resume_epoch + epoch
+        self.num_examples = self.skip_examples if self.epoch == self.resume_epoch else 0
+
+    def state_dict(self) -> Dict[str, int]:
+        return {'epoch': self.epoch, 'num_examples': self.num_examples}
+
+    def load_state_dict(self, state_dict: Dict[str, int]) -> None:
+        self.epoch = self.resume_epoch = state_dict['epoch']
+        self.num_examples = self.skip_examples = state_dict['num_examples']
+
+    def _iter_encoded(self, shard_id: int, num_shards: int,
+                      random_state: RandomState) -> Iterator[Dict[str, Any]]:
+        chunk_iter_list = [
+            _iter_chunks(source, shard_id, num_shards, self.chunk_size)
+            for source in self.source_list
+        ]
+        active_list = list(range(len(self.source_list)))
+        while len(active_list) > 0:
+            i = active_list[random_state.randint(len(active_list))]
+            chunk = next(chunk_iter_list[i], None)
+            if chunk is None:
+                active_list.remove(i)
+                continue
+            _, preprocess_func = self.source_list[i]
+            if preprocess_func is not None:
+                chunk = preprocess_func(HfDataset.from_list(chunk))
+                if len(chunk) == 0:
+                    continue
+                chunk = chunk.to_list()
+            for data in self.template.encode_batch(chunk):
+                data = _postprocess_map(data)
+                if data is not None:
+                    yield data
+
+    def _shuffle(self, data_iter: Iterator[Dict[str, Any]],
+                 random_state: RandomState) -> Iterator[Dict[str, Any]]:
+        buffer = []
+        for data in data_iter:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(data)
+                continue
+            i = random_state.randint(len(buffer))
+            yield buffer[i]
+            buffer[i] = data
+        for i in random_state.permutation(len(buffer)):
+            yield buffer[i]
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        rank, _, world_size, _ = get_dist_setting()
+        rank, world_size = max(rank, 0), max(world_size, 1)
+        worker_info = get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        shard_id = rank * num_workers + worker_id
+        num_shards = world_size * num_workers
+        random_state = RandomState((self.seed + self.epoch) * num_shards
+                                   + shard_id)
+        data_iter = self._iter_encoded(shard_id, num_shards, random_state)
+        data_iter = self._shuffle(data_iter, random_state)
+        skip_examples = 0
+        if self.epoch == self.resume_epoch:
+            # The DataLoader workers are consumed round-robin.
+            skip_examples = self.skip_examples // num_workers
+        for i, data in enumerate(data_iter):
+            if i < skip_examples:
+                continue
+            yield data
@@ -1,4 +1,6 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
+import re
+from bisect import bisect_left
 from copy import deepcopy
 from typing import Any, Dict, List, Literal, Optional, Tuple, Union
 
@@ -6,9 +8,13 @@ import torch
 from torch import Tensor
 from transformers import PreTrainedTokenizerBase, StoppingCriteria
 
+from swift.utils import get_logger
+
 DEFAULT_SYSTEM = 'You are a helpful assistant.'  # qwen system
 History = List[Union[Tuple[str, str], List[str]]]
 
+logger = get_logger()
+
 
 class TemplateType:
     # text-generation
@@ -123,28 +129,137 @@ def _concat_context_list(
         res_context_list.append(context)
 
 
+def _tokenize(tokenizer: PreTrainedTokenizerBase, context: Union[str,
+                                                                 List[str]],
+              **kwargs) -> Union[List[int], List[List[int]]]:
+    return tokenizer(
+        context,
+        return_attention_mask=False,
+        add_special_tokens=False,
+        **kwargs)['input_ids']
+
+
+class TokenCache:
+    """Token ids of the fixed template fragments (prefix, prompt, chat_sep, suffix and default_system).
+
+    The text is split on the added tokens of the tokenizer (e.g. `<|im_start|>`), which the tokenizer
+    never merges with the neighbouring text. The static pieces are looked up in the cache, and the
+    remaining pieces (containing the query/response) are encoded with a single tokenizer call.
+    If splitting changes the token ids of the probe texts, only the whole fragments are cached.
+    """
+    probe_text_list = ['', 'hello', ' hello world ', '\n你好\n', '12345+234=？']
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase,
+                 fragment_list: List[str]) -> None:
+        self.tokenizer = tokenizer
+        self.token_ids: Dict[str, List[int]] = {}
+        self.split_pattern = _get_split_pattern(tokenizer, fragment_list)
+        if self.split_pattern is not None and not self._check_split(
+                fragment_list):
+            self.split_pattern = None
+        for fragment in fragment_list:
+            for s in [fragment] + self._split(fragment):
+                if '{{' not in s and s not in self.token_ids:
+                    self.token_ids[s] = _tokenize(tokenizer, s)
+
+    def _split(self, context: str) -> List[str]:
+        if self.split_pattern is None:
+            return [context]
+        return [s for s in self.split_pattern.split(context) if len(s) > 0]
+
+    def _check_split(self, fragment_list: List[str]) -> bool:
+        for fragment in fragment_list:
+            for probe_text in self.probe_text_list:
+                context = fragment.replace('{{QUERY}}', probe_text)
+                context = re.sub(r'{{[A-Z0-9]+}}', '', context)
+                token_list = []
+                for s in self._split(context):
+                    token_list += _tokenize(self.tokenizer, s)
+                if token_list != _tokenize(self.tokenizer, context):
+                    return False
+        return True
+
+    def split(self, context: str) -> List[Union[str, List[int]]]:
+        """Split the context into cached token ids and the text that still needs to be tokenized."""
+        token_list = self.token_ids.get(context)
+        if token_list is not None:
+            return [token_list]
+        return [self.token_ids.get(s, s) for s in self._split(context)]
+
+    def encode(self, context_list: List[str]) -> List[List[int]]:
+        """The uncached texts (deduplicated) are tokenized with a single tokenizer call."""
+        split_list = [self.split(context) for context in context_list]
+        text_list = list(
+            dict.fromkeys(
+                s for sl in split_list for s in sl if isinstance(s, str)))
+        text_token_ids = {}
+        if len(text_list) > 0:
+            text_token_ids = dict(
+                zip(text_list, _tokenize(self.tokenizer, text_list)))
+        res: List[List[int]] = []
+        for sl in split_list:
+            token_list = []
+            for s in sl:
+                token_list += text_token_ids[s] if isinstance(s, str) else s
+            res.append(token_list)
+        return res
+
+
+def _get_split_pattern(tokenizer: PreTrainedTokenizerBase,
+                       fragment_list: List[str]) -> Optional['re.Pattern']:
+    try:
+        added_vocab = tokenizer.get_added_vocab()
+    except (AttributeError, NotImplementedError):
+        return None
+    special_tokens = [
+        token for token in added_vocab.keys()
+        if len(token) > 0 and any(token in fragment
+                                  for fragment in fragment_list)
+    ]
+    if len(special_tokens) == 0:
+        return None
+    special_tokens.sort(key=len, reverse=True)
+    return re.compile(f"({'|'.join(map(re.escape, special_tokens))})")
+
+
+def _convert_token_list(tokenizer: PreTrainedTokenizerBase,
+                        context: List[Union[str, int]]) -> List[int]:
+    token_list = []
+    for c in context:
+        if isinstance(c, str):
+            token = getattr(tokenizer, c)
+            assert token is not None
+        else:
+            token = c
+        token_list.append(token)
+    return token_list
+
+
 def _encode_context_list(
     tokenizer: PreTrainedTokenizerBase,
     context_list: List[Context],
     compute_loss_idx: Optional[List[int]] = None,
+    token_cache: Optional[TokenCache] = None,
+    str_token_list: Optional[List[List[int]]] = None,
     **args,
 ) -> Tuple[List[int], Optional[List[int]], Dict[str, Any]]:
+    """str_token_list: the token ids of the str contexts, if they have been tokenized."""
     input_ids: List[int] = []
     labels: List[int] = []
     kwargs = {}
     if compute_loss_idx is not None:
         compute_loss_idx = set(compute_loss_idx)
+    if str_token_list is None and token_cache is not None:
+        str_token_list = token_cache.encode(
+            [context for context in context_list if isinstance(context, str)])
+    if str_token_list is not None:
+        cached_token_iter = iter(str_token_list)
     for i, context in enumerate(context_list):
         if isinstance(context, list):
-            for c in context:
-                if isinstance(c, str):
-                    token = getattr(tokenizer, c)
-                    assert token is not None
-                else:
-                    token = c
-                input_ids.append(token)
-                labels.append(-100)
-        elif isinstance(context, str):
+            token_list = _convert_token_list(tokenizer, context)
+        elif str_token_list is not None:
+            token_list = next(cached_token_iter)
+        else:
             if (getattr(tokenizer, 'model_type', '').startswith('qwen-audio')):
                 audio_info = get_audio_info(tokenizer, context=context)
                 old_audio_info = kwargs.get('audio_info')
@@ -156,28 +271,103 @@ def _encode_context_list(
                             [old_audio_info[k], audio_info[k]], dim=0)
                     for k in ['audio_span_tokens', 'audio_urls']:
                         old_audio_info[k] = old_audio_info[k] + audio_info[k]
-
-            token_list = tokenizer(
-                context,
-                return_attention_mask=False,
-                add_special_tokens=False,
-                **kwargs)['input_ids']
-            input_ids += token_list
-            if compute_loss_idx is None:
-                continue
-            if i in compute_loss_idx:
-                labels += token_list
-            else:
-                labels += [-100] * len(token_list)
+            token_list = _tokenize(tokenizer, context, **kwargs)
+        input_ids += token_list
+        if compute_loss_idx is not None and i in compute_loss_idx:
+            labels += token_list
+        else:
+            labels += [-100] * len(token_list)
     if compute_loss_idx is None:
         return input_ids, None, kwargs
     else:
         return input_ids, labels, kwargs
 
 
-def _encode(template: 'Template', query: str, response: Optional[str],
-            history: History, system: Optional[str],
-            truncation_strategy: str) -> Dict[str, Optional[List[int]]]:
+RenderedContext = Tuple[Union[str, List[int]], Union[List[Tuple[int, int]],
+                                                     bool]]
+
+
+def _render_context_list(tokenizer: PreTrainedTokenizerBase,
+                         context_list: List[Context],
+                         compute_loss_idx: List[int]) -> List[RenderedContext]:
+    """The adjacent str contexts are concatenated into one text.
+
+    Returns: The list of (text, loss_spans) and (token_list, compute_loss).
+        loss_spans: the char spans of the text that compute the loss.
+    """
+    compute_loss_idx = set(compute_loss_idx)
+    res: List[RenderedContext] = []
+    text: Optional[str] = None
+    loss_spans: List[Tuple[int, int]] = []
+    for i, context in enumerate(context_list):
+        if isinstance(context, list):
+            if text is not None:
+                res.append((text, loss_spans))
+                text, loss_spans = None, []
+            res.append((_convert_token_list(tokenizer, context), i
+                        in compute_loss_idx))
+            continue
+        if text is None:
+            text = ''
+        if i in compute_loss_idx and len(context) > 0:
+            start = len(text)
+            if len(loss_spans) > 0 and loss_spans[-1][1] == start:
+                start = loss_spans.pop()[0]
+            loss_spans.append((start, len(text) + len(context)))
+        text += context
+    if text is not None:
+        res.append((text, loss_spans))
+    return res
+
+
+def _encode_context_list_single_pass(
+    tokenizer: PreTrainedTokenizerBase,
+    pre_encode_list: List[Tuple[List[Context], List[int]]],
+) -> List[Tuple[List[int], List[int]]]:
+    """Each text is tokenized in one piece (the texts of all the samples share a tokenizer call),
+    and the labels are derived from the offset mapping: a token computes the loss
+    if its start char is in the loss_spans (the start chars are non-decreasing)."""
+    rendered_list = [
+        _render_context_list(tokenizer, context_list, compute_loss_idx)
+        for context_list, compute_loss_idx in pre_encode_list
+    ]
+    text_list = [
+        context for rendered in rendered_list for context, _ in rendered
+        if isinstance(context, str)
+    ]
+    encoding_iter = iter([])
+    if len(text_list) > 0:
+        encoding = tokenizer(
+            text_list,
+            return_attention_mask=False,
+            add_special_tokens=False,
+            return_offsets_mapping=True)
+        encoding_iter = zip(encoding['input_ids'], encoding['offset_mapping'])
+    res = []
+    for rendered in rendered_list:
+        input_ids: List[int] = []
+        labels: List[int] = []
+        for context, loss in rendered:
+            if isinstance(context, str):
+                token_list, offset_mapping = next(encoding_iter)
+                input_ids += token_list
+                token_labels = [-100] * len(token_list)
+                start_list = [offset[0] for offset in offset_mapping]
+                for start, end in loss:
+                    i, j = bisect_left(start_list,
+                                       start), bisect_left(start_list, end)
+                    token_labels[i:j] = token_list[i:j]
+                labels += token_labels
+            else:
+                input_ids += context
+                labels += context if loss else [-100] * len(context)
+        res.append((input_ids, labels))
+    return res
+
+
+def _pre_encode(template: 'Template', query: str, response: Optional[str],
+                history: History,
+                system: Optional[str]) -> Tuple[List[Context], List[int]]:
     res_context_list: List[Context] = []
     compute_loss_idx: List[int] = []
     if system is None:
@@ -203,19 +393,17 @@ def _encode(template: 'Template', query: str, response: Optional[str],
         round0=len(history))
     res_context_list, compute_loss_idx = _simplify_context_list(
         res_context_list, compute_loss_idx)
-    input_ids, labels, kwargs = _encode_context_list(template.tokenizer,
-                                                     res_context_list,
-                                                     compute_loss_idx)
-
     if response is not None:
-        tgt_input_ids = _encode_context_list(template.tokenizer, [response])[0]
-        tgt_input_ids += _encode_context_list(template.tokenizer,
-                                              template.suffix)[0]
-        labels = labels + tgt_input_ids
-        input_ids += tgt_input_ids
-    else:
-        labels = None
+        # The response and the suffix are tokenized separately and compute the loss.
+        tgt_idx = len(res_context_list)
+        res_context_list += [response, *template.suffix]
+        compute_loss_idx += list(range(tgt_idx, len(res_context_list)))
+    return res_context_list, compute_loss_idx
 
+
+def _post_encode(template: 'Template', input_ids: List[int],
+                 labels: Optional[List[int]], kwargs: Dict[str, Any],
+                 truncation_strategy: str) -> Dict[str, Optional[List[int]]]:
     if template.max_length is not None:
         if truncation_strategy == 'delete' and len(
                 input_ids) > template.max_length:
@@ -230,7 +418,155 @@ def _encode(template: 'Template', query: str, response: Optional[str],
     return res
 
 
+def _encode(template: 'Template', query: str, response: Optional[str],
+            history: History, system: Optional[str],
+            truncation_strategy: str) -> Dict[str, Optional[List[int]]]:
+    if template.encode_strategy == 'single_pass':
+        return _encode_batch(template, [(query, response, history, system)],
+                             truncation_strategy)[0]
+    res_context_list, compute_loss_idx = _pre_encode(template, query, response,
+                                                     history, system)
+    input_ids, labels, kwargs = _encode_context_list(template.tokenizer,
+                                                     res_context_list,
+                                                     compute_loss_idx,
+                                                     template.token_cache)
+    if response is None:
+        labels = None
+    return _post_encode(template, input_ids, labels, kwargs,
+                        truncation_strategy)
+
+
+def _encode_batch(
+        template: 'Template',
+        example_list: List[Tuple[str, Optional[str], History, Optional[str]]],
+        truncation_strategy: str) -> List[Dict[str, Optional[List[int]]]]:
+    """The str contexts of all the examples are tokenized with a single tokenizer call,
+    and then the input_ids/labels of each example are rebuilt."""
+    pre_encode_list = [
+        _pre_encode(template, *example) for example in example_list
+    ]
+    if template.encode_strategy == 'single_pass':
+        encoded_list = [
+            (input_ids, labels, {})
+            for input_ids, labels in _encode_context_list_single_pass(
+                template.tokenizer, pre_encode_list)
+        ]
+    else:
+        context_list = [
+            context for res_context_list, _ in pre_encode_list
+            for context in res_context_list if isinstance(context, str)
+        ]
+        token_list_iter = iter(template.token_cache.encode(context_list))
+        encoded_list = []
+        for res_context_list, compute_loss_idx in pre_encode_list:
+            str_token_list = [
+                next(token_list_iter) for context in res_context_list
+                if isinstance(context, str)
+            ]
+            encoded_list.append(
+                _encode_context_list(
+                    template.tokenizer,
+                    res_context_list,
+                    compute_loss_idx,
+                    str_token_list=str_token_list))
+    res = []
+    for (input_ids, labels, kwargs), example in zip(encoded_list,
+                                                    example_list):
+        if example[1] is None:
+            labels = None
+        res.append(
+            _post_encode(template, input_ids, labels, kwargs,
+                         truncation_strategy))
+    return res
+
+
+def check_encode_strategy(
+        template: 'Template', example_list: List[Dict[str,
+                                                      Any]]) -> Dict[str, Any]:
+    """Compare the results of encode_strategy 'single_pass' with 'context' (the reference).
+
+    Returns: The number of examples whose input_ids/labels are different,
+        and the index of the first mismatched example (-1 means no mismatch).
+    """
+    encode_strategy = template.encode_strategy
+    res_list = []
+    try:
+        for strategy in ['context', 'single_pass']:
+            template.encode_strategy = strategy
+            res_list.append(template.encode_batch(example_list))
+    finally:
+        template.encode_strategy = encode_strategy
+    num_input_ids_mismatch, num_labels_mismatch = 0, 0
+    first_mismatch_idx = -1
+    for i, (r1, r2) in enumerate(zip(*res_list)):
+        if r1 is None or r2 is None:
+            mismatch = (r1 is None) != (r2 is None)
+            num_input_ids_mismatch += mismatch
+        else:
+            mismatch = r1['input_ids'] != r2['input_ids']
+            num_input_ids_mismatch += mismatch
+            if not mismatch and r1['labels'] != r2['labels']:
+                mismatch = True
+                num_labels_mismatch += 1
+        if mismatch and first_mismatch_idx == -1:
+            first_mismatch_idx = i
+    return {
+        'num_examples': len(example_list),
+        'num_input_ids_mismatch': num_input_ids_mismatch,
+        'num_labels_mismatch': num_labels_mismatch,
+        'first_mismatch_idx': first_mismatch_idx
+    }
+
+
+class _AhoCorasick:
+    """Match several patterns at once over a text fed incrementally.
+
+    The state of a text is an int, so each row of a batch only keeps its state between the steps.
+    """
+
+    def __init__(self, pattern_list: List[str]) -> None:
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.matched: List[bool] = [False]
+        for pattern in pattern_list:
+            state = 0
+            for c in pattern:
+                if c not in self.goto[state]:
+                    self.goto[state][c] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.matched.append(False)
+                state = self.goto[state][c]
+            self.matched[state] = True
+        queue = list(self.goto[0].values())
+        for state in queue:  # BFS
+            for c, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail > 0 and c not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(c, 0)
+                self.matched[next_state] |= self.matched[self.fail[next_state]]
+                queue.append(next_state)
+
+    def feed(self, state: int, text: str) -> Tuple[int, bool]:
+        """Returns the new state, and whether a pattern ends in `text`."""
+        matched = False
+        for c in text:
+            while state > 0 and c not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(c, 0)
+            matched |= self.matched[state]
+        return state, matched
+
+
 class StopWordsCriteria(StoppingCriteria):
+    """The stop words are compiled once: the string stop words into an Aho-Corasick automaton,
+    which is fed with the incrementally decoded text of each row, and the list stop words into token ids.
+    So the cost of each step does not grow with the length of the generated text.
+
+    All the rows of the batch are checked. Once a row meets a stop word, it is marked in `is_done`,
+    and the generation is stopped when all the rows are done.
+    """
 
     def __init__(self, tokenizer: PreTrainedTokenizerBase,
                  stop_words: StopWords, **decode_kwargs) -> None:
@@ -238,30 +574,75 @@ class StopWordsCriteria(StoppingCriteria):
         self.stop_words = stop_words
         self.decode_kwargs = decode_kwargs
         self.start_idx = -1
-
-    def __call__(self, input_ids: Tensor, scores: Tensor) -> bool:
-        if self.start_idx == -1:
-            self.start_idx = len(input_ids[0]) - 1
-        tokenizer = self.tokenizer
-        stop_words = self.stop_words
-        text = tokenizer.decode(input_ids[0, self.start_idx:],
-                                **self.decode_kwargs)
+        self.read_idx = -1
+        str_stop_words = []
+        self.token_stop_words: List[Tensor] = []
         for stop_word in stop_words:
             if isinstance(stop_word, str):
-                if stop_word in text:
-                    return True
+                if len(stop_word) > 0:
+                    str_stop_words.append(stop_word)
             elif isinstance(stop_word, list) and len(stop_word) > 0:
-                res = []
+                token_ids = []
                 for sw in stop_word:
                     if isinstance(sw, str):
                         token = getattr(tokenizer, sw)
                         assert token is not None
                     else:
                         token = sw
-                    res.append(token)
-                if input_ids[0].tolist()[-len(res):] == res:
-                    return True
-        return False
+                    token_ids.append(token)
+                self.token_stop_words.append(torch.tensor(token_ids))
+        self.automaton = None
+        if len(str_stop_words) > 0:
+            self.automaton = _AhoCorasick(str_stop_words)
+        # The states of the rows
+        self.is_done: Optional[Tensor] = None
+        # The length of `input_ids` when the row is done (0: not done),
+        # so that the tokens generated after it (while the other rows are not done) can be removed.
+        self.done_length: Optional[Tensor] = None
+        self.detokenizer_list = []
+        self.automaton_state_list: List[int] = []
+
+    def _init_states(self, input_ids: Tensor) -> None:
+        from .utils import IncrementalDetokenizer
+        self.start_idx = input_ids.shape[1] - 1
+        self.read_idx = self.start_idx
+        batch_size = input_ids.shape[0]
+        self.is_done = torch.zeros(
+            batch_size, dtype=torch.bool, device=input_ids.device)
+        self.done_length = torch.zeros(
+            batch_size, dtype=torch.long, device=input_ids.device)
+        self.detokenizer_list = [
+            IncrementalDetokenizer(self.tokenizer, False, **self.decode_kwargs)
+            for _ in range(batch_size)
+        ]
+        self.automaton_state_list = [0] * batch_size
+
+    def __call__(self, input_ids: Tensor, scores: Tensor) -> bool:
+        if self.start_idx == -1:
+            self._init_states(input_ids)
+        for token_ids in self.token_stop_words:
+            n = len(token_ids)
+            if input_ids.shape[1] >= n:
+                token_ids = token_ids.to(input_ids.device)
+                self.is_done |= (input_ids[:, -n:] == token_ids).all(dim=1)
+        if self.automaton is not None:
+            # Only the new tokens of the rows that are not done are decoded.
+            new_token_ids = input_ids[:, self.read_idx:].tolist()
+            self.read_idx = input_ids.shape[1]
+            is_done = self.is_done.tolist()
+            for i, detokenizer in enumerate(self.detokenizer_list):
+                if is_done[i]:
+                    continue
+                text_len = len(detokenizer.text)
+                detokenizer.add_tokens(new_token_ids[i])
+                state, matched = self.automaton.feed(
+                    self.automaton_state_list[i], detokenizer.text[text_len:])
+                self.automaton_state_list[i] = state
+                if matched:
+                    self.is_done[i] = True
+        self.done_length[self.is_done
+                         & (self.done_length == 0)] = input_ids.shape[1]
+        return bool(self.is_done.all())
 
 
 def _has_system(prefix: Prompt) -> bool:
@@ -294,6 +675,8 @@ class Template:
         self.suffix = suffix
         self.default_system = default_system
         self.use_default_system = True
+        self.token_cache: Optional[TokenCache] = None
+        self.encode_strategy = 'context'
         self._is_init = False
 
     def _init_template(self,
@@ -302,6 +685,8 @@ class Template:
                        max_length: Optional[int] = None,
                        truncation_strategy: Literal[
                            'delete', 'truncation_left'] = 'delete',
+                       encode_strategy: Literal['context',
+                                                'single_pass'] = 'context',
                        **kwargs) -> None:
         assert self._is_init is False
         self._is_init = True
@@ -311,9 +696,41 @@ class Template:
             self.default_system = default_system
         self.max_length = max_length
         self.truncation_strategy = truncation_strategy
-
-    def encode(self, example: Dict[str,
-                                   Any]) -> Dict[str, Optional[List[int]]]:
+        is_qwen_audio = getattr(tokenizer, 'model_type',
+                                '').startswith('qwen-audio')
+        if not is_qwen_audio:
+            # qwen-audio needs the audio_info of each context.
+            self.token_cache = TokenCache(tokenizer, self._get_fragment_list())
+        if encode_strategy == 'single_pass' and (not tokenizer.is_fast
+                                                 or is_qwen_audio):
+            logger.warning(
+                '`encode_strategy: single_pass` requires the offset mapping of a fast tokenizer. '
+                "Setting encode_strategy: 'context'")
+            encode_strategy = 'context'
+        self.encode_strategy = encode_strategy
+
+    def _get_fragment_list(self) -> List[str]:
+        prompt_list = [self.prefix, self.prompt, self.suffix]
+        if self.chat_sep is not None:
+            prompt_list.append(self.chat_sep)
+        if self.prefix_has_system is not None:
+            prefix_has_system = self.prefix_has_system
+            if self.default_system is not None:
+                prefix_has_system = [
+                    p.replace('{{SYSTEM}}', self.default_system) if isinstance(
+                        p, str) else p for p in prefix_has_system
+                ]
+            prompt_list.append(prefix_has_system)
+        fragment_list = []
+        for prompt in prompt_list:
+            for p in prompt:
+                if isinstance(p, str) and p not in fragment_list:
+                    fragment_list.append(p)
+        return fragment_list
+
+    def _preprocess_example(
+        self, example: Dict[str, Any]
+    ) -> Tuple[str, Optional[str], History, Optional[str]]:
         if not self._is_init:
             raise ValueError(
                 'Template has not been initialized, please call init_template(...) first.'
@@ -333,9 +750,27 @@ class Template:
                 system = self.default_system
         else:
             assert self.prefix_has_system is not None, 'not support `system`'
+        return query, response, history, system
+
+    def encode(self, example: Dict[str,
+                                   Any]) -> Dict[str, Optional[List[int]]]:
+        query, response, history, system = self._preprocess_example(example)
         return _encode(self, query, response, history, system,
                        self.truncation_strategy)
 
+    def encode_batch(
+        self, example_list: List[Dict[str, Any]]
+    ) -> List[Dict[str, Optional[List[int]]]]:
+        """The result is the same as `[self.encode(example) for example in example_list]`,
+        but the texts of all the examples are tokenized with a single tokenizer call."""
+        if self.token_cache is None or type(
+                self).encode is not Template.encode:
+            return [self.encode(example) for example in example_list]
+        example_list = [
+            self._preprocess_example(example) for example in example_list
+        ]
+        return _encode_batch(self, example_list, self.truncation_strategy)
+
 
 class CogAgentTemplate(Template):
     LANGUAGE_TOKEN_TYPE = 0
@@ -1,18 +1,25 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
 # Part of the implementation is borrowed from huggingface/transformers.
-import heapq
 import importlib.util
+import inspect
 import logging
 import os
+import pickle
 import shutil
-from copy import deepcopy
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from copy import copy, deepcopy
+from contextlib import contextmanager
 from functools import partial, wraps
-from queue import Empty, Queue
-from tempfile import TemporaryDirectory
+from itertools import chain
+from tempfile import TemporaryDirectory, gettempdir
 from typing import (Any, Callable, Dict, Iterator, List, Optional, Tuple,
                     TypeVar, Union)
 
 import accelerate
+import json
 import multiprocess
 import numpy as np
 import requests
@@ -26,10 +33,10 @@ from datasets import Dataset as HfDataset
 from modelscope import MsDataset
 from modelscope.utils.config_ds import MS_CACHE_HOME
 from modelscope.utils.logger import get_logger as get_ms_logger
+from torch import Tensor
 from torch import device as Device
 from torch.nn import Linear, Module
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset
 from tqdm.auto import tqdm
 from transformers import (GenerationConfig, PreTrainedModel,
@@ -37,8 +44,9 @@ from transformers import (GenerationConfig, PreTrainedModel,
                           TextStreamer, trainer)
 
 from swift.hub import ModelScopeConfig
-from swift.utils import (get_dist_setting, get_logger, is_ddp_plus_mp, is_dist,
-                         is_local_master, is_master, stat_array, upper_bound)
+from swift.utils import (get_dataset_lengths, get_dist_setting, get_logger,
+                         is_ddp_plus_mp, is_dist, is_local_master, is_master,
+                         stat_array, upper_bound)
 from .template import (History, StopWords, StopWordsCriteria, Template,
                        get_audio_info)
 
@@ -57,6 +65,9 @@ else:
     ms_logger.setLevel(logging.ERROR)
 
 os.environ['TOKENIZERS_PARALLELISM'] = 'true'
+# The thread pool of the fast tokenizer cannot be used in the forked process (deadlock).
+os.register_at_fork(
+    after_in_child=lambda: os.environ.update(TOKENIZERS_PARALLELISM='false'))
 
 
 def download_files(url: str, local_path: str, cookies) -> None:
@@ -90,17 +101,35 @@ def download_dataset(model_id: str,
 
 
 _old_msdataset_load = MsDataset.load
+_msdataset_ddp_barrier = True
+
+
+@contextmanager
+def _disable_msdataset_ddp_barrier() -> Iterator[None]:
+    """Used when only the local master loads the dataset."""
+    global _msdataset_ddp_barrier
+    _msdataset_ddp_barrier = False
+    try:
+        yield
+    finally:
+        _msdataset_ddp_barrier = True
+
+
+def _use_msdataset_ddp_barrier() -> bool:
+    """Whether `MsDataset.load` synchronizes the ranks with `dist.barrier()`."""
+    return is_dist() and _msdataset_ddp_barrier
 
 
 @wraps(_old_msdataset_load)
 def _msdataset_ddp_load(*args, **kwargs):
-    if is_dist() and not is_local_master():
+    ddp_barrier = _use_msdataset_ddp_barrier()
+    if ddp_barrier and not is_local_master():
         dist.barrier()
     dataset = _old_msdataset_load(*args, **kwargs)
-    if is_dist() and is_local_master():
+    if ddp_barrier and is_local_master():
         dist.barrier()
 
-    if is_dist():
+    if ddp_barrier:
         dist.barrier()
     return dataset
 
@@ -162,38 +191,303 @@ def _infer_auto_device_map_patch(
 
 
 class LLMDataset(Dataset):
+    """The input_ids/labels of all the examples are stored in flat int32 buffers with offsets.
+
+    `__getitem__` returns zero-copy numpy views, and `select` only creates an index view.
+    """
 
     def __init__(self, data: List[Dict[str, Any]]) -> None:
-        self.data = data
+        self._init_columnar(_to_columnar(data))
+
+    @classmethod
+    def from_columnar(cls, columnar: Dict[str, Any]) -> 'LLMDataset':
+        llm_dataset = cls.__new__(cls)
+        llm_dataset._init_columnar(columnar)
+        return llm_dataset
+
+    def _init_columnar(self, columnar: Dict[str, Any]) -> None:
+        self.input_ids, input_ids_lengths = columnar['input_ids']
+        self.labels, labels_lengths = columnar['labels']
+        self.input_ids_offsets = _get_offsets(input_ids_lengths)
+        self.labels_offsets = _get_offsets(labels_lengths)
+        self.has_labels = labels_lengths >= 0
+        self.extra: Optional[List[Dict[str, Any]]] = columnar.get(
+            'extra')  # e.g. audio_info
+        self.idx: Optional[np.ndarray] = None
+        # The examples of the i-th source (dataset) are in [source_offsets[i], source_offsets[i + 1]).
+        self.source_offsets: Optional[np.ndarray] = None
+        # The sampling probabilities of the sources (see `WeightedSourceSampler`).
+        self.source_probs: Optional[List[float]] = None
 
     def __getitem__(self, idx: Union[int, str]) -> Dict[str, Any]:
-        if isinstance(idx, int):
-            return self.data[idx]
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError(f'idx: {idx}')
+            if self.idx is not None:
+                idx = self.idx[idx]
+            start, end = self.input_ids_offsets[idx:idx + 2]
+            input_ids = self.input_ids[start:end]
+            labels = None
+            if self.has_labels[idx]:
+                start, end = self.labels_offsets[idx:idx + 2]
+                labels = self.labels[start:end]
+            res = {'input_ids': input_ids, 'labels': labels}
+            if self.extra is not None:
+                res.update(self.extra[idx])
+            return res
         elif isinstance(idx, str):
-            return [d[idx] for d in self.data]
+            res = []
+            for i in range(len(self)):
+                value = self[i][idx]
+                if isinstance(value, np.ndarray):
+                    value = value.tolist()
+                res.append(value)
+            return res
         else:
             raise ValueError(f'idx: {idx}')
 
     def select(self, idx_list: List[int]) -> 'LLMDataset':
-        new_data = np.array(self.data)
-        new_data = new_data[idx_list].tolist()
-        return self.__class__(new_data)
+        idx_list = np.asarray(idx_list, dtype=np.int64)
+        llm_dataset = copy(self)
+        llm_dataset.idx = idx_list if self.idx is None else self.idx[idx_list]
+        return llm_dataset
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """The token lengths of the examples (computed once from the offsets and shared by `select`)."""
+        lengths = getattr(self, '_lengths', None)
+        if lengths is None:
+            lengths = np.diff(self.input_ids_offsets)
+            self._lengths = lengths
+        return lengths if self.idx is None else lengths[self.idx]
+
+    @property
+    def sources(self) -> Optional[np.ndarray]:
+        """The source index of the examples."""
+        if self.source_offsets is None:
+            return None
+        sources = np.repeat(
+            np.arange(len(self.source_offsets) - 1),
+            np.diff(self.source_offsets))
+        return sources if self.idx is None else sources[self.idx]
+
+    def __len__(self) -> int:
+        if self.idx is not None:
+            return len(self.idx)
+        return len(self.has_labels)
+
+    _ARRAY_NAMES = [
+        'input_ids', 'labels', 'input_ids_offsets', 'labels_offsets',
+        'has_labels', 'idx', 'source_offsets'
+    ]
+    _EXTRA_FNAME = 'extra.pkl'
+
+    def save(self, dir_path: str) -> None:
+        os.makedirs(dir_path, exist_ok=True)
+        for k in self._ARRAY_NAMES:
+            v = getattr(self, k)
+            if v is not None:
+                np.save(os.path.join(dir_path, f'{k}.npy'), v)
+        if self.extra is not None:
+            with open(os.path.join(dir_path, self._EXTRA_FNAME), 'wb') as f:
+                pickle.dump(self.extra, f)
+
+    @classmethod
+    def load(cls,
+             dir_path: str,
+             mmap_mode: Optional[str] = 'r') -> 'LLMDataset':
+        """mmap_mode: 'r' means that the buffers are memory-mapped (read-only) instead of being copied."""
+        llm_dataset = cls.__new__(cls)
+        for k in cls._ARRAY_NAMES:
+            path = os.path.join(dir_path, f'{k}.npy')
+            v = None
+            if os.path.exists(path):
+                v = np.load(path, mmap_mode=mmap_mode)
+                if isinstance(v, np.memmap):
+                    v = np.asarray(v)  # zero-copy
+            setattr(llm_dataset, k, v)
+        llm_dataset.source_probs = None
+        llm_dataset.extra = None
+        extra_path = os.path.join(dir_path, cls._EXTRA_FNAME)
+        if os.path.exists(extra_path):
+            with open(extra_path, 'rb') as f:
+                llm_dataset.extra = pickle.load(f)
+        return llm_dataset
+
+
+def _get_columnar(dataset: LLMDataset) -> Dict[str, Any]:
+    """The inverse of `LLMDataset.from_columnar` (zero-copy)."""
+    assert dataset.idx is None
+    labels_lengths = np.where(dataset.has_labels,
+                              np.diff(dataset.labels_offsets), -1)
+    columnar = {
+        'input_ids': (dataset.input_ids, dataset.lengths),
+        'labels': (dataset.labels, labels_lengths)
+    }
+    if dataset.extra is not None:
+        columnar['extra'] = dataset.extra
+    return columnar
+
+
+def concat_llm_datasets(
+        dataset_list: List[Optional[LLMDataset]]) -> LLMDataset:
+    """Concatenate the datasets (e.g. the datasets encoded separately),
+    and record the source of each example in `source_offsets`."""
+    columnar_list = [
+        _to_columnar([]) if dataset is None else _get_columnar(dataset)
+        for dataset in dataset_list
+    ]
+    llm_dataset = LLMDataset.from_columnar(_concat_columnar(columnar_list))
+    llm_dataset.source_offsets = _get_offsets(
+        np.array([len(columnar['input_ids'][1]) for columnar in columnar_list],
+                 dtype=np.int64))
+    return llm_dataset
+
+
+class PackedLLMDataset(Dataset):
+    """Each item is the concatenation of several examples (a pack) of `dataset`,
+    with `position_ids` restarting from 0 at the start of every example.
+
+    Only the example indices of the packs are stored, and the examples are concatenated in `__getitem__`.
+    """
+
+    def __init__(self, dataset: Dataset, pack_list: List[List[int]],
+                 lengths: np.ndarray) -> None:
+        self.dataset = dataset
+        pack_lengths = np.array([len(pack) for pack in pack_list],
+                                dtype=np.int64)
+        self.pack_offsets = _get_offsets(pack_lengths)
+        self.pack_idx = np.fromiter(
+            chain.from_iterable(pack_list),
+            dtype=np.int64,
+            count=self.pack_offsets[-1])
+        self.example_lengths = lengths
+        self.idx: Optional[np.ndarray] = None
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f'idx: {idx}')
+        if self.idx is not None:
+            idx = self.idx[idx]
+        start, end = self.pack_offsets[idx:idx + 2]
+        input_ids, labels, position_ids = [], [], []
+        for i in self.pack_idx[start:end].tolist():
+            d = self.dataset[i]
+            example_len = len(d['input_ids'])
+            input_ids.append(np.asarray(d['input_ids'], dtype=np.int64))
+            if d.get('labels') is None:
+                example_labels = np.full(example_len, -100, dtype=np.int64)
+            else:
+                example_labels = np.array(d['labels'], dtype=np.int64)
+            # Not predicted from the previous example, same as without packing.
+            example_labels[0] = -100
+            labels.append(example_labels)
+            position_ids.append(np.arange(example_len, dtype=np.int64))
+        return {
+            'input_ids': np.concatenate(input_ids),
+            'labels': np.concatenate(labels),
+            'position_ids': np.concatenate(position_ids)
+        }
+
+    def select(self, idx_list: List[int]) -> 'PackedLLMDataset':
+        idx_list = np.asarray(idx_list, dtype=np.int64)
+        packed_dataset = copy(self)
+        packed_dataset.idx = idx_list if self.idx is None else self.idx[
+            idx_list]
+        return packed_dataset
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """The token lengths of the packs."""
+        lengths = np.add.reduceat(self.example_lengths[self.pack_idx],
+                                  self.pack_offsets[:-1])
+        return lengths if self.idx is None else lengths[self.idx]
 
     def __len__(self) -> int:
-        return len(self.data)
+        if self.idx is not None:
+            return len(self.idx)
+        return len(self.pack_offsets) - 1
+
+
+def _first_fit_decreasing(lengths: np.ndarray,
+                          capacity: int) -> List[List[int]]:
+    """Pack the items into bins of `capacity` with the First-Fit-Decreasing algorithm.
+
+    A segment tree of the remaining capacity of the bins is used to find the first bin
+    that fits in O(log(num_bins)).
+    """
+    n = len(lengths)
+    size = 1
+    while size < n:
+        size *= 2
+    # tree[size + i]: The remaining capacity of the i-th bin (unopened bins: capacity).
+    tree = [capacity] * (2 * size)
+    pack_list: List[List[int]] = []
+    for i in np.argsort(-lengths, kind='stable').tolist():
+        length = int(lengths[i])
+        node = 1
+        while node < size:
+            node = 2 * node if tree[2 * node] >= length else 2 * node + 1
+        bin_idx = node - size
+        if bin_idx == len(pack_list):
+            pack_list.append([])
+        pack_list[bin_idx].append(i)
+        tree[node] -= length
+        node //= 2
+        while node >= 1:
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+            node //= 2
+    return pack_list
+
+
+def pack_dataset(dataset: Dataset, max_length: int) -> PackedLLMDataset:
+    """Pack the encoded examples into sequences of at most `max_length` tokens (First-Fit-Decreasing)."""
+    lengths = get_dataset_lengths(dataset)
+    if lengths is None:
+        raise ValueError(
+            f'The lengths of the dataset are not precomputed: {dataset.__class__.__name__}'
+        )
+    too_long = int((lengths > max_length).sum())
+    if too_long > 0:
+        raise ValueError(
+            f'{too_long} examples are longer than max_length: {max_length}.')
+    pack_list = _first_fit_decreasing(lengths, max_length)
+    packed_dataset = PackedLLMDataset(dataset, pack_list, lengths)
+    efficiency = lengths.sum() / max(len(pack_list) * max_length, 1)
+    logger.info(f'Packing {len(dataset)} examples into {len(pack_list)} '
+                f'sequences, packing efficiency: {efficiency:.4f}')
+    return packed_dataset
 
 
 class LazyLLMDataset(Dataset):
+    """Encode the examples in `__getitem__`.
+
+    If an example fails to be encoded (e.g. `truncation_strategy='delete'`), a random example is tried instead.
+    The failed indices are remembered, so they are not encoded again.
+    cache_size: The number of the encoded examples kept in an LRU cache (0: no cache), which is reused across
+        the epochs as long as the DataLoader workers are persistent.
+    """
 
     def __init__(self,
                  dataset: HfDataset,
                  template: Template,
                  *,
-                 try_fetch_time: int = 20) -> None:
+                 try_fetch_time: int = 20,
+                 cache_size: int = 0) -> None:
         self.dataset = dataset
         self.template = template
         self.try_fetch_time = min(try_fetch_time, len(self.dataset))
         assert self.try_fetch_time >= 1
+        self.cache_size = cache_size
+        self._cache: Dict[int, Dict[str, Any]] = OrderedDict()
+        self._failed_idx = set()
+        # see LLMDataset
+        self.sources: Optional[np.ndarray] = None
+        self.source_probs: Optional[List[float]] = None
 
     def __getitem__(self, idx: int) -> Dict[str, Any]:
         res = self._try_fetch(idx)
@@ -201,11 +495,30 @@ class LazyLLMDataset(Dataset):
             return res
         raise ValueError('Please check if the max_length is appropriate.')
 
+    def _encode(self, idx: int) -> Optional[Dict[str, Any]]:
+        if idx in self._failed_idx:
+            return None
+        res = self._cache.get(idx)
+        if res is not None:
+            self._cache.move_to_end(idx)
+            return res
+        res = self.template.encode(self.dataset[idx])
+        if res is None:
+            self._failed_idx.add(idx)
+            return None
+        if self.cache_size > 0:
+            self._cache[idx] = res
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return res
+
     def _try_fetch(self, first_idx: int) -> Optional[Dict[str, Any]]:
-        idx = np.random.permutation(len(self))[:self.try_fetch_time - 1]
-        for i in [first_idx] + idx.tolist():
-            data = self.dataset[i]
-            res = self.template.encode(data)
+        res = self._encode(first_idx)
+        if res is not None:
+            return res
+        # O(1) per candidate, instead of permuting all the indices.
+        for _ in range(self.try_fetch_time - 1):
+            res = self._encode(np.random.randint(len(self)))
             if res is not None:
                 return res
 
@@ -214,11 +527,10 @@ class LazyLLMDataset(Dataset):
 
 
 MapFunc = Callable[[Dict[str, Any]], Dict[str, Any]]
+BatchMapFunc = Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]
 
 
-def _single_map(d: Dict[str, Any],
-                map_func: MapFunc) -> Optional[Dict[str, Any]]:
-    d = map_func(d)
+def _postprocess_map(d: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
     if d is None or d.get('input_ids') is None:
         return None
     audio_info = d.get('audio_info')
@@ -227,116 +539,575 @@ def _single_map(d: Dict[str, Any],
     return d
 
 
-def _map_mp_single(subset: HfDataset, map_func: MapFunc, queue: Queue,
-                   start_idx: int):
-    for i, d in enumerate(subset, start=start_idx):
-        queue.put((i, map_func(d)))  # idx, result
+def _single_map(d: Dict[str, Any],
+                map_func: MapFunc) -> Optional[Dict[str, Any]]:
+    return _postprocess_map(map_func(d))
+
+
+def _batch_map(d_list: List[Dict[str, Any]],
+               map_func: BatchMapFunc) -> List[Optional[Dict[str, Any]]]:
+    return [_postprocess_map(d) for d in map_func(d_list)]
+
+
+def _map_iter(dataset: HfDataset,
+              map_func: Union[MapFunc, BatchMapFunc],
+              batched: bool = False,
+              batch_size: int = 1000) -> Iterator[Optional[Dict[str, Any]]]:
+    if not batched:
+        for d in dataset:
+            yield _single_map(d, map_func)
+        return
+    d_list = []
+    for d in dataset:
+        d_list.append(d)
+        if len(d_list) == batch_size:
+            yield from _batch_map(d_list, map_func)
+            d_list = []
+    if len(d_list) > 0:
+        yield from _batch_map(d_list, map_func)
+
+
+def _pack_sequences(
+        seq_list: List[Optional[List[int]]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the flat int32 array and the lengths (-1 means None)."""
+    lengths = np.array([-1 if seq is None else len(seq) for seq in seq_list],
+                       dtype=np.int64)
+    flat = np.array(
+        list(chain.from_iterable(seq for seq in seq_list if seq is not None)),
+        dtype=np.int32)
+    return flat, lengths
+
+
+def _get_offsets(lengths: np.ndarray) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(np.maximum(lengths, 0), out=offsets[1:])
+    return offsets
+
+
+def _to_columnar(data: List[Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Convert the encoded examples (None is dropped) into flat int32 arrays and lengths.
+    This is the storage format of LLMDataset, and a shard can be transferred between processes in one piece."""
+    data = [d for d in data if d is not None]
+    res = {}
+    for key in ['input_ids', 'labels']:
+        res[key] = _pack_sequences([d.get(key) for d in data])
+    extra = [{k: v
+              for k, v in d.items() if k not in {'input_ids', 'labels'}}
+             for d in data]
+    if any(len(e) > 0 for e in extra):
+        res['extra'] = extra  # e.g. audio_info
+    return res
 
 
-def _map_mp_i(dataset: HfDataset, map_func: MapFunc,
-              num_proc: int) -> Iterator[Tuple[int, Dict[str, Any]]]:
-    with multiprocess.Pool(
-            num_proc) as pool, multiprocess.Manager() as manager:
-        queue = manager.Queue()
-        async_results = []
-        split_idx = np.linspace(0, len(dataset), num_proc + 1, dtype=np.int32)
-        for i in range(num_proc):
-            subset = dataset.select(range(split_idx[i], split_idx[i + 1]))
-            async_results.append(
-                pool.apply_async(
-                    _map_mp_single,
-                    args=(subset, map_func, queue, split_idx[i])))
-        while True:
-            try:
-                yield queue.get(timeout=0.05)
-            except Empty:
-                if all(async_result.ready()
-                       for async_result in async_results) and queue.empty():
-                    break
+def _concat_columnar(columnar_list: List[Dict[str, Any]]) -> Dict[str, Any]:
+    res = {}
+    for key in ['input_ids', 'labels']:
+        res[key] = tuple(
+            np.concatenate([columnar[key][i] for columnar in columnar_list])
+            for i in range(2))
+    if any('extra' in columnar for columnar in columnar_list):
+        res['extra'] = []
+        for columnar in columnar_list:
+            res['extra'] += columnar.get('extra',
+                                         [{}] * len(columnar['input_ids'][1]))
+    return res
+
+
+def _map_to_columnar(dataset: HfDataset,
+                     map_iter: Callable[[HfDataset], Iterator[Any]],
+                     update_func: Callable[[int], None],
+                     chunk_size: int = 1000) -> Dict[str, Any]:
+    """The results are packed every `chunk_size` examples to reduce the peak memory."""
+    columnar_list = []
+    data = []
+    for d in map_iter(dataset):
+        data.append(d)
+        if len(data) == chunk_size:
+            columnar_list.append(_to_columnar(data))
+            update_func(len(data))
+            data = []
+    columnar_list.append(_to_columnar(data))
+    update_func(len(data))
+    return _concat_columnar(columnar_list)
+
+
+_map_mp_counter: Optional['multiprocess.Value'] = None
+
+
+def _map_mp_init(counter: 'multiprocess.Value') -> None:
+    global _map_mp_counter
+    _map_mp_counter = counter
+
+
+def _map_mp_update(n: int) -> None:
+    with _map_mp_counter.get_lock():
+        _map_mp_counter.value += n
+
 
+def _map_mp_single(
+        subset: HfDataset,
+        map_iter: Callable[[HfDataset], Iterator[Any]]) -> Dict[str, Any]:
+    return _map_to_columnar(subset, map_iter, _map_mp_update)
 
-def _map_mp(dataset: HfDataset, map_func: MapFunc,
-            num_proc: int) -> List[Dict[str, Any]]:
-    # Solving the unordered problem
-    data = [None] * len(dataset)
+
+def _map_mp(dataset: HfDataset, map_iter: Callable[[HfDataset], Iterator[Any]],
+            num_proc: int) -> Dict[str, Any]:
+    """Each worker encodes a contiguous shard and returns it in the columnar format."""
     num_proc = min(num_proc, len(dataset))
-    for d in tqdm(_map_mp_i(dataset, map_func, num_proc), total=len(dataset)):
-        data[d[0]] = d[1]
-    return data
+    split_idx = np.linspace(0, len(dataset), num_proc + 1, dtype=np.int64)
+    counter = multiprocess.Value('q', 0)
+    with multiprocess.Pool(
+            num_proc, initializer=_map_mp_init, initargs=(counter, )) as pool:
+        async_results = [
+            pool.apply_async(
+                _map_mp_single,
+                args=(dataset.select(range(split_idx[i],
+                                           split_idx[i + 1])), map_iter))
+            for i in range(num_proc)
+        ]
+        with tqdm(total=len(dataset)) as prog_bar:
+            while not all(async_result.ready()
+                          for async_result in async_results):
+                time.sleep(0.1)
+                prog_bar.update(counter.value - prog_bar.n)
+            prog_bar.update(len(dataset) - prog_bar.n)
+        columnar_list = [async_result.get() for async_result in async_results]
+    return _concat_columnar(columnar_list)
 
 
 def dataset_map(dataset: HfDataset,
-                map_func: MapFunc,
-                num_proc: int = 1) -> LLMDataset:
-    single_map = partial(_single_map, map_func=map_func)
+                map_func: Union[MapFunc, BatchMapFunc],
+                num_proc: int = 1,
+                *,
+                batched: bool = False,
+                batch_size: int = 1000) -> LLMDataset:
+    """batched: If True, `map_func` receives a list of (at most `batch_size`) examples
+        and returns the list of results, e.g. `template.encode_batch`.
+    """
+    map_iter = partial(
+        _map_iter, map_func=map_func, batched=batched, batch_size=batch_size)
     if num_proc == 1:
-        data = []
-        for d in tqdm(dataset):
-            d = single_map(d)
-            data.append(d)
+        with tqdm(total=len(dataset)) as prog_bar:
+            columnar = _map_to_columnar(dataset, map_iter, prog_bar.update)
     else:
         assert num_proc > 1
-        data = _map_mp(dataset, single_map, num_proc)
-    data = [d for d in data if d is not None]
-    if len(data) == 0:
+        columnar = _map_mp(dataset, map_iter, num_proc)
+    llm_dataset = LLMDataset.from_columnar(columnar)
+    if len(llm_dataset) == 0:
         logger.info('len(dataset): 0')
         return None
-    return LLMDataset(data)
+    return llm_dataset
+
+
+_local_masters_group = None
+
+
+def _get_local_masters_group() -> Optional[dist.ProcessGroup]:
+    """The gloo group of the local masters (on CPU, instead of the GPU memory), called by all the ranks."""
+    global _local_masters_group
+    if _local_masters_group is None:
+        _, _, world_size, local_world_size = get_dist_setting()
+        _local_masters_group = dist.new_group(
+            list(range(0, world_size, local_world_size)), backend='gloo')
+    return _local_masters_group
+
+
+def _get_node_shard_dir_list() -> List[str]:
+    return [
+        f'{shared_dir}-shards' for shared_dir in _get_node_shared_dir_list()
+    ]
+
+
+def _save_shard(shard_dir: str, info: Dict[str, Any],
+                llm_dataset: Optional[LLMDataset]) -> None:
+    if llm_dataset is not None:
+        llm_dataset.save(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(os.path.join(shard_dir, _SHARED_INFO_FNAME), 'w') as f:
+        json.dump(info, f)
+
+
+def _load_shard(shard_dir: str) -> Tuple[Dict[str, Any], Optional[LLMDataset]]:
+    with open(os.path.join(shard_dir, _SHARED_INFO_FNAME), 'r') as f:
+        info = json.load(f)
+    llm_dataset = None
+    if os.path.exists(os.path.join(shard_dir, 'input_ids.npy')):
+        llm_dataset = LLMDataset.load(shard_dir, mmap_mode='r+')
+    return info, llm_dataset
 
 
-def stat_dataset(llm_dataset: Dataset) -> None:
-    """Statistical analysis was performed on the dataset"""
-    _token_len = []
-    if isinstance(llm_dataset, HfDataset):
-        input_ids = llm_dataset['input_ids']
-        for ii in input_ids:
-            _token_len.append(len(ii))
+def _find_shard_dir(rank: int) -> str:
+    shard_dir_list = [
+        os.path.join(d, str(rank)) for d in _get_node_shard_dir_list()
+    ]
+    for shard_dir in shard_dir_list:
+        if os.path.exists(os.path.join(shard_dir, _SHARED_INFO_FNAME)):
+            return shard_dir
+    raise FileNotFoundError(f'The shard is not found: {shard_dir_list}')
+
+
+def _exchange_shards() -> Dict[int, str]:
+    """The local masters broadcast the shards of their nodes to the other local masters.
+    The buffers are sent as tensors (without pickling the tokens) and received into the node-local shared memory.
+
+    Returns: The shard_dir of each rank.
+    """
+    rank, _, world_size, local_world_size = get_dist_setting()
+    group = _get_local_masters_group()
+    shard_dir_dict = {}
+    for src in range(0, world_size, local_world_size):
+        for shard_rank in range(src, src + local_world_size):
+            meta, llm_dataset = None, None
+            if rank == src:
+                shard_dir = _find_shard_dir(shard_rank)
+                info, llm_dataset = _load_shard(shard_dir)
+                meta = {'info': info, 'arrays': {}, 'extra': None}
+                if llm_dataset is not None:
+                    meta['extra'] = llm_dataset.extra
+                    for k in LLMDataset._ARRAY_NAMES:
+                        v = getattr(llm_dataset, k)
+                        if v is not None:
+                            meta['arrays'][k] = (v.shape, v.dtype.str)
+            obj_list = [meta]
+            dist.broadcast_object_list(obj_list, src=src, group=group)
+            meta = obj_list[0]
+            if rank != src:
+                nbytes = sum(
+                    np.prod(shape, dtype=np.int64) * np.dtype(dtype).itemsize
+                    for shape, dtype in meta['arrays'].values())
+                shard_dir = os.path.join(
+                    _select_shared_dir(_get_node_shard_dir_list(), nbytes),
+                    str(shard_rank))
+                shutil.rmtree(shard_dir, ignore_errors=True)
+                os.makedirs(shard_dir)
+            for k, (shape, dtype) in meta['arrays'].items():
+                if rank == src:
+                    array = getattr(llm_dataset, k)
+                else:
+                    array = np.lib.format.open_memmap(
+                        os.path.join(shard_dir, f'{k}.npy'),
+                        'w+',
+                        dtype=np.dtype(dtype),
+                        shape=tuple(shape))
+                if array.size > 0:
+                    # e.g. gloo does not support bool.
+                    dist.broadcast(
+                        torch.from_numpy(array.view(np.uint8)),
+                        src=src,
+                        group=group)
+                if rank != src:
+                    array.flush()
+            if rank != src:
+                if meta['extra'] is not None:
+                    with open(
+                            os.path.join(shard_dir, LLMDataset._EXTRA_FNAME),
+                            'wb') as f:
+                        pickle.dump(meta['extra'], f)
+                _save_shard(shard_dir, meta['info'], None)
+            llm_dataset = None
+            shard_dir_dict[shard_rank] = shard_dir
+    return shard_dir_dict
+
+
+def dataset_map_distributed(dataset: HfDataset,
+                            map_func: Union[MapFunc, BatchMapFunc],
+                            num_proc: int = 1,
+                            *,
+                            batched: bool = False,
+                            batch_size: int = 1000) -> Optional[LLMDataset]:
+    """Each rank maps a contiguous `1/world_size` of the rows with `dataset_map`,
+    and the results are concatenated in the rank order.
+    So the result is the same as `dataset_map(dataset, ...)`, provided that `dataset` is the same on all the ranks.
+
+    Each rank saves its shard to the node-local shared memory (/dev/shm). The local masters exchange the shards
+    of their nodes (see `_exchange_shards`), concatenate them and share the result with the other local ranks
+    through `share_dataset_in_node`. So each node holds about one copy of the encoded dataset,
+    instead of one copy per process.
+
+    If not in DDP, `dataset_map` is returned directly.
+    """
+    if not is_dist():
+        return dataset_map(
+            dataset,
+            map_func,
+            num_proc,
+            batched=batched,
+            batch_size=batch_size)
+    rank, _, world_size, local_world_size = get_dist_setting()
+    start = len(dataset) * rank // world_size
+    end = len(dataset) * (rank + 1) // world_size
+    info, llm_dataset = {}, None
+    try:
+        llm_dataset = dataset_map(
+            dataset.select(range(start, end)),
+            map_func,
+            num_proc,
+            batched=batched,
+            batch_size=batch_size)
+    except Exception as e:
+        # Raised by the local masters, to avoid blocking the other ranks.
+        info['error'] = repr(e)
+    shard_dir_list = _get_node_shard_dir_list()
+    for d in shard_dir_list:
+        shutil.rmtree(os.path.join(d, str(rank)), ignore_errors=True)
+    shard_dir = os.path.join(
+        _select_shared_dir(shard_dir_list, _get_dataset_nbytes([llm_dataset])),
+        str(rank))
+    _save_shard(shard_dir, info, llm_dataset)
+    info = llm_dataset = None  # free the shard
+    if world_size > local_world_size:
+        _get_local_masters_group()
+    dist.barrier()
+
+    def _concat() -> List[Optional[LLMDataset]]:
+        if world_size > local_world_size:
+            shard_dir_dict = _exchange_shards()
+        else:
+            shard_dir_dict = {i: _find_shard_dir(i) for i in range(world_size)}
+        try:
+            columnar_list = []
+            for i in range(world_size):
+                info, llm_dataset = _load_shard(shard_dir_dict[i])
+                if 'error' in info:
+                    raise RuntimeError(
+                        f'The rank {i} failed to map the dataset: {info["error"]}'
+                    )
+                if llm_dataset is not None:
+                    columnar_list.append(_get_columnar(llm_dataset))
+            if len(columnar_list) == 0:
+                logger.info('len(dataset): 0')
+                return [None]
+            return [LLMDataset.from_columnar(_concat_columnar(columnar_list))]
+        finally:
+            # The memory-mapped buffers are still valid after the files are deleted.
+            for d in shard_dir_list:
+                shutil.rmtree(d, ignore_errors=True)
+
+    return share_dataset_in_node(_concat)[0]
+
+
+_SHARED_INFO_FNAME = 'shared_info.json'
+
+
+def _get_node_shared_dir_list() -> List[str]:
+    # All the local ranks are spawned by the same launcher process.
+    dir_name = f"swift-dataset-{os.getppid()}-{os.getenv('MASTER_PORT', '')}"
+    base_dir_list = [gettempdir()]
+    if os.path.isdir('/dev/shm'):
+        base_dir_list.insert(0, '/dev/shm')
+    return [os.path.join(base_dir, dir_name) for base_dir in base_dir_list]
+
+
+def _select_shared_dir(dir_list: List[str], nbytes: int) -> str:
+    for d in dir_list:
+        # The size of /dev/shm is usually limited in docker.
+        if shutil.disk_usage(os.path.dirname(d)).free > nbytes * 1.2:
+            return d
+    return dir_list[-1]
+
+
+def _get_dataset_nbytes(dataset_list: List[Optional[LLMDataset]]) -> int:
+    nbytes = 0
+    for dataset in dataset_list:
+        if dataset is None:
+            continue
+        for k in LLMDataset._ARRAY_NAMES:
+            v = getattr(dataset, k)
+            if v is not None:
+                nbytes += v.nbytes
+    return nbytes
+
+
+def share_dataset_in_node(
+    prepare_func: Callable[[], List[Optional[LLMDataset]]]
+) -> List[Optional[LLMDataset]]:
+    """Only the local master of each node runs `prepare_func` (e.g. loading and tokenizing the dataset),
+    and saves the results to the node-local shared memory (/dev/shm). Then all the local ranks memory-map them,
+    so there is only one copy of the dataset on each node.
+
+    If not in DDP, `prepare_func()` is returned directly.
+    """
+    if not is_dist():
+        return prepare_func()
+    shared_dir_list = _get_node_shared_dir_list()
+    error = None
+    if is_local_master():
+        for shared_dir in shared_dir_list:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+        shared_dir = shared_dir_list[0]
+        info = {}
+        try:
+            with _disable_msdataset_ddp_barrier():
+                dataset_list = prepare_func()
+            nbytes = _get_dataset_nbytes(dataset_list)
+            shared_dir = _select_shared_dir(shared_dir_list, nbytes)
+            for i, dataset in enumerate(dataset_list):
+                if dataset is not None:
+                    dataset.save(os.path.join(shared_dir, str(i)))
+            info['dataset_list_len'] = len(dataset_list)
+            logger.info(f'Saving the shared dataset: {shared_dir}, '
+                        f'nbytes: {nbytes / 1e9:.3f}GB')
+        except Exception as e:
+            # Raised after notifying the other local ranks, to avoid blocking them.
+            error = e
+            info['error'] = repr(e)
+        os.makedirs(shared_dir, exist_ok=True)
+        with open(os.path.join(shared_dir, _SHARED_INFO_FNAME), 'w') as f:
+            json.dump(info, f)
+        dist.barrier()
     else:
-        for d in llm_dataset:
-            _token_len.append(len(d['input_ids']))
-    _, stat_str = stat_array(_token_len)
+        dist.barrier()
+        shared_dir, info = None, {}
+        for d in shared_dir_list:
+            info_path = os.path.join(d, _SHARED_INFO_FNAME)
+            if os.path.exists(info_path):
+                shared_dir = d
+                with open(info_path, 'r') as f:
+                    info = json.load(f)
+                break
+        if shared_dir is None:
+            error = FileNotFoundError(
+                f'The shared dataset is not found: {shared_dir_list}')
+        elif 'error' in info:
+            error = RuntimeError('The local master failed to prepare '
+                                 f"the dataset: {info['error']}")
+    res = []
+    if error is None:
+        for i in range(info['dataset_list_len']):
+            dataset_dir = os.path.join(shared_dir, str(i))
+            dataset = None
+            if os.path.isdir(dataset_dir):
+                dataset = LLMDataset.load(dataset_dir)
+            res.append(dataset)
+    dist.barrier()
+    if is_local_master():
+        # The memory-mapped buffers are still valid after the files are deleted.
+        shutil.rmtree(shared_dir, ignore_errors=True)
+    if error is not None:
+        raise error
+    return res
+
+
+def _get_lengths(llm_dataset: Dataset) -> np.ndarray:
+    lengths = get_dataset_lengths(llm_dataset)
+    if lengths is None:
+        lengths = np.array([len(d['input_ids']) for d in llm_dataset],
+                           dtype=np.int64)
+    return lengths
+
+
+def _get_padding_waste(lengths: np.ndarray, batch_size: int) -> float:
+    """The ratio of the padding tokens when the examples are batched in the order of `lengths`."""
+    starts = np.arange(0, len(lengths), batch_size)
+    batch_lengths = np.maximum.reduceat(lengths, starts)
+    n_examples = np.diff(np.append(starts, len(lengths)))
+    n_padded = int((batch_lengths * n_examples).sum())
+    return 1 - int(lengths.sum()) / max(n_padded, 1)
+
+
+def _get_length_report(lengths: np.ndarray,
+                       batch_size: Optional[int] = None) -> str:
+    p50, p90, p99 = np.percentile(lengths, [50, 90, 99]).tolist()
+    report = f'p50={p50:.0f}, p90={p90:.0f}, p99={p99:.0f}'
+    # histogram with the bins (0, 64], (64, 128], (128, 256], ...
+    max_length = max(int(lengths.max()), 1)
+    bins = [0] + [
+        2**i for i in range(6,
+                            int(np.ceil(np.log2(max(max_length, 64)))) + 1)
+    ]
+    counts = np.histogram(lengths, bins=bins)[0]
+    hist_str = ', '.join(f'<={hi}: {count}'
+                         for hi, count in zip(bins[1:], counts.tolist()))
+    report += f'\nhistogram: {hist_str}'
+    if batch_size is not None and batch_size > 1:
+        random_lengths = lengths[np.random.RandomState(42).permutation(
+            len(lengths))]
+        random_waste = _get_padding_waste(random_lengths, batch_size)
+        sorted_waste = _get_padding_waste(np.sort(lengths), batch_size)
+        report += (
+            f'\npadding waste (batch_size={batch_size}): '
+            f'random: {random_waste:.2%}, sorted by length: {sorted_waste:.2%}'
+        )
+    return report
+
+
+def stat_dataset(llm_dataset: Dataset,
+                 batch_size: Optional[int] = None) -> None:
+    """Statistical analysis was performed on the dataset
+
+    batch_size: If not None, the padding waste of the batches is also reported.
+    """
+    token_len = _get_lengths(llm_dataset)
+    _, stat_str = stat_array(token_len)
     logger.info(f'Dataset Token Length: {stat_str}')
+    logger.info(
+        f'Dataset Token Length: {_get_length_report(token_len, batch_size)}')
 
 
 def data_collate_fn(batch: List[Dict[str, Any]],
                     tokenizer: PreTrainedTokenizerBase,
-                    padding_to: Optional[int] = None) -> Dict[str, Any]:
+                    padding_to: Optional[int] = None,
+                    pad_to_multiple_of: Optional[int] = None,
+                    pin_memory: bool = False) -> Dict[str, Any]:
     """
     Args:
         batch(`List[Dict[str, Any]]`): The input data in batch
         tokenizer(`PreTrainedTokenizerBase`): The tokenizer of the model
         padding_to(`int`, optional): Whether padding the batch to a fixed length, if none, the batch
             will be padded to the `longest`
+        pad_to_multiple_of(`int`, optional): Round the padded length up to a multiple of this value
+            (e.g. 8 or 64 for tensor-core-friendly shapes)
+        pin_memory(`bool`): Whether to allocate the tensors in pinned memory (if cuda is available),
+            so that they can be copied to the device with `non_blocking=True`
     """
     assert tokenizer.pad_token_id is not None
-    input_ids = [torch.tensor(b['input_ids']) for b in batch]
-    labels = [torch.tensor(b['labels']) for b in batch]
-    attention_mask = [
-        torch.ones(len(input_ids[i]), dtype=torch.int64)
-        for i in range(len(input_ids))
-    ]
-
-    if padding_to is not None and padding_to > input_ids[0].shape[-1]:
-        input_ids[0] = F.pad(input_ids[0],
-                             (0, padding_to - input_ids[0].shape[-1]),
-                             'constant', tokenizer.pad_token_id)
-        labels[0] = F.pad(labels[0], (0, padding_to - labels[0].shape[-1]),
-                          'constant', -100)
-        attention_mask[0] = F.pad(
-            attention_mask[0], (0, padding_to - attention_mask[0].shape[-1]),
-            'constant', 0)
-
-    input_ids = pad_sequence(
-        input_ids, batch_first=True, padding_value=tokenizer.pad_token_id)
-    attention_mask = pad_sequence(
-        attention_mask, batch_first=True, padding_value=0)
-    labels = pad_sequence(labels, batch_first=True, padding_value=-100)
+    lengths = [len(b['input_ids']) for b in batch]
+    max_length = max(lengths)
+    if padding_to is not None:
+        max_length = max(max_length, padding_to)
+    # packing: the attention_mask holds the example ids (1, 1, 2, 2, 2, ..., 0 for padding)
+    is_packing = batch[0].get('position_ids') is not None
+    if is_packing and min(lengths) == max_length:
+        # Ensure that flash-attn does not drop the attention_mask.
+        max_length += 1
+    if pad_to_multiple_of is not None:
+        max_length = -(-max_length // pad_to_multiple_of) * pad_to_multiple_of
+    # The padded buffers are allocated once and filled from the examples.
+    shape = (len(batch), max_length)
+    pin_memory = pin_memory and torch.cuda.is_available()
+    input_ids = torch.full(
+        shape,
+        tokenizer.pad_token_id,
+        dtype=torch.int64,
+        pin_memory=pin_memory)
+    labels = torch.full(shape, -100, dtype=torch.int64, pin_memory=pin_memory)
+    attention_mask = torch.zeros(
+        shape, dtype=torch.int64, pin_memory=pin_memory)
+    input_ids_np, labels_np = input_ids.numpy(), labels.numpy()
+    attention_mask_np = attention_mask.numpy()
+    position_ids = None
+    if is_packing:
+        position_ids = torch.zeros(
+            shape, dtype=torch.int64, pin_memory=pin_memory)
+        position_ids_np = position_ids.numpy()
+    for i, (b, length) in enumerate(zip(batch, lengths)):
+        input_ids_np[i, :length] = b['input_ids']
+        if b['labels'] is not None:
+            labels_np[i, :length] = b['labels']
+        if is_packing:
+            position_ids_np[i, :length] = b['position_ids']
+            attention_mask_np[i, :length] = np.cumsum(
+                position_ids_np[i, :length] == 0)
+        else:
+            attention_mask_np[i, :length] = 1
 
     res = {
         'input_ids': input_ids,
         'attention_mask': attention_mask,
         'labels': labels,
     }
+    if position_ids is not None:
+        res['position_ids'] = position_ids
     if batch[0].get('audio_info') is not None:
         res['audio_info'] = [
             get_audio_info(tokenizer, audio_info=b['audio_info'])
@@ -380,6 +1151,10 @@ def _get_labels_str(labels: List[int], tokenizer: PreTrainedTokenizerBase,
 def print_example(example: Dict[str, Any],
                   tokenizer: PreTrainedTokenizerBase) -> None:
     input_ids, labels = example['input_ids'], example.get('labels')
+    if isinstance(input_ids, np.ndarray):
+        input_ids = input_ids.tolist()
+    if isinstance(labels, np.ndarray):
+        labels = labels.tolist()
     logger.info(f'[INPUT_IDS] {input_ids}')
     decode_kwargs = {}
     # Compatible with qwen-audio
@@ -426,9 +1201,8 @@ def find_all_linear_for_lora(model: Module, quantization_bit: int,
 
 def sort_by_max_length(llm_dataset: LLMDataset, num_dataset: int) -> HfDataset:
     logger.info('sort by max length...')
-    dataset_len = [len(d['input_ids']) for d in llm_dataset]
-    idx = heapq.nlargest(
-        num_dataset, range(len(dataset_len)), key=lambda i: dataset_len[i])
+    lengths = _get_lengths(llm_dataset)
+    idx = np.argsort(-lengths, kind='stable')[:num_dataset]
     return llm_dataset.select(idx)
 
 
@@ -447,6 +1221,447 @@ def _is_chinese_char(cp):
     return False
 
 
+class IncrementalDetokenizer:
+    """Decode the generated tokens incrementally, so the cost of each step does not grow with the response length.
+
+    In each step only the tokens from `prefix_offset` are decoded: the tokens in [prefix_offset, read_offset)
+    are the context (e.g. the leading space of a sentencepiece token), and the text of the tokens after
+    `read_offset` is appended once it does not end with an incomplete UTF-8 character ('\ufffd').
+    `safe_text` does not end with an incomplete word (the printing logic of `TextStreamer`).
+    """
+
+    def __init__(self,
+                 tokenizer: PreTrainedTokenizerBase,
+                 skip_special_tokens: bool = True,
+                 **decode_kwargs) -> None:
+        self.tokenizer = tokenizer
+        self.decode_kwargs = {
+            'skip_special_tokens': skip_special_tokens,
+            **decode_kwargs
+        }
+        self.token_ids: List[int] = []
+        self.text = ''
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.print_idx = 0
+        self._prefix_text = ''
+
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, **self.decode_kwargs)
+
+    def add_tokens(self, token_ids: List[int], finished: bool = False) -> str:
+        """finished: If True, the pending tokens are decoded even if the text is incomplete.
+        return: The text decoded so far."""
+        self.token_ids += token_ids
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) > len(self._prefix_text) and (
+                finished or not new_text.endswith('\ufffd')):
+            text_len = len(self.text)
+            delta_text = new_text[len(self._prefix_text):]
+            self.text += delta_text
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            self._prefix_text = self._decode(
+                self.token_ids[self.prefix_offset:self.read_offset])
+            if self.text.endswith('\n') or _is_chinese_char(
+                    ord(self.text[-1])):
+                self.print_idx = len(self.text)
+            else:
+                # Only the new text is searched for the last space.
+                space_idx = delta_text.rfind(' ')
+                if space_idx >= 0:
+                    self.print_idx = max(text_len + space_idx + 1,
+                                         self.print_idx)
+        if finished:
+            self.print_idx = len(self.text)
+        return self.text
+
+    @property
+    def safe_text(self) -> str:
+        # avoid printing incomplete words
+        return self.text[:self.print_idx]
+
+
+def _get_multimodal_kwargs(inputs: Dict[str, Any],
+                           tokenizer: PreTrainedTokenizerBase,
+                           device: Device) -> Dict[str, Any]:
+    """The model kwargs of qwen-audio, cogagent, ..."""
+    model_kwargs = {}
+    if 'audio_info' in inputs:
+        model_kwargs['audio_info'] = get_audio_info(
+            tokenizer, audio_info=inputs['audio_info'])
+    if 'token_type_ids' in inputs:
+        model_kwargs['token_type_ids'] = inputs['token_type_ids'].to(device)
+    for key in ['images', 'cross_images']:
+        if key in inputs:
+            model_kwargs[key] = [[
+                inputs[key][0][0].to(device).to(torch.float16)
+            ]]
+    return model_kwargs
+
+
+PastKeyValues = Tuple[Tuple[Tensor, ...], ...]
+
+# The memory budget (in bytes) of the caches of the KVCacheSessions.
+_kv_cache_max_memory = 4 * 1024**3
+_kv_cache_max_cpu_memory = 0
+# The sessions holding a cache, in LRU order. id(session) -> weakref.ref(session)
+_kv_cache_sessions: 'OrderedDict[int, weakref.ref]' = OrderedDict()
+_kv_cache_lock = threading.Lock()
+
+
+def set_kv_cache_max_memory(max_memory: float,
+                            max_cpu_memory: float = 0.) -> None:
+    """Set the memory budget (GiB) of the caches of all the KVCacheSessions.
+
+    max_memory: The memory on the model's device.
+    max_cpu_memory: The memory of the caches offloaded to the CPU.
+    """
+    global _kv_cache_max_memory, _kv_cache_max_cpu_memory
+    _kv_cache_max_memory = int(max_memory * 1024**3)
+    _kv_cache_max_cpu_memory = int(max_cpu_memory * 1024**3)
+
+
+def _map_kv_cache(func: Callable[[Tensor], Any], past_key_values: Any) -> Any:
+    if isinstance(past_key_values, (tuple, list)):
+        return tuple(_map_kv_cache(func, x) for x in past_key_values)
+    return func(past_key_values)
+
+
+def _get_kv_cache_tensor(past_key_values: Any) -> Optional[Tensor]:
+    """The first tensor of the cache, or None if the format is not supported."""
+    while isinstance(past_key_values, (tuple, list)):
+        if len(past_key_values) == 0:
+            return None
+        past_key_values = past_key_values[0]
+    if isinstance(past_key_values, Tensor):
+        return past_key_values
+    return None
+
+
+def _prefill_kv_cache(
+        model: PreTrainedModel, token_ids: List[int], prefix_len: int,
+        past_key_values: Optional[PastKeyValues]) -> PastKeyValues:
+    """Returns the cache of `token_ids`, where `past_key_values` is the cache of `token_ids[:prefix_len]`.
+    The tensors of `past_key_values` are not modified."""
+    if prefix_len == len(token_ids):
+        return past_key_values
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        outputs = model(
+            input_ids=torch.tensor(token_ids[prefix_len:])[None].to(device),
+            attention_mask=torch.ones((1, len(token_ids)),
+                                      dtype=torch.int64,
+                                      device=device),
+            position_ids=torch.arange(
+                prefix_len, len(token_ids), device=device)[None],
+            past_key_values=past_key_values,
+            use_cache=True)
+    return outputs.past_key_values
+
+
+class KVCacheSession:
+    """Keep the KV cache (`past_key_values`) and the token ids of a conversation across turns,
+    so that a new turn only prefills the new tokens instead of the whole history.
+
+    In each turn, the cache is truncated to the longest common prefix of the cached token ids and the new input_ids
+    (e.g. the old turns were dropped by `limit_history_length`, or the history was edited or cleared),
+    and the remaining tokens are prefilled with one forward pass. The cache is dropped if the model changes.
+    Only the legacy format of the cache (nested tuples of tensors) is supported.
+
+    All the sessions share the memory budget set by `set_kv_cache_max_memory`: when it is exceeded,
+    the caches of the least recently used sessions are offloaded to the CPU (within `max_cpu_memory`) or dropped.
+    """
+
+    def __init__(self) -> None:
+        self.token_ids: List[int] = []
+        self.past_key_values: Optional[PastKeyValues] = None
+        # The dim of the sequence in the cache tensors, which depends on the model.
+        self.seq_dim: Optional[int] = None
+        # The devices of the cache tensors, if the cache is offloaded to the CPU.
+        self.offload_devices: Optional[Tuple[Any, ...]] = None
+        self._model_ref: Optional[weakref.ref] = None
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> 'KVCacheSession':
+        # Compatible with gr.State: a copy starts with an empty cache.
+        return self.__class__()
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = 0
+
+        def _count(tensor: Tensor) -> None:
+            nonlocal nbytes
+            nbytes += tensor.numel() * tensor.element_size()
+
+        if self.past_key_values is not None:
+            _map_kv_cache(_count, self.past_key_values)
+        return nbytes
+
+    def offload(self) -> None:
+        if self.past_key_values is None or self.offload_devices is not None:
+            return
+        self.offload_devices = _map_kv_cache(lambda t: t.device,
+                                             self.past_key_values)
+        self.past_key_values = _map_kv_cache(lambda t: t.cpu(),
+                                             self.past_key_values)
+
+    def _reload(self) -> None:
+        if self.offload_devices is None:
+            return
+        device_list = []
+        _map_kv_cache(device_list.append, self.offload_devices)
+        device_iter = iter(device_list)
+        self.past_key_values = _map_kv_cache(lambda t: t.to(next(device_iter)),
+                                             self.past_key_values)
+        self.offload_devices = None
+
+    def clear(self) -> None:
+        self.token_ids = []
+        self.past_key_values = None
+        self.offload_devices = None
+        with _kv_cache_lock:
+            _kv_cache_sessions.pop(id(self), None)
+
+    def _set_cache(self, token_ids: List[int],
+                   past_key_values: Optional[PastKeyValues]) -> None:
+        tensor = _get_kv_cache_tensor(past_key_values)
+        if tensor is None:
+            self.clear()
+            return
+        if self.seq_dim is None:
+            seq_dims = [
+                i for i, size in enumerate(tensor.shape)
+                if size == len(token_ids)
+            ]
+            if len(seq_dims) == 1:
+                self.seq_dim = seq_dims[0]
+        elif tensor.shape[self.seq_dim] != len(token_ids):
+            self.clear()
+            return
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        with _kv_cache_lock:
+            _kv_cache_sessions[id(self)] = weakref.ref(self)
+            _kv_cache_sessions.move_to_end(id(self))
+            _evict_kv_cache_sessions()
+
+    def _truncate(self, length: int) -> None:
+        if length == len(self.token_ids):
+            return
+        if length == 0 or self.seq_dim is None:
+            self.clear()
+            return
+        seq_dim = self.seq_dim
+        self.past_key_values = _map_kv_cache(
+            lambda t: t.narrow(seq_dim, 0, length).contiguous(),
+            self.past_key_values)
+        self.token_ids = self.token_ids[:length]
+
+    def prefill(
+        self,
+        model: PreTrainedModel,
+        input_ids: List[int],
+        prefix: Optional[Tuple[List[int], PastKeyValues]] = None
+    ) -> Optional[PastKeyValues]:
+        """Returns the cache of `input_ids[:-1]`, which can be passed to `model.generate` with `input_ids`.
+
+        prefix: The token ids (a prefix of `input_ids[:-1]`) and the cache to start from,
+            if it is longer than the reused part of the session (see `PrefixKVCache`).
+        """
+        if self._model_ref is None or self._model_ref() is not model:
+            self.clear()
+            self._model_ref = weakref.ref(model)
+            self.seq_dim = None
+        with _kv_cache_lock:
+            self._reload()
+        prefix_len = 0
+        max_len = min(len(self.token_ids), len(input_ids) - 1)
+        while prefix_len < max_len and self.token_ids[prefix_len] == input_ids[
+                prefix_len]:
+            prefix_len += 1
+        self._truncate(prefix_len)
+        if prefix is not None and len(prefix[0]) > len(self.token_ids):
+            self.token_ids, self.past_key_values = prefix
+        prefix_len = len(self.token_ids)
+        if prefix_len == len(input_ids) - 1:
+            if prefix_len > 0:
+                self._set_cache(self.token_ids, self.past_key_values)
+            return self.past_key_values
+        past_key_values = _prefill_kv_cache(model, input_ids[:-1], prefix_len,
+                                            self.past_key_values)
+        self._set_cache(input_ids[:-1], past_key_values)
+        return self.past_key_values
+
+    def update(self, token_ids: List[int],
+               past_key_values: Optional[PastKeyValues]) -> None:
+        """Keep the cache returned by `model.generate`, which covers `token_ids`."""
+        if past_key_values is not None:
+            self._set_cache(token_ids, past_key_values)
+
+
+def _evict_kv_cache_sessions() -> None:
+    """LRU, except the session in use (the last one). Call with `_kv_cache_lock` held."""
+    session_list = []
+    for session_id, session_ref in list(_kv_cache_sessions.items()):
+        session = session_ref()
+        if session is None or session.past_key_values is None:
+            _kv_cache_sessions.pop(session_id)
+        else:
+            session_list.append(session)
+    memory, cpu_memory = 0, 0
+    for session in session_list:
+        if session.offload_devices is None:
+            memory += session.nbytes
+        else:
+            cpu_memory += session.nbytes
+    for session in session_list[:-1]:
+        if memory <= _kv_cache_max_memory:
+            break
+        if session.offload_devices is not None:
+            continue
+        nbytes = session.nbytes
+        memory -= nbytes
+        if cpu_memory + nbytes <= _kv_cache_max_cpu_memory:
+            session.offload()
+            cpu_memory += nbytes
+        else:
+            session.token_ids = []
+            session.past_key_values = None
+            _kv_cache_sessions.pop(id(session))
+    for session in session_list[:-1]:
+        if cpu_memory <= _kv_cache_max_cpu_memory:
+            break
+        if session.offload_devices is None or session.past_key_values is None:
+            continue
+        cpu_memory -= session.nbytes
+        session.token_ids = []
+        session.past_key_values = None
+        session.offload_devices = None
+        _kv_cache_sessions.pop(id(session))
+
+
+class PrefixKVCache:
+    """The KV caches of the shared prompt prefixes (the template prefix with the system,
+    and the fixed part of the prompt before the query), so that a request only prefills the tokens after the prefix.
+
+    The prefix of a system is the longest common prefix of the token ids of several probe queries.
+    The caches are kept in an LRU keyed by the hash of the prefix token ids, the pinned ones (e.g. the default system,
+    see `prepare_model_template`) are not evicted. The model concatenates the new keys and values into new tensors,
+    so the requests can start from the same cache without copying it.
+    """
+    probe_query_list = ['', 'hello', ' hello world ', '\n你好\n', '12345+234=？']
+
+    def __init__(self, max_size: int = 4) -> None:
+        self.max_size = max_size
+        # (id(template), system) -> prefix token ids
+        self.prefix_token_ids = OrderedDict()
+        # hash(prefix token ids) -> (prefix token ids, past_key_values)
+        self.cache = OrderedDict()
+        self.pinned_keys = set()
+        self._lock = threading.Lock()
+
+    def get_prefix_token_ids(self, template: Template,
+                             system: Optional[str]) -> List[int]:
+        if type(template).encode is not Template.encode:
+            # e.g. cogagent
+            return []
+        key = (id(template), system)
+        token_ids = self.prefix_token_ids.get(key)
+        if token_ids is not None:
+            self.prefix_token_ids.move_to_end(key)
+            return token_ids
+        input_ids_list = []
+        for query in self.probe_query_list:
+            inputs = template.encode({'query': query, 'system': system})
+            input_ids_list.append(
+                [] if inputs is None else inputs['input_ids'])
+        token_ids = input_ids_list[0]
+        for input_ids in input_ids_list[1:]:
+            prefix_len = 0
+            max_len = min(len(token_ids), len(input_ids))
+            while prefix_len < max_len and token_ids[prefix_len] == input_ids[
+                    prefix_len]:
+                prefix_len += 1
+            token_ids = token_ids[:prefix_len]
+        self.prefix_token_ids[key] = token_ids
+        if len(self.prefix_token_ids) > self.max_size * 4:
+            self.prefix_token_ids.popitem(last=False)
+        return token_ids
+
+    def add(self,
+            model: PreTrainedModel,
+            template: Template,
+            system: Optional[str] = None,
+            pin: bool = False) -> Optional[Tuple[List[int], PastKeyValues]]:
+        """Returns the prefix token ids and the cache of the system, which are computed if not cached."""
+        with self._lock:
+            token_ids = self.get_prefix_token_ids(template, system)
+            if len(token_ids) == 0:
+                return None
+            key = hash(tuple(token_ids))
+            if key in self.cache and self.cache[key][0] == token_ids:
+                self.cache.move_to_end(key)
+            else:
+                past_key_values = _prefill_kv_cache(model, token_ids, 0, None)
+                self.cache[key] = (token_ids, past_key_values)
+                unpinned_keys = [
+                    k for k in self.cache if k not in self.pinned_keys
+                ]
+                for k in unpinned_keys[:max(
+                        len(unpinned_keys) - self.max_size, 0)]:
+                    if k != key:
+                        self.cache.pop(k)
+            if pin:
+                self.pinned_keys.add(key)
+            return self.cache[key]
+
+    def get(self, model: PreTrainedModel, template: Template,
+            system: Optional[str],
+            input_ids: List[int]) -> Optional[Tuple[List[int], PastKeyValues]]:
+        """Returns the prefix of `input_ids[:-1]` and its cache, or None if not matched."""
+        with self._lock:
+            token_ids = self.get_prefix_token_ids(template, system)
+        if len(token_ids) == 0 or len(token_ids) >= len(
+                input_ids) or input_ids[:len(token_ids)] != token_ids:
+            return None
+        return self.add(model, template, system)
+
+
+def _prepare_kv_cache(model: PreTrainedModel, template: Template,
+                      inputs: Dict[str, Any], system: Optional[str],
+                      model_kwargs: Dict[str, Any],
+                      session: Optional[KVCacheSession]) -> bool:
+    """Add the cache of the session or of the prompt prefix (see `PrefixKVCache`) to `model_kwargs`.
+    Returns True if the session is used."""
+    prefix_kv_cache: Optional[PrefixKVCache] = getattr(model,
+                                                       'prefix_kv_cache', None)
+    if session is None and prefix_kv_cache is None:
+        return False
+    if len(model_kwargs) > 0 or 'attention_mask' in inputs:
+        # The multimodal inputs are processed with the whole input_ids.
+        if session is not None:
+            session.clear()
+        return False
+    input_ids = inputs['input_ids']
+    prefix = None
+    if prefix_kv_cache is not None and (session is None
+                                        or session.past_key_values is None):
+        prefix = prefix_kv_cache.get(model, template, system, input_ids)
+    if session is not None:
+        past_key_values = session.prefill(model, input_ids, prefix)
+    elif prefix is not None:
+        prefix_token_ids, past_key_values = prefix
+        past_key_values = _prefill_kv_cache(model, input_ids[:-1],
+                                            len(prefix_token_ids),
+                                            past_key_values)
+    else:
+        past_key_values = None
+    if past_key_values is not None:
+        model_kwargs['past_key_values'] = past_key_values
+    return session is not None
+
+
 def inference_stream(
     model: PreTrainedModel,
     template: Template,
@@ -457,9 +1672,11 @@ def inference_stream(
     *,
     generation_config: Optional[GenerationConfig] = None,
     stop_words: Optional[List[StopWords]] = None,
+    session: Optional[KVCacheSession] = None,
 ) -> Iterator[Tuple[str, History]]:
     """
     generation_config: Priority: generation_config > model.generation_config.
+    session: Reuse the KV cache of the previous turns of the conversation.
     """
     if stop_words is None:
         stop_words = []
@@ -499,21 +1716,10 @@ def inference_stream(
     if template.suffix[-1] not in stop_words:
         stop_words.append(template.suffix[-1])
     decode_kwargs = {}
-    model_kwargs = {}
-    if 'token_type_ids' in inputs:
-        model_kwargs['token_type_ids'] = inputs['token_type_ids'].to(device)
-    if 'images' in inputs:
-        model_kwargs['images'] = [[
-            inputs['images'][0][0].to(device).to(torch.float16)
-        ]]
-    if 'cross_images' in inputs:
-        model_kwargs['cross_images'] = [[
-            inputs['cross_images'][0][0].to(device).to(torch.float16)
-        ]]
+    model_kwargs = _get_multimodal_kwargs(inputs, tokenizer, device)
     if audio_info is not None:
-        audio_info = get_audio_info(tokenizer, audio_info=audio_info)
-        decode_kwargs['audio_info'] = audio_info
-        model_kwargs['audio_info'] = audio_info
+        decode_kwargs['audio_info'] = model_kwargs['audio_info']
+    _prepare_kv_cache(model, template, inputs, system, model_kwargs, session)
     stopping_criteria = StoppingCriteriaList(
         [StopWordsCriteria(tokenizer, stop_words, **decode_kwargs)])
     gen = model.generate_stream(
@@ -523,22 +1729,14 @@ def inference_stream(
         stopping_criteria=stopping_criteria,
         **model_kwargs,
         seed=-1)
-    generate_ids = []
-    response = ''
-    print_idx = 0
+    detokenizer = IncrementalDetokenizer(tokenizer, True, **decode_kwargs)
     history.append(None)  # dummy
     for token in gen:
-        generate_ids.append(token.item())
-        response = tokenizer.decode(generate_ids, True, **decode_kwargs)
-        if response.endswith('\n') or len(response) > 0 and _is_chinese_char(
-                ord(response[-1])):
-            print_idx = len(response)
-        else:
-            print_idx = max(response.rfind(' ') + 1, print_idx)
-        # avoid printing incomplete words
-        safe_response = response[:print_idx]
+        detokenizer.add_tokens([token.item()])
+        safe_response = detokenizer.safe_text
         history[-1] = (query, safe_response)
         yield safe_response, history
+    response = detokenizer.add_tokens([], finished=True)
     history[-1] = (query, response)
     yield response, history
 
@@ -551,12 +1749,14 @@ def inference(model: PreTrainedModel,
               *,
               generation_config: Optional[GenerationConfig] = None,
               stop_words: Optional[List[StopWords]] = None,
+              session: Optional[KVCacheSession] = None,
               stream: bool = False,
               verbose: bool = False,
               prompt_prefix: str = '[PROMPT]',
               output_prefix: str = '[OUTPUT]') -> Tuple[str, History]:
     """
     generation_config: Priority: generation_config > model.generation_config.
+    session: Reuse the KV cache of the previous turns of the conversation.
     """
     if stop_words is None:
         stop_words = []
@@ -602,6 +1802,10 @@ def inference(model: PreTrainedModel,
         generation_config.max_length = 20  # fix max_length, max_new_tokens warning
     if template.suffix[-1] not in stop_words:
         stop_words.append(template.suffix[-1])
+    use_session = _prepare_kv_cache(model, template, inputs, system,
+                                    model_kwargs, session)
+    if use_session:
+        generation_config.return_dict_in_generate = True
     stopping_criteria = StoppingCriteriaList(
         [StopWordsCriteria(tokenizer, stop_words, **decode_kwargs)])
     generate_ids = model.generate(
@@ -611,6 +1815,11 @@ def inference(model: PreTrainedModel,
         generation_config=generation_config,
         stopping_criteria=stopping_criteria,
         **model_kwargs)
+    if use_session:
+        # The cache of the response (except the last token) is also kept.
+        session.update(generate_ids.sequences[0, :-1].tolist(),
+                       getattr(generate_ids, 'past_key_values', None))
+        generate_ids = generate_ids.sequences
     response = tokenizer.decode(generate_ids[0, len(input_ids[0]):], True,
                                 **decode_kwargs)
     if verbose and stream is False:
@@ -621,6 +1830,162 @@ def inference(model: PreTrainedModel,
     return response, history
 
 
+def _get_position_ids_module(model: Module) -> Optional[PreTrainedModel]:
+    """The outermost PreTrainedModel (e.g. inside SwiftModel/PeftModel), if its forward accepts `position_ids`."""
+    for module in model.modules():
+        if isinstance(module, PreTrainedModel):
+            if 'position_ids' in inspect.signature(module.forward).parameters:
+                return module
+            return None
+    return None
+
+
+def _left_padding_position_ids_hook(
+        module: Module, args: Tuple[Any, ...],
+        kwargs: Dict[str, Any]) -> Tuple[Tuple[Any, ...], Dict[str, Any]]:
+    """Some models (e.g. the remote code of qwen/chatglm) do not derive the position_ids from the attention_mask,
+    so the position_ids of the left-padded rows are passed explicitly."""
+    attention_mask = kwargs.get('attention_mask')
+    if attention_mask is None:
+        return args, kwargs
+    inputs = kwargs.get('input_ids')
+    if inputs is None and len(args) > 0:
+        inputs = args[0]
+    if inputs is None:
+        inputs = kwargs['inputs_embeds']
+    position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+    kwargs['position_ids'] = position_ids[:, -inputs.shape[1]:]
+    return args, kwargs
+
+
+def inference_batch(model: PreTrainedModel,
+                    template: Template,
+                    request_list: List[Dict[str, Any]],
+                    *,
+                    generation_config: Optional[GenerationConfig] = None,
+                    stop_words: Optional[List[StopWords]] = None,
+                    batch_size: int = 16,
+                    use_tqdm: bool = False) -> List[Dict[str, Any]]:
+    """
+    request_list: e.g. [{'query': 'hello!'}].
+        The keys that can be included are: 'query', 'history', 'system'.
+    generation_config: Priority: generation_config > model.generation_config.
+    return: e.g. [{'response': 'hi!', 'history': [('hello!', 'hi!')]}].
+        The keys to be included will be: 'response', 'history'. The order is the same as `request_list`.
+
+    The requests are sorted by the prompt length and split into batches (left padding),
+    and `model.generate` is called once per batch. A row is truncated after its stop word (or eos),
+    as the other rows of the batch may continue to be generated.
+    The position_ids are computed from the attention_mask. The requests with multimodal inputs
+    (e.g. `audio_info`, `images`), and all the requests of the models that do not accept `position_ids`,
+    are generated with batch_size 1.
+    """
+    if stop_words is None:
+        stop_words = []
+    stop_words = list(stop_words)
+    if template.suffix[-1] not in stop_words:
+        stop_words.append(template.suffix[-1])
+    request_list = deepcopy(request_list)
+    tokenizer = template.tokenizer
+    device = next(model.parameters()).device
+    model.eval()
+    if generation_config is None:
+        generation_config = getattr(model, 'generation_config', None)
+    generation_config = deepcopy(generation_config)
+    if tokenizer.eos_token_id is not None:
+        generation_config.eos_token_id = tokenizer.eos_token_id
+    if tokenizer.pad_token_id is not None:
+        generation_config.pad_token_id = tokenizer.pad_token_id
+    if generation_config.max_new_tokens is not None:
+        generation_config.max_length = 20  # fix max_length, max_new_tokens warning
+    eos_token_ids = generation_config.eos_token_id
+    if not isinstance(eos_token_ids, list):
+        eos_token_ids = [eos_token_ids]
+    pad_token_id = generation_config.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = eos_token_ids[0] if eos_token_ids[0] is not None else 0
+    inputs_list = []
+    for request in request_list:
+        if request.get('history') is None:
+            request['history'] = []
+        inputs_list.append(template.encode(request))
+    position_ids_module = _get_position_ids_module(model)
+    if position_ids_module is None and batch_size > 1:
+        logger.info('The model does not accept `position_ids`, '
+                    'so the requests are generated with batch_size 1.')
+        batch_size = 1
+    # Group the requests of similar lengths to reduce the padding.
+    lengths = np.array([len(inputs['input_ids']) for inputs in inputs_list])
+    batch_list = []
+    batch = []
+    for i in np.argsort(-lengths, kind='stable').tolist():
+        if set(inputs_list[i].keys()) - {'input_ids', 'labels'}:
+            batch_list.append([i])
+            continue
+        batch.append(i)
+        if len(batch) == batch_size:
+            batch_list.append(batch)
+            batch = []
+    if len(batch) > 0:
+        batch_list.append(batch)
+    resp_list = [None] * len(request_list)
+    prog_bar = tqdm(
+        total=len(request_list), dynamic_ncols=True, disable=not use_tqdm)
+    for batch in batch_list:
+        inputs = inputs_list[batch[0]]
+        model_kwargs = _get_multimodal_kwargs(inputs, tokenizer, device)
+        decode_kwargs = {}
+        if 'audio_info' in model_kwargs:
+            decode_kwargs['audio_info'] = model_kwargs['audio_info']
+        max_length = max(lengths[batch])
+        input_ids = torch.full((len(batch), max_length), pad_token_id)
+        attention_mask = torch.zeros((len(batch), max_length),
+                                     dtype=torch.long)
+        for j, i in enumerate(batch):
+            # left padding
+            input_ids[j, max_length - lengths[i]:] = torch.tensor(
+                inputs_list[i]['input_ids'])
+            attention_mask[j, max_length - lengths[i]:] = 1
+        if 'attention_mask' in inputs and len(batch) == 1:
+            attention_mask = inputs['attention_mask']
+        stop_words_criteria = StopWordsCriteria(tokenizer, stop_words,
+                                                **decode_kwargs)
+        handle = None
+        if len(batch) > 1 and lengths[batch].min() < max_length:
+            handle = position_ids_module.register_forward_pre_hook(
+                _left_padding_position_ids_hook, with_kwargs=True)
+        try:
+            generate_ids = model.generate(
+                input_ids=input_ids.to(device),
+                attention_mask=attention_mask.to(device),
+                generation_config=generation_config,
+                stopping_criteria=StoppingCriteriaList([stop_words_criteria]),
+                **model_kwargs)
+        finally:
+            if handle is not None:
+                handle.remove()
+        done_length = [0] * len(batch)
+        if stop_words_criteria.done_length is not None:
+            done_length = stop_words_criteria.done_length.tolist()
+        for j, i in enumerate(batch):
+            generate_ids_j = generate_ids[j].tolist()
+            if done_length[j] > 0:
+                generate_ids_j = generate_ids_j[:done_length[j]]
+            generate_ids_j = generate_ids_j[max_length:]
+            for k, token_id in enumerate(generate_ids_j):
+                if token_id in eos_token_ids:
+                    generate_ids_j = generate_ids_j[:k + 1]
+                    break
+            response = tokenizer.decode(generate_ids_j, True, **decode_kwargs)
+            request = request_list[i]
+            history = request['history']
+            history.append((request['query'], response))
+            resp_list[i] = {'response': response, 'history': history}
+        prog_bar.update(len(batch))
+    prog_bar.close()
+    return resp_list
+
+
 def limit_history_length(template: Template, query: str,
                          history: Optional[History], max_length: int) -> int:
     """binary search"""
@@ -696,6 +2061,117 @@ def fix_fp16_trainable_bug(model: Module) -> None:
             p.data = p.data.to(dtype=torch.float32)
 
 
+# The transformers implementations whose attention can be isolated for packing.
+PACKING_MODEL_MODULES = [
+    'transformers.models.llama.modeling_llama',
+    'transformers.models.mistral.modeling_mistral',
+    'transformers.models.mixtral.modeling_mixtral',
+    'transformers.models.phi.modeling_phi'
+]
+
+
+def _get_unpad_data_packing(
+        attention_mask: Tensor) -> Tuple[Tensor, Tensor, int]:
+    """attention_mask: The example ids, [batch_size, seq_len]. The cu_seqlens are split by the examples."""
+    seq_len = attention_mask.shape[1]
+    attention_mask = attention_mask.flatten()
+    indices = torch.nonzero(attention_mask, as_tuple=False).flatten()
+    # Make the example ids unique across the rows.
+    row_offsets = torch.arange(
+        0, len(attention_mask), seq_len,
+        device=attention_mask.device).repeat_interleave(seq_len)
+    example_ids = (attention_mask + row_offsets)[indices]
+    seqlens_in_batch = torch.unique_consecutive(
+        example_ids, return_counts=True)[1].to(torch.int32)
+    max_seqlen_in_batch = seqlens_in_batch.max().item()
+    cu_seqlens = F.pad(
+        torch.cumsum(seqlens_in_batch, dim=0, dtype=torch.int32), (1, 0))
+    return indices, cu_seqlens, max_seqlen_in_batch
+
+
+def _prepare_4d_attention_mask_packing(
+        attention_mask: Tensor,
+        inputs_embeds: Tensor,
+        sliding_window: Optional[int] = None) -> Tensor:
+    """Returns the block-diagonal causal masks, [batch_size, 1, seq_len, seq_len]."""
+    seq_len = attention_mask.shape[1]
+    device = attention_mask.device
+    mask = (attention_mask[:, :, None] == attention_mask[:, None, :]) & (
+        attention_mask[:, None, :] > 0)
+    causal_mask = torch.ones((seq_len, seq_len),
+                             dtype=torch.bool,
+                             device=device).tril()
+    if sliding_window is not None:
+        causal_mask = causal_mask.triu(1 - sliding_window)
+    mask = mask & causal_mask
+    dtype = inputs_embeds.dtype
+    return torch.zeros(
+        mask.shape, dtype=dtype,
+        device=device).masked_fill(~mask,
+                                   torch.finfo(dtype).min)[:, None]
+
+
+def patch_packing_attention(model: Module) -> None:
+    """Isolate the attention of the examples in a pack. The attention_mask holds the example ids
+    (see `data_collate_fn`). flash-attn uses the varlen kernel with the cu_seqlens of the examples,
+    and the other implementations (sdpa/eager) use block-diagonal causal masks.
+
+    The behavior of the ordinary 0/1 attention_mask is not changed.
+    """
+    module = inspect.getmodule(model.__class__)
+    module_name = getattr(module, '__name__', None)
+    if module_name not in PACKING_MODEL_MODULES:
+        raise ValueError(
+            f'Packing does not support the model: {model.__class__.__name__} ({module_name}). '
+            f'The supported modules: {PACKING_MODEL_MODULES}')
+    if getattr(module, '_swift_packing_patched', False):
+        return
+    if not hasattr(module, '_get_unpad_data') or not hasattr(
+            module, '_prepare_4d_causal_attention_mask'):
+        raise ValueError(
+            f'Packing requires transformers>=4.36, but got transformers=={transformers.__version__}.'
+        )
+    _old_get_unpad_data = module._get_unpad_data
+
+    def _get_unpad_data(attention_mask: Tensor) -> Tuple[Tensor, Tensor, int]:
+        if attention_mask.max() <= 1:
+            return _old_get_unpad_data(attention_mask)
+        return _get_unpad_data_packing(attention_mask)
+
+    module._get_unpad_data = _get_unpad_data
+    for fn_name in [
+            '_prepare_4d_causal_attention_mask',
+            '_prepare_4d_causal_attention_mask_for_sdpa'
+    ]:
+        if not hasattr(module, fn_name):
+            continue
+
+        def _prepare_4d_causal_attention_mask(
+            attention_mask: Optional[Tensor],
+            input_shape: Tuple[int, int],
+            inputs_embeds: Tensor,
+            past_key_values_length: int,
+            sliding_window: Optional[int] = None,
+            *,
+            _old_fn: Callable[...,
+                              Optional[Tensor]] = getattr(module, fn_name)
+        ) -> Optional[Tensor]:
+            if (attention_mask is None or past_key_values_length > 0
+                    or attention_mask.max() <= 1):
+                kwargs = {}
+                if sliding_window is not None:
+                    kwargs['sliding_window'] = sliding_window
+                return _old_fn(attention_mask, input_shape, inputs_embeds,
+                               past_key_values_length, **kwargs)
+            return _prepare_4d_attention_mask_packing(attention_mask,
+                                                      inputs_embeds,
+                                                      sliding_window)
+
+        setattr(module, fn_name, _prepare_4d_causal_attention_mask)
+    module._swift_packing_patched = True
+    logger.info(f'Patching the attention of {module_name} for packing.')
+
+
 def is_vllm_available():
     return importlib.util.find_spec('vllm') is not None
 
@@ -13,7 +13,7 @@ from swift.utils import get_logger, seed_everything
 from .argument import InferArguments
 from .model import MODEL_MAPPING, get_model_tokenizer
 from .template import Template, get_template
-from .utils import _is_chinese_char
+from .utils import IncrementalDetokenizer
 
 logger = get_logger()
 
@@ -167,23 +167,21 @@ def inference_stream_vllm(
 
     batch_size = len(request_list)
     resp_list = [None] * batch_size
-    print_idx_list = [0] * batch_size
+    detokenizer_list = [
+        IncrementalDetokenizer(tokenizer, True) for _ in range(batch_size)
+    ]
     prog_bar = tqdm(total=batch_size, dynamic_ncols=True, disable=not use_tqdm)
     while llm_engine.has_unfinished_requests():
         step_outputs = llm_engine.step()
         for output in step_outputs:
             i = int(output.request_id)
             request = request_list[i]
-            response = tokenizer.decode(output.outputs[0].token_ids, True)
-            if output.finished or response.endswith(
-                    '\n') or len(response) > 0 and _is_chinese_char(
-                        ord(response[-1])):
-                print_idx_list[i] = len(response)
-            else:
-                print_idx_list[i] = max(
-                    response.rfind(' ') + 1, print_idx_list[i])
-            # avoid printing incomplete words
-            safe_response = response[:print_idx_list[i]]
+            detokenizer = detokenizer_list[i]
+            # Only the new tokens of this step are decoded.
+            token_ids = output.outputs[0].token_ids
+            detokenizer.add_tokens(token_ids[len(detokenizer.token_ids):],
+                                   output.finished)
+            safe_response = detokenizer.safe_text
             query = request['query']
             history = request['history']
             if resp_list[i] is None:
@@ -22,6 +22,11 @@ class SwiftArgumentsMixin:
     acc_strategy: str = field(
         default='token', metadata={'choices': ['token', 'sentence']})
     additional_saved_files: Optional[List[str]] = None
+    # Dynamic batching: the padded token count of each batch <= max_tokens_per_batch
+    max_tokens_per_batch: Optional[int] = None
+    # The seed of the samplers added by swift (group_by_length, max_tokens_per_batch, dataset mixing).
+    # Default: data_seed or seed. The default RandomSampler is not affected.
+    sampler_seed: Optional[int] = None
 
     def __post_init__(self):
         if self.additional_saved_files is None:
@@ -5,7 +5,8 @@ import re
 import shutil
 from pathlib import Path
 from types import MethodType
-from typing import Callable, Dict, List, Optional, Tuple, Union
+from typing import (Any, Callable, Dict, Iterator, List, Optional, Tuple,
+                    Union)
 
 import json
 import numpy as np
@@ -15,6 +16,7 @@ from datasets import Dataset as HfDataset
 from peft import PeftModel
 from requests.exceptions import HTTPError
 from torch.nn import Module
+from torch.utils.data import DataLoader, Dataset, RandomSampler
 from transformers import PreTrainedModel, PreTrainedTokenizerBase
 from transformers.data.data_collator import DataCollator
 from transformers.modeling_utils import unwrap_model
@@ -26,15 +28,17 @@ from transformers.trainer import (ADAPTER_SAFE_WEIGHTS_NAME,
                                   WEIGHTS_NAME, IntervalStrategy,
                                   is_peft_available)
 from transformers.trainer_callback import TrainerCallback
-from transformers.trainer_utils import EvalPrediction
+from transformers.trainer_utils import EvalPrediction, seed_worker
 from transformers.training_args import TrainingArguments
 
 from swift.hub import HubApi, ModelScopeConfig, Repository
 from swift.hub.check_model import check_local_model_is_latest
 from swift.hub.constants import ModelVisibility
 from swift.tuners import SwiftModel
-from swift.utils import check_json_format, get_logger
+from swift.utils import check_json_format, get_dataset_lengths, get_logger
 from swift.utils.constants import Invoke
+from .sampler import (LengthGroupedSampler, TokenBudgetBatchSampler,
+                      WeightedSourceSampler)
 from .utils import (can_return_loss, find_labels, get_function,
                     is_instance_of_ms_model)
 
@@ -240,6 +244,20 @@ class PushToMsHubMixin:
                 shutil.move(tmp_checkpoint, checkpoint_folder)
 
 
+class _ShardedDataLoader(DataLoader):
+    """Forward `set_epoch` to the dataset, and count the examples consumed in the epoch (for resuming)."""
+
+    def set_epoch(self, epoch: int) -> None:
+        if hasattr(self.dataset, 'set_epoch'):
+            self.dataset.set_epoch(epoch)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for batch in super().__iter__():
+            if hasattr(self.dataset, 'num_examples'):
+                self.dataset.num_examples += len(batch['input_ids'])
+            yield batch
+
+
 class SwiftMixin:
 
     def __init__(self,
@@ -425,9 +443,17 @@ class SwiftMixin:
             f'Saving model checkpoint to {self.state.last_model_checkpoint}')
         only_save_model = self.args.only_save_model
         if only_save_model:
-            return self._only_save_model(model, trial, metrics)
+            res = self._only_save_model(model, trial, metrics)
         else:
-            return super()._save_checkpoint(model, trial, metrics)
+            res = super()._save_checkpoint(model, trial, metrics)
+        if getattr(self.train_dataset, 'shard_by_rank', False):
+            # The position of each rank in the streaming dataset.
+            dataset_state_path = os.path.join(
+                self.state.last_model_checkpoint,
+                f'dataset_state_{self.args.process_index}.json')
+            with open(dataset_state_path, 'w') as f:
+                json.dump(self.train_dataset.state_dict(), f)
+        return res
 
     def _only_save_model(self, model, trial, metrics=None):
         # Save model checkpoint
@@ -467,13 +493,88 @@ class SwiftMixin:
         if self.args.should_save:
             self._rotate_checkpoints(use_mtime=True, output_dir=run_dir)
 
+    def _get_sampler_seed(self) -> int:
+        for seed in [self.args.sampler_seed, self.args.data_seed]:
+            if seed is not None:
+                return seed
+        return self.args.seed
+
     def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
         train_sampler_random = self.args.train_sampler_random
+        source_probs = getattr(self.train_dataset, 'source_probs', None)
+        if train_sampler_random and source_probs is not None:
+            seed = self._get_sampler_seed()
+            return WeightedSourceSampler(
+                self.train_dataset.sources, source_probs, seed=seed)
+        if train_sampler_random and self.args.group_by_length:
+            lengths = get_dataset_lengths(self.train_dataset)
+            if lengths is not None:
+                seed = self._get_sampler_seed()
+                return LengthGroupedSampler(
+                    lengths,
+                    self.args.train_batch_size,
+                    self.args.world_size,
+                    seed=seed)
+            logger.warning(
+                'The lengths of the train_dataset are not precomputed, '
+                'ignoring `group_by_length`.')
+            return RandomSampler(self.train_dataset)
         if train_sampler_random:
             return super()._get_train_sampler()
         else:
             return self._get_eval_sampler(self.train_dataset)
 
+    def _get_token_budget_dataloader(self, dataset: Dataset, shuffle: bool,
+                                     description: str) -> Optional[DataLoader]:
+        """Returns None if the lengths of the dataset are not precomputed."""
+        lengths = get_dataset_lengths(dataset)
+        if lengths is None:
+            logger.warning(
+                f'The lengths of the {description} dataset are not precomputed, '
+                'ignoring `max_tokens_per_batch`.')
+            return None
+        seed = self._get_sampler_seed()
+        batch_sampler = TokenBudgetBatchSampler(
+            lengths, self.args.max_tokens_per_batch, shuffle, seed=seed)
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self._get_collator_with_removed_columns(
+                self.data_collator, description=description),
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            worker_init_fn=seed_worker)
+        return self.accelerator.prepare(dataloader)
+
+    def get_train_dataloader(self) -> DataLoader:
+        if getattr(self.train_dataset, 'shard_by_rank', False):
+            # The dataset is already sharded across the processes, so it is not prepared by accelerate
+            # (which would make every process read the whole dataset or dispatch the batches from rank 0).
+            return _ShardedDataLoader(
+                self.train_dataset,
+                batch_size=self._train_batch_size,
+                collate_fn=self._get_collator_with_removed_columns(
+                    self.data_collator, description='training'),
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory)
+        if self.args.max_tokens_per_batch is not None:
+            dataloader = self._get_token_budget_dataloader(
+                self.train_dataset, self.args.train_sampler_random, 'training')
+            if dataloader is not None:
+                return dataloader
+        return super().get_train_dataloader()
+
+    def get_eval_dataloader(self,
+                            eval_dataset: Optional[Dataset] = None
+                            ) -> DataLoader:
+        if self.args.max_tokens_per_batch is not None:
+            dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
+            dataloader = self._get_token_budget_dataloader(
+                dataset, False, 'evaluation')
+            if dataloader is not None:
+                return dataloader
+        return super().get_eval_dataloader(eval_dataset)
+
     def _load_from_checkpoint(self,
                               resume_from_checkpoint: str,
                               model=None) -> None:
@@ -0,0 +1,217 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+from typing import Iterator, List
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class LengthGroupedSampler(Sampler):
+    """Group the examples of similar lengths into the same batch to reduce the padding, while keeping the randomness.
+
+    In each epoch, the indices are randomly permuted and split into mega-batches of
+    `mega_batch_mult * batch_size * world_size` examples. Each mega-batch is sorted by length and split into
+    global batches (`batch_size * world_size` examples, consumed by the processes in one step),
+    whose order is shuffled again. The global batch containing the longest example is placed first,
+    so that an OOM happens sooner rather than later.
+
+    The indices only depend on `seed` and the epoch (see `set_epoch`), so they are the same in all the processes
+    (accelerate dispatches the batches round-robin) and can be reproduced when resuming from a checkpoint.
+    """
+
+    def __init__(self,
+                 lengths: np.ndarray,
+                 batch_size: int,
+                 world_size: int = 1,
+                 mega_batch_mult: int = 50,
+                 seed: int = 42) -> None:
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.global_batch_size = batch_size * world_size
+        self.mega_batch_size = self.global_batch_size * max(
+            min(mega_batch_mult,
+                len(self.lengths) // (self.global_batch_size * 4)), 1)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _get_global_batches(self) -> List[np.ndarray]:
+        random_state = np.random.RandomState(self.seed + self.epoch)
+        indices = random_state.permutation(len(self.lengths))
+        global_batches = []
+        for i in range(0, len(indices), self.mega_batch_size):
+            mega_batch = indices[i:i + self.mega_batch_size]
+            mega_batch = mega_batch[np.argsort(
+                -self.lengths[mega_batch], kind='stable')]
+            batches = [
+                mega_batch[j:j + self.global_batch_size]
+                for j in range(0, len(mega_batch), self.global_batch_size)
+            ]
+            for j in random_state.permutation(len(batches)):
+                global_batches.append(batches[j])
+        # Keep the incomplete global batch at the end, otherwise the following batches are misaligned.
+        last_batch = None
+        if len(indices) % self.global_batch_size != 0:
+            last_idx = next(i for i, batch in enumerate(global_batches)
+                            if len(batch) < self.global_batch_size)
+            last_batch = global_batches.pop(last_idx)
+        if len(global_batches) > 0:
+            max_idx = int(
+                np.argmax([self.lengths[batch[0]]
+                           for batch in global_batches]))
+            global_batches[0], global_batches[max_idx] = global_batches[
+                max_idx], global_batches[0]
+        if last_batch is not None:
+            global_batches.append(last_batch)
+        return global_batches
+
+    def __iter__(self) -> Iterator[int]:
+        for batch in self._get_global_batches():
+            yield from batch.tolist()
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Build variable-sized batches whose padded token count (batch_size * max_length of the batch)
+    does not exceed `max_tokens`.
+
+    shuffle=True: In each epoch, the indices are randomly permuted and split into mega-batches.
+        Each mega-batch is sorted by length and split into batches greedily, and the order of the batches is shuffled
+        (the batch containing the longest example is placed first, so that an OOM happens sooner rather than later).
+        The batches only depend on `seed` and the epoch, so they are the same in all the processes.
+    shuffle=False: The batches are split from the indices sorted by length (descending), e.g. for evaluation.
+
+    An example longer than `max_tokens` makes up a batch alone.
+    """
+
+    def __init__(self,
+                 lengths: np.ndarray,
+                 max_tokens: int,
+                 shuffle: bool = True,
+                 mega_batch_mult: int = 50,
+                 seed: int = 42) -> None:
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        # The number of the examples of `mega_batch_mult` batches on average.
+        mean_length = max(
+            float(self.lengths.mean()) if len(self.lengths) > 0 else 1., 1.)
+        self.mega_batch_size = max(
+            int(mega_batch_mult * max_tokens / mean_length), 1)
+        self.seed = seed
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch: int) -> None:
+        if getattr(self, 'epoch', None) == epoch:
+            return
+        self.epoch = epoch
+        self._batches = self._get_batches()
+
+    @property
+    def sampler(self) -> 'TokenBudgetBatchSampler':
+        # accelerate forwards `set_epoch` to `batch_sampler.sampler` (or `batch_sampler.batch_sampler.sampler`
+        # when wrapped by BatchSamplerShard under DDP), but not to the batch sampler itself.
+        return self
+
+    def _split_batches(self, indices: np.ndarray) -> List[List[int]]:
+        """indices: sorted by length (descending)."""
+        batches = []
+        batch, batch_max_length = [], 0
+        for i, length in zip(indices.tolist(), self.lengths[indices].tolist()):
+            max_length = max(batch_max_length, length)
+            if len(batch) > 0 and max_length * (len(batch)
+                                                + 1) > self.max_tokens:
+                batches.append(batch)
+                batch, max_length = [], length
+            batch.append(i)
+            batch_max_length = max_length
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def _get_batches(self) -> List[List[int]]:
+        if not self.shuffle:
+            indices = np.argsort(-self.lengths, kind='stable')
+            return self._split_batches(indices)
+        random_state = np.random.RandomState(self.seed + self.epoch)
+        indices = random_state.permutation(len(self.lengths))
+        batches = []
+        for i in range(0, len(indices), self.mega_batch_size):
+            mega_batch = indices[i:i + self.mega_batch_size]
+            mega_batch = mega_batch[np.argsort(
+                -self.lengths[mega_batch], kind='stable')]
+            batches += self._split_batches(mega_batch)
+        batches = [batches[i] for i in random_state.permutation(len(batches))]
+        if len(batches) > 0:
+            max_idx = int(
+                np.argmax([self.lengths[batch[0]] for batch in batches]))
+            batches[0], batches[max_idx] = batches[max_idx], batches[0]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        yield from self._batches
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+
+class WeightedSourceSampler(Sampler):
+    """Sample the examples of several sources (datasets) with the given probabilities,
+    instead of in proportion to the dataset sizes. Only the indices are sampled, the examples are not copied.
+
+    Each epoch has `len(sources)` indices: about `len(sources) * probs[i]` of them are drawn from the i-th source
+    by concatenating random permutations of the source (a source is only repeated after all its examples are used),
+    and then the indices are shuffled. The indices only depend on `seed` and the epoch (see `set_epoch`),
+    so they are the same in all the processes.
+    """
+
+    def __init__(self,
+                 sources: np.ndarray,
+                 probs: List[float],
+                 seed: int = 42) -> None:
+        sources = np.asarray(sources, dtype=np.int64)
+        self.source_idx_list = [
+            np.flatnonzero(sources == i) for i in range(len(probs))
+        ]
+        probs = np.array(probs, dtype=np.float64)
+        probs[[len(idx) == 0 for idx in self.source_idx_list]] = 0
+        assert probs.sum() > 0
+        probs /= probs.sum()
+        self.num_samples_list = self._get_num_samples_list(probs, len(sources))
+        self.seed = seed
+        self.epoch = 0
+
+    @staticmethod
+    def _get_num_samples_list(probs: np.ndarray,
+                              num_samples: int) -> List[int]:
+        """The largest remainder method."""
+        expected = probs * num_samples
+        num_samples_arr = np.floor(expected).astype(np.int64)
+        remainder = num_samples - int(num_samples_arr.sum())
+        num_samples_arr[np.argsort(
+            -(expected - num_samples_arr), kind='stable')[:remainder]] += 1
+        return num_samples_arr.tolist()
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[int]:
+        random_state = np.random.RandomState(self.seed + self.epoch)
+        indices = []
+        for source_idx, num_samples in zip(self.source_idx_list,
+                                           self.num_samples_list):
+            if num_samples == 0:
+                continue
+            num_repeats = -(-num_samples // len(source_idx))
+            idx = np.concatenate([
+                random_state.permutation(source_idx)
+                for _ in range(num_repeats)
+            ])
+            indices.append(idx[:num_samples])
+        indices = np.concatenate(indices)
+        yield from indices[random_state.permutation(len(indices))].tolist()
+
+    def __len__(self) -> int:
+        return sum(self.num_samples_list)
@@ -6,8 +6,8 @@ import gradio as gr
 import json
 import torch
 
-from swift.llm import (InferArguments, inference_stream, limit_history_length,
-                       prepare_model_template)
+from swift.llm import (InferArguments, KVCacheSession, inference_stream,
+                       limit_history_length, prepare_model_template)
 from swift.ui.base import BaseUI
 from swift.ui.llm_infer.model import Model
 
@@ -164,7 +164,8 @@ class LLMInfer(BaseUI):
         os.environ['CUDA_VISIBLE_DEVICES'] = gpus
         args = InferArguments(**kwargs)
         model, template = prepare_model_template(args)
-        return [model, template]
+        session = KVCacheSession() if args.kv_cache_session else None
+        return [model, template, session]
 
     @classmethod
     def clear_session(cls):
@@ -180,14 +181,15 @@ class LLMInfer(BaseUI):
         if not model_and_template:
             gr.Warning(cls.locale('generate_alert', cls.lang)['value'])
             return '', None
-        model, template = model_and_template
+        model, template, session = model_and_template
         if not cls.element('template_type').arg_value.endswith('generation'):
             old_history, history = limit_history_length(
                 template, prompt, history, int(max_new_tokens))
         else:
             old_history = []
             history = []
-        gen = inference_stream(model, template, prompt, history)
+        gen = inference_stream(
+            model, template, prompt, history, session=session)
         for _, history in gen:
             total_history = old_history + history
             yield '', total_history
@@ -9,9 +9,9 @@ from .run_utils import get_main
 from .tb_utils import (TB_COLOR, TB_COLOR_SMOOTH, plot_images,
                        read_tensorboard_file, tensorboard_smoothing)
 from .torch_utils import (broadcast_string, freeze_model_parameters,
-                          get_dist_setting, get_model_info, is_ddp_plus_mp,
-                          is_dist, is_local_master, is_master,
-                          is_on_same_device, seed_everything, show_layers,
-                          time_synchronize)
+                          get_dataset_lengths, get_dist_setting,
+                          get_model_info, is_ddp_plus_mp, is_dist,
+                          is_local_master, is_master, is_on_same_device,
+                          seed_everything, show_layers, time_synchronize)
 from .utils import (add_version_to_work_dir, check_json_format, lower_bound,
                     parse_args, read_multi_line, test_time, upper_bound)
@@ -7,15 +7,35 @@ from bisect import bisect_right
 from typing import List, Optional, Tuple
 
 import numpy as np
+import pyarrow.compute as pc
 import torch
 import torch.distributed as dist
 from torch.nn import Module
+from torch.utils.data import Dataset
 
 from .logger import get_logger, is_master
 
 logger = get_logger()
 
 
+def get_dataset_lengths(dataset: Dataset) -> Optional[np.ndarray]:
+    """Returns the token lengths of the examples without encoding them again.
+
+    The lengths are read from the `lengths` attribute (e.g. LLMDataset, computed once in `dataset_map`),
+    or computed from the `input_ids` column with Arrow (HfDataset).
+    Returns None if the lengths are not precomputed (e.g. LazyLLMDataset).
+    """
+    lengths = getattr(dataset, 'lengths', None)
+    if lengths is None:
+        column_names = getattr(dataset, 'column_names', None)
+        if column_names is None or 'input_ids' not in column_names:
+            return None
+        input_ids = dataset.with_format('arrow')['input_ids']
+        lengths = pc.list_value_length(input_ids).to_numpy(
+            zero_copy_only=False)
+    return np.asarray(lengths, dtype=np.int64)
+
+
 def is_on_same_device(model: torch.nn.Module) -> bool:
     device_set = set(map(lambda p: p.device, model.parameters()))
     return len(device_set) == 1
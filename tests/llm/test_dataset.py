@@ -1,9 +1,23 @@
+import os
 import tempfile
+import threading
 import unittest
 
 from datasets import Dataset as HfDataset
 
-from swift.llm import DatasetName, get_dataset
+from swift.llm import (ConversationsPreprocessor, DatasetName, LLMDataset,
+                       ModelType, SftArguments, SmartPreprocessor,
+                       SwiftPreprocessor, dataset_map, get_dataset,
+                       get_dataset_cache_key, get_model_tokenizer,
+                       get_template, list_dataset_cache, load_dataset_cache,
+                       load_dataset_from_local, prune_dataset_cache,
+                       register_dataset, concat_llm_datasets,
+                       save_dataset_cache, set_dataset_load_num_workers)
+from swift.llm.utils.dataset import (_check_dataset, _thread_map,
+                                     get_custom_dataset)
+from swift.llm.sft import _set_source_probs
+from swift.llm.utils.preprocess import _literal_eval
+from swift.llm.utils.utils import _disable_msdataset_ddp_barrier
 
 
 class TestDataset(unittest.TestCase):
@@ -22,6 +36,181 @@ class TestDataset(unittest.TestCase):
             train_dataset, HfDataset)
         assert len(train_dataset) + len(val_dataset) == totol_len
 
+    def test_check_dataset(self):
+        dataset = HfDataset.from_dict({
+            'query': ['q0', None, 'q2', 'q3'],
+            'response': ['r0', 'r1', None, 'r3'],
+            'history': [None, [['q', 'r']], [], None]
+        }).select([3, 2, 1, 0])
+        for strategy in ['discard', 'warning']:
+            res = _check_dataset(dataset, strategy)
+            self.assertTrue(res['query'] == ['q3', 'q0'])
+        self.assertTrue(_check_dataset(dataset, 'none') is dataset)
+        with self.assertRaises(ValueError):
+            _check_dataset(dataset, 'error')
+        # The whole column has a wrong type.
+        dataset = HfDataset.from_dict({
+            'query': ['q0', 'q1'],
+            'response': [0, 1]
+        })
+        with self.assertRaises(AssertionError):
+            _check_dataset(dataset, 'discard')
+
+    def test_preprocessor(self):
+        dataset = HfDataset.from_dict({
+            'query': ['q0', 'q1', 'q2'],
+            'response': ['r0', 'r1', 'r2'],
+            'history': [None, '[["a", "b"]]', "[['a\\/', 'b']]"]
+        })
+        dataset = SwiftPreprocessor()(dataset)
+        self.assertTrue(
+            dataset['history'] == [None, [['a', 'b']], [['a\\/', 'b']]])
+        conversations = [
+            [('user', 'q0'), ('assistant', 'r0')],
+            [('assistant', 'r1'), ('user', 'q1')],  # invalid
+        ]
+        conversations = [[{
+            'from': role,
+            'value': value
+        } for role, value in c] for c in conversations]
+        dataset = HfDataset.from_dict(
+            {'conversations': [str(c) for c in conversations]})
+        dataset = ConversationsPreprocessor(error_strategy='delete')(dataset)
+        self.assertTrue(dataset.to_list() == [{
+            'query': 'q0',
+            'response': 'r0'
+        }])
+
+    def test_literal_eval(self):
+        import ast
+        for s in [
+                '[["a", "b"]]', "[['a', 'b']]", '{"a": [1, 2.5, -3e2]}',
+                '[["\\u4f60", "b\\n"]]', '[True, None]'
+        ]:
+            self.assertTrue(_literal_eval(s) == ast.literal_eval(s))
+        # The JSON-only literals are rejected as by `ast.literal_eval`.
+        for s in [
+                '[true]', '{"a": false}', '[["a", null]]', '[NaN]',
+                '[-Infinity]'
+        ]:
+            with self.assertRaises(ValueError):
+                _literal_eval(s)
+
+    def test_load_dataset_from_local(self):
+        data_dir = os.path.join(os.path.dirname(__file__), 'data')
+        dataset_path_list = [
+            os.path.join(data_dir, fname) for fname in
+            ['alpaca.csv', 'swift_single.jsonl', 'swift_multi.json']
+        ]
+        dataset = load_dataset_from_local(dataset_path_list,
+                                          SmartPreprocessor())
+        self.assertTrue(len(dataset) == 9)
+        dataset2 = load_dataset_from_local(dataset_path_list[1],
+                                           SmartPreprocessor())
+        self.assertTrue(dataset2['query'] == dataset['query'][3:6])
+        self.assertTrue(len(dataset['history'][8]) == 2)
+
+    def test_parallel_load_dataset(self):
+        data_dir = os.path.join(os.path.dirname(__file__), 'data')
+        dataset_name_list = []
+        for fname in ['alpaca.csv', 'swift_single.jsonl', 'swift_multi.json']:
+            dataset_name = f'_test_{fname}'
+            register_dataset(
+                dataset_name,
+                dataset_name, [os.path.join(data_dir, fname)],
+                get_function=get_custom_dataset,
+                exists_ok=True)
+            dataset_name_list.append(dataset_name)
+        dataset_list = []
+        for num_workers in [1, 4]:
+            set_dataset_load_num_workers(num_workers)
+            dataset_list.append(get_dataset(dataset_name_list, 0.4, 42))
+        set_dataset_load_num_workers(1)
+        for d1, d2 in zip(*dataset_list):
+            self.assertTrue(d1.to_list() == d2.to_list())
+
+    def test_thread_map_ddp(self):
+        set_dataset_load_num_workers(4)
+        os.environ.update({'RANK': '1', 'LOCAL_RANK': '1'})
+        try:
+            main_thread_id = threading.get_ident()
+            # The barriers of `MsDataset.load` require the same order in all the ranks.
+            thread_id_list = _thread_map(lambda _: threading.get_ident(),
+                                         range(8))
+            self.assertTrue(set(thread_id_list) == {main_thread_id})
+            with _disable_msdataset_ddp_barrier():
+                thread_id_list = _thread_map(lambda _: threading.get_ident(),
+                                             range(8))
+            self.assertTrue(main_thread_id not in thread_id_list)
+        finally:
+            os.environ.pop('RANK')
+            os.environ.pop('LOCAL_RANK')
+            set_dataset_load_num_workers(1)
+
+    def test_dataset_cache(self):
+        args = SftArguments(
+            model_type=ModelType.qwen_7b_chat,
+            dataset=[DatasetName.leetcode_python_en],
+            train_dataset_sample=100)
+        _, tokenizer = get_model_tokenizer(args.model_type, load_model=False)
+        template = get_template(args.template_type, tokenizer, args.system,
+                                args.max_length)
+        cache_key = get_dataset_cache_key(args, tokenizer)
+        self.assertTrue(cache_key == get_dataset_cache_key(args, tokenizer))
+        args.max_length = 1024
+        self.assertTrue(cache_key != get_dataset_cache_key(args, tokenizer))
+        train_dataset, _ = get_dataset(args.dataset)
+        train_dataset = dataset_map(
+            train_dataset.select(range(100)),
+            template.encode_batch,
+            batched=True)
+        with tempfile.TemporaryDirectory() as dataset_cache_dir:
+            self.assertTrue(
+                load_dataset_cache(dataset_cache_dir, cache_key) is None)
+            save_dataset_cache(dataset_cache_dir, cache_key, train_dataset,
+                               None, args)
+            train_dataset2, val_dataset2 = load_dataset_cache(
+                dataset_cache_dir, cache_key)
+            self.assertTrue(val_dataset2 is None)
+            self.assertTrue(isinstance(train_dataset2, LLMDataset))
+            self.assertTrue(
+                train_dataset2['input_ids'] == train_dataset['input_ids'])
+            self.assertTrue(
+                train_dataset2['labels'] == train_dataset['labels'])
+            self.assertTrue(len(list_dataset_cache(dataset_cache_dir)) == 1)
+            prune_dataset_cache(dataset_cache_dir, max_size_gb=0)
+            self.assertTrue(len(list_dataset_cache(dataset_cache_dir)) == 0)
+
+    def test_dataset_cache_mixing(self):
+        args = SftArguments(
+            model_type=ModelType.qwen_7b_chat,
+            dataset=[
+                f'{DatasetName.leetcode_python_en}:0.7',
+                f'{DatasetName.alpaca_zh}:0.3'
+            ])
+        train_dataset = concat_llm_datasets([
+            LLMDataset([{
+                'input_ids': [i] * (i + 1),
+                'labels': [-100] + [i] * i
+            } for i in range(1, 6)]),
+            LLMDataset([{
+                'input_ids': [i, i],
+                'labels': None
+            } for i in range(3)])
+        ])
+        with tempfile.TemporaryDirectory() as dataset_cache_dir:
+            save_dataset_cache(dataset_cache_dir, 'key', train_dataset, None,
+                               args)
+            train_dataset2, _ = load_dataset_cache(dataset_cache_dir, 'key')
+            self.assertTrue(train_dataset2.sources.tolist() == [0] * 5
+                            + [1] * 3)
+            self.assertTrue(
+                train_dataset2['input_ids'] == train_dataset['input_ids'])
+            self.assertTrue(
+                train_dataset2['labels'] == train_dataset['labels'])
+            _set_source_probs(args, train_dataset2)
+            self.assertTrue(train_dataset2.source_probs == [0.7, 0.3])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,9 +7,10 @@ import unittest
 import torch
 from modelscope import GenerationConfig
 
-from swift.llm import (ModelType, get_default_template_type,
-                       get_model_tokenizer, get_template, inference,
-                       messages_to_history)
+from swift.llm import (ModelType, check_encode_strategy,
+                       get_default_template_type, get_model_tokenizer,
+                       get_template, inference, messages_to_history)
+from swift.llm.utils.template import StopWordsCriteria
 
 SKPT_TEST = True
 
@@ -48,6 +49,140 @@ you are a helpful assistant!<|im_end|>
 浙江的省会是杭州。<|im_end|>"""
             self.assertTrue(result == text)
 
+    def test_template_token_cache(self):
+        model_type = ModelType.qwen_7b_chat_int4
+        _, tokenizer = get_model_tokenizer(model_type, load_model=False)
+        template_type = get_default_template_type(model_type)
+        template = get_template(template_type, tokenizer)
+        data = {
+            'query': '浙江的省会在哪？',
+            'response': '浙江的省会是杭州。',
+            'history': [('你好，你是谁？', '我是来自达摩院的大规模语言模型，我叫通义千问。')]
+        }
+        token_cache = template.token_cache
+        self.assertTrue(token_cache is not None)
+        for system in [None, 'you are a helpful assistant!']:
+            data['system'] = system
+            template.token_cache = token_cache
+            res = template.encode(data)
+            template.token_cache = None
+            res2 = template.encode(data)
+            self.assertTrue(res == res2)
+
+    def test_stop_words_criteria(self):
+        from tokenizers import (Tokenizer, decoders, models, pre_tokenizers,
+                                trainers)
+        from transformers import PreTrainedTokenizerFast
+        text_list = ['hello world. Observation:', '你好世界。<stop>好的']
+        tokenizer = Tokenizer(models.BPE())
+        tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(
+            add_prefix_space=False)
+        tokenizer.decoder = decoders.ByteLevel()
+        trainer = trainers.BpeTrainer(
+            vocab_size=300,
+            special_tokens=['<eos>'],
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+        tokenizer.train_from_iterator(text_list * 10, trainer)
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=tokenizer, eos_token='<eos>')
+        stop_words = ['Observation:', '<stop>', '界。', ['eos_token_id']]
+        token_ids = torch.tensor(
+            tokenizer.encode(''.join(text_list)) + [tokenizer.eos_token_id])
+        generator = torch.Generator().manual_seed(0)
+        for _ in range(20):
+            input_ids = token_ids[torch.randint(
+                len(token_ids), (4, 60), generator=generator)]
+            stop_words_criteria = StopWordsCriteria(tokenizer, stop_words)
+            start_idx = 10
+            is_done = [False] * input_ids.shape[0]
+            for i in range(start_idx + 1, input_ids.shape[1]):
+                res = stop_words_criteria(input_ids[:, :i], None)
+                for j in range(input_ids.shape[0]):
+                    # The previous implementation (decode the whole text in each step).
+                    text = tokenizer.decode(input_ids[j, start_idx:i])
+                    is_done[j] |= any(sw in text for sw in stop_words[:3])
+                    is_done[j] |= (
+                        input_ids[j, i - 1] == tokenizer.eos_token_id).item()
+                    self.assertTrue(
+                        is_done[j] == stop_words_criteria.is_done[j])
+                self.assertTrue(res == stop_words_criteria.is_done.all())
+        input_ids = torch.tensor([tokenizer.encode(text_list[1])])
+        stop_words_criteria = StopWordsCriteria(tokenizer, ['<stop>'])
+        for i in range(1, input_ids.shape[1] + 1):
+            if stop_words_criteria(input_ids[:, :i], None):
+                break
+        self.assertTrue(tokenizer.decode(input_ids[0, :i]).endswith('<stop>'))
+
+    def test_template_encode_batch(self):
+        model_type = ModelType.qwen_7b_chat_int4
+        _, tokenizer = get_model_tokenizer(model_type, load_model=False)
+        template_type = get_default_template_type(model_type)
+        template = get_template(template_type, tokenizer, max_length=40)
+        example_list = [{
+            'query': '浙江的省会在哪？',
+            'response': '浙江的省会是杭州。'
+        }, {
+            'query': '你好，你是谁？',
+            'history': [('浙江的省会在哪？', '浙江的省会是杭州。')],
+            'system': 'you are a helpful assistant!'
+        }, {
+            'query': '你好' * 50,
+            'response': '浙江的省会是杭州。'
+        }]
+        res = template.encode_batch(example_list)
+        res2 = [template.encode(example) for example in example_list]
+        self.assertTrue(res == res2)
+        self.assertTrue(res[2] is None)
+
+    def test_template_single_pass(self):
+        model_type = ModelType.deepseek_coder_6_7b_chat
+        _, tokenizer = get_model_tokenizer(model_type, load_model=False)
+        template_type = get_default_template_type(model_type)
+        template = get_template(
+            template_type, tokenizer, encode_strategy='single_pass')
+        self.assertTrue(template.encode_strategy == 'single_pass')
+        example_list = [{
+            'query': 'write a quick sort algorithm in python.',
+            'response': 'def quick_sort(arr):\n    pass',
+            'history': [('你好，你是谁？', '我是一个AI编程助手。')]
+        }, {
+            'query': '浙江的省会在哪？'
+        }]
+        res = check_encode_strategy(template, example_list)
+        print(res)
+        self.assertTrue(res['num_labels_mismatch'] == 0)
+        res = template.encode_batch(example_list)
+        res2 = [template.encode(example) for example in example_list]
+        self.assertTrue(res == res2)
+        labels = [label for label in res[0]['labels'] if label != -100]
+        self.assertTrue(
+            tokenizer.decode(labels).endswith(example_list[0]['response']
+                                              + '\n<|EOT|>'))
+
+    @unittest.skipIf(SKPT_TEST, 'Benchmark')
+    def test_template_encode_benchmark(self):
+        from swift.utils import test_time
+        model_type = ModelType.deepseek_coder_6_7b_chat
+        _, tokenizer = get_model_tokenizer(model_type, load_model=False)
+        template_type = get_default_template_type(model_type)
+        template = get_template(template_type, tokenizer)
+        data = {
+            'query': 'write a quick sort algorithm in python.',
+            'response': 'BBBBB' * 50,
+            'history': [('AAAAA' * 20, 'BBBBB' * 20)] * 3
+        }
+        token_cache = template.token_cache
+        number = 2000
+        for cache in [None, token_cache]:
+            template.token_cache = cache
+            print(f'token_cache: {cache is not None}')
+            test_time(lambda: template.encode(data), number, warmup=100)
+        data_list = [{
+            **data, 'query': f'{i}. {data["query"]}',
+            'response': f'{i}. {data["response"]}'
+        } for i in range(1000)]
+        test_time(lambda: template.encode_batch(data_list), number // 1000)
+
     @unittest.skipIf(
         SKPT_TEST,
         'To avoid excessive testing time caused by downloading models and '
@@ -1,11 +1,62 @@
 import os
+import tempfile
 import unittest
 
-from swift.llm import (ModelType, get_default_template_type,
+import numpy as np
+from datasets import Dataset as HfDataset
+
+from swift.llm import (IncrementalDetokenizer, KVCacheSession, LazyLLMDataset,
+                       LLMDataset, ModelType, PrefixKVCache,
+                       concat_llm_datasets, data_collate_fn, dataset_map,
+                       dataset_map_distributed, get_default_template_type,
                        get_model_tokenizer, get_template, inference,
-                       inference_stream, limit_history_length, print_example)
+                       inference_batch, inference_stream, limit_history_length,
+                       pack_dataset, print_example, set_kv_cache_max_memory,
+                       sort_by_max_length)
+from swift.llm.utils import StreamingLLMDataset
 from swift.utils import lower_bound, seed_everything
 
+SKPT_TEST = True
+
+
+def _get_tiny_model_template():
+    import torch
+    from tokenizers import (Tokenizer, decoders, models, pre_tokenizers,
+                            trainers)
+    from transformers import (GenerationConfig, LlamaConfig, LlamaForCausalLM,
+                              PreTrainedTokenizerFast)
+    text_list = [
+        'hello world. Observation:', '你好世界。<stop>好的', '### Human:\n',
+        '### Assistant:\n'
+    ]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=300,
+        special_tokens=['<eos>', '<pad>'],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(text_list * 10, trainer)
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, eos_token='<eos>', pad_token='<pad>')
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id)
+    model = LlamaForCausalLM(config)
+    model.generation_config = GenerationConfig(
+        max_new_tokens=30,
+        do_sample=False,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id)
+    template = get_template('default', tokenizer)
+    return model, template, text_list
+
 
 class TestLlmUtils(unittest.TestCase):
 
@@ -85,6 +136,500 @@ class TestLlmUtils(unittest.TestCase):
             600)
         self.assertTrue(len(old_history) == 3 and len(new_history) == 2)
 
+    def test_dataset_map(self):
+        model_type = ModelType.qwen_7b_chat
+        _, tokenizer = get_model_tokenizer(model_type, load_model=False)
+        template_type = get_default_template_type(model_type)
+        template = get_template(template_type, tokenizer, max_length=64)
+        dataset = HfDataset.from_list([{
+            'query':
+            '你好' * (i % 50),
+            'response':
+            None if i % 10 == 0 else f'{i}'
+        } for i in range(1000)])
+        llm_dataset = dataset_map(dataset, template.encode)
+        for num_proc in [2, 3]:
+            llm_dataset2 = dataset_map(dataset, template.encode, num_proc)
+            for key in ['input_ids', 'labels']:
+                self.assertTrue(llm_dataset[key] == llm_dataset2[key])
+
+    def test_dataset_map_distributed(self):
+        _, template, text_list = _get_tiny_model_template()
+        random_state = np.random.RandomState(0)
+        dataset = HfDataset.from_list([{
+            'query':
+            ''.join(
+                random_state.choice(text_list, random_state.randint(1, 5))),
+            'response':
+            None if i % 10 == 0 else f'{i}'
+        } for i in range(100)])
+        llm_dataset = dataset_map(
+            dataset, template.encode_batch, batched=True, batch_size=16)
+        # Not in DDP: the same as `dataset_map`.
+        llm_dataset2 = dataset_map_distributed(
+            dataset, template.encode_batch, batched=True, batch_size=16)
+        for key in ['input_ids', 'labels']:
+            self.assertTrue(llm_dataset[key] == llm_dataset2[key])
+
+    def test_llm_dataset(self):
+        data = [{
+            'input_ids': [1, 2, 3],
+            'labels': [-100, 2, 3]
+        }, {
+            'input_ids': [4],
+            'labels': None
+        }, {
+            'input_ids': [5, 6],
+            'labels': [-100, 6]
+        }]
+        llm_dataset = LLMDataset(data)
+        self.assertTrue(len(llm_dataset) == 3)
+        self.assertTrue(llm_dataset['input_ids'] == [[1, 2, 3], [4], [5, 6]])
+        self.assertTrue(
+            llm_dataset['labels'] == [[-100, 2, 3], None, [-100, 6]])
+        self.assertTrue(llm_dataset.lengths.tolist() == [3, 1, 2])
+        # zero-copy
+        self.assertTrue(
+            np.shares_memory(llm_dataset[2]['input_ids'],
+                             llm_dataset.input_ids))
+        llm_dataset2 = llm_dataset.select([2, 0]).select([1, 0])
+        self.assertTrue(llm_dataset2['input_ids'] == [[1, 2, 3], [5, 6]])
+        self.assertTrue(llm_dataset2[-1]['labels'].tolist() == [-100, 6])
+        self.assertTrue([len(d['input_ids']) for d in llm_dataset2] == [3, 2])
+        # save/load (memory-mapped)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            llm_dataset2.save(tmp_dir)
+            llm_dataset3 = LLMDataset.load(tmp_dir)
+            self.assertTrue(
+                llm_dataset3['input_ids'] == llm_dataset2['input_ids'])
+            self.assertTrue(llm_dataset3['labels'] == llm_dataset2['labels'])
+            self.assertTrue(llm_dataset3.lengths.tolist() == [3, 2])
+
+    def test_pack_dataset(self):
+        data = [{
+            'input_ids': [1, 2, 3, 4, 5],
+            'labels': [-100, -100, 3, 4, 5]
+        }, {
+            'input_ids': [6, 7],
+            'labels': None
+        }, {
+            'input_ids': [8, 9, 10],
+            'labels': [8, 9, 10]
+        }, {
+            'input_ids': [11, 12, 13, 14],
+            'labels': [-100, 12, 13, 14]
+        }]
+        packed_dataset = pack_dataset(LLMDataset(data), 8)
+        self.assertTrue(len(packed_dataset) == 2)
+        self.assertTrue(packed_dataset.lengths.tolist() == [8, 6])
+        example = packed_dataset[0]
+        self.assertTrue(
+            example['input_ids'].tolist() == [1, 2, 3, 4, 5, 8, 9, 10])
+        # The first token of each example is not predicted.
+        self.assertTrue(
+            example['labels'].tolist() == [-100, -100, 3, 4, 5, -100, 9, 10])
+        self.assertTrue(
+            example['position_ids'].tolist() == [0, 1, 2, 3, 4, 0, 1, 2])
+        # The lengths of HfDataset are computed with Arrow.
+        packed_dataset2 = pack_dataset(HfDataset.from_list(data), 8)
+        self.assertTrue(packed_dataset2.lengths.tolist() == [8, 6])
+        self.assertTrue(packed_dataset2[0]['input_ids'].tolist() ==
+                        example['input_ids'].tolist())
+
+        class Tokenizer:
+            pad_token_id = 0
+
+        batch = data_collate_fn([packed_dataset[0], packed_dataset[1]],
+                                Tokenizer())
+        self.assertTrue(batch['attention_mask'].tolist() ==
+                        [[1, 1, 1, 1, 1, 2, 2, 2], [1, 1, 1, 1, 2, 2, 0, 0]])
+        self.assertTrue(
+            batch['position_ids'][1].tolist() == [0, 1, 2, 3, 0, 1, 0, 0])
+
+    def test_data_collate_fn(self):
+
+        class Tokenizer:
+            pad_token_id = 0
+
+        batch = [{
+            'input_ids': np.array([1, 2, 3], dtype=np.int32),
+            'labels': np.array([-100, 2, 3], dtype=np.int32)
+        }, {
+            'input_ids': [4, 5],
+            'labels': None
+        }]
+        res = data_collate_fn(batch, Tokenizer())
+        self.assertTrue(res['input_ids'].tolist() == [[1, 2, 3], [4, 5, 0]])
+        self.assertTrue(
+            res['labels'].tolist() == [[-100, 2, 3], [-100, -100, -100]])
+        self.assertTrue(
+            res['attention_mask'].tolist() == [[1, 1, 1], [1, 1, 0]])
+        res = data_collate_fn(batch, Tokenizer(), pad_to_multiple_of=8)
+        self.assertTrue(res['input_ids'].shape == (2, 8))
+        self.assertTrue(res['attention_mask'].sum().item() == 5)
+
+    def test_sort_by_max_length(self):
+        lengths = [3, 1, 4, 1, 5, 9, 2, 6]
+        data = [{'input_ids': list(range(n)), 'labels': None} for n in lengths]
+        for dataset in [LLMDataset(data), HfDataset.from_list(data)]:
+            dataset = sort_by_max_length(dataset.select(range(1, 8)), 3)
+            self.assertTrue([len(d['input_ids'])
+                             for d in dataset] == [9, 6, 5])
+
+    def test_concat_llm_datasets(self):
+        data_list = [[{
+            'input_ids': list(range(n)),
+            'labels': None
+        } for n in lengths] for lengths in [[3, 1], [4, 1, 5]]]
+        dataset = concat_llm_datasets(
+            [LLMDataset(data_list[0]), None,
+             LLMDataset(data_list[1])])
+        self.assertTrue(len(dataset) == 5)
+        self.assertTrue(dataset.sources.tolist() == [0, 0, 2, 2, 2])
+        self.assertTrue(dataset.lengths.tolist() == [3, 1, 4, 1, 5])
+        self.assertTrue(dataset[2]['input_ids'].tolist() == list(range(4)))
+        dataset = dataset.select([4, 0])
+        self.assertTrue(dataset.sources.tolist() == [2, 0])
+
+    def test_lazy_llm_dataset(self):
+
+        class Template:
+            encode_count = 0
+
+            def encode(self, example):
+                self.encode_count += 1
+                if example['query'] % 2 == 1:
+                    return None  # too long
+                return {'input_ids': [example['query']], 'labels': None}
+
+        dataset = HfDataset.from_dict({'query': list(range(100))})
+        template = Template()
+        lazy_dataset = LazyLLMDataset(dataset, template, cache_size=10)
+        for _ in range(2):
+            for i in range(0, 10, 2):
+                self.assertTrue(lazy_dataset[i]['input_ids'] == [i])
+        self.assertTrue(template.encode_count == 5)
+        res = lazy_dataset[1]
+        self.assertTrue(res['input_ids'][0] % 2 == 0)
+        encode_count = template.encode_count
+        lazy_dataset[1]
+        # The failed index is not encoded again.
+        self.assertTrue(1 in lazy_dataset._failed_idx)
+        self.assertTrue(template.encode_count <= encode_count + 19)
+        self.assertTrue(len(lazy_dataset._cache) <= 10)
+
+    def test_streaming_dataset(self):
+
+        class Template:
+
+            def encode_batch(self, example_list):
+                return [{
+                    'input_ids': [int(example['query'])],
+                    'labels': None
+                } for example in example_list]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset_path = os.path.join(tmp_dir, 'train.jsonl')
+            with open(dataset_path, 'w') as f:
+                for i in range(1000):
+                    f.write(f'{{"query": "{i}", "response": "{"x" * i}"}}\n')
+            source_list = [(dataset_path, None)]
+            world_size = 3
+            shard_list = []
+            for rank in range(world_size):
+                os.environ.update({
+                    'RANK': str(rank),
+                    'LOCAL_RANK': str(rank),
+                    'WORLD_SIZE': str(world_size),
+                    'LOCAL_WORLD_SIZE': str(world_size)
+                })
+                try:
+                    dataset = StreamingLLMDataset(
+                        source_list,
+                        Template(),
+                        shuffle_buffer_size=100,
+                        chunk_size=64)
+                    shard = [d['input_ids'][0] for d in dataset]
+                    # deterministic
+                    self.assertTrue([d['input_ids'][0]
+                                     for d in dataset] == shard)
+                    dataset.set_epoch(1)
+                    shard1 = [d['input_ids'][0] for d in dataset]
+                    self.assertTrue(shard1 != shard)
+                    dataset.set_epoch(2)
+                    shard2 = [d['input_ids'][0] for d in dataset]
+                    # Resume from the 10th example of the epoch 1.
+                    dataset.load_state_dict({'epoch': 1, 'num_examples': 10})
+                    dataset.set_epoch(0)
+                    self.assertTrue(dataset.state_dict() == {
+                        'epoch': 1,
+                        'num_examples': 10
+                    })
+                    self.assertTrue([d['input_ids'][0]
+                                     for d in dataset] == shard1[10:])
+                    # The following epochs are not skipped.
+                    dataset.set_epoch(1)
+                    self.assertTrue([d['input_ids'][0]
+                                     for d in dataset] == shard2)
+                finally:
+                    for k in [
+                            'RANK', 'LOCAL_RANK', 'WORLD_SIZE',
+                            'LOCAL_WORLD_SIZE'
+                    ]:
+                        os.environ.pop(k)
+                shard_list.append(shard)
+            # Each row is read exactly once across the ranks.
+            self.assertTrue(
+                sorted(i for shard in shard_list
+                       for i in shard) == list(range(1000)))
+            self.assertTrue(shard_list[0] != sorted(shard_list[0]))
+            # The sources are interleaved.
+            dataset_path2 = os.path.join(tmp_dir, 'train2.jsonl')
+            with open(dataset_path2, 'w') as f:
+                for i in range(1000, 2000):
+                    f.write(f'{{"query": "{i}", "response": "y"}}\n')
+            dataset = StreamingLLMDataset([(dataset_path, None),
+                                           (dataset_path2, None)],
+                                          Template(),
+                                          shuffle_buffer_size=100,
+                                          chunk_size=64)
+            first = [d['input_ids'][0] for d in dataset][:100]
+            self.assertTrue(
+                any(i < 1000 for i in first) and any(i >= 1000 for i in first))
+            # A JSON file cannot be streamed.
+            json_path = os.path.join(tmp_dir, 'train.json')
+            dataset = StreamingLLMDataset([(json_path, None)], Template())
+            with self.assertRaises(ValueError):
+                next(iter(dataset))
+
+    def test_incremental_detokenizer(self):
+        from tokenizers import (Tokenizer, decoders, models, pre_tokenizers,
+                                trainers)
+        from transformers import PreTrainedTokenizerFast
+        text_list = [
+            'hello world, this is a test.', '你好世界，这是一个测试。',
+            '中文和English混合 text 😀😃\nline two'
+        ]
+        tokenizer = Tokenizer(models.BPE())
+        tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(
+            add_prefix_space=False)
+        tokenizer.decoder = decoders.ByteLevel()
+        trainer = trainers.BpeTrainer(
+            vocab_size=300,
+            special_tokens=['<eos>'],
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+        tokenizer.train_from_iterator(text_list * 10, trainer)
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=tokenizer, eos_token='<eos>')
+        for text in text_list:
+            input_ids = tokenizer.encode(text + '<eos>' + text)
+            detokenizer = IncrementalDetokenizer(tokenizer, True)
+            for i, token_id in enumerate(input_ids):
+                response = detokenizer.add_tokens([token_id])
+                self.assertTrue('\ufffd' not in response)
+                self.assertTrue(
+                    tokenizer.decode(input_ids[:i + 1],
+                                     True).startswith(response))
+                # avoid printing incomplete words
+                safe_response = detokenizer.safe_text
+                self.assertTrue(safe_response == ''
+                                or safe_response[-1] in ' \n'
+                                or ord(safe_response[-1]) > 0x2E80)
+            response = detokenizer.add_tokens([], finished=True)
+            self.assertTrue(response == tokenizer.decode(input_ids, True))
+            self.assertTrue(detokenizer.safe_text == response)
+
+    def test_inference_batch(self):
+        model, template, text_list = _get_tiny_model_template()
+        random_state = np.random.RandomState(0)
+        request_list = [{
+            'query':
+            ''.join(
+                random_state.choice(text_list, random_state.randint(1, 7)))
+        } for _ in range(20)]
+        request_list[3]['history'] = [('hi', 'hello')]
+        stop_words = ['好的']
+        resp_list = inference_batch(
+            model, template, request_list, stop_words=stop_words, batch_size=8)
+        self.assertTrue(len(resp_list) == len(request_list))
+        for request, resp in zip(request_list, resp_list):
+            response, history = inference(
+                model, template, **request, stop_words=list(stop_words))
+            # The same results as `inference` (left padding, per-row stop words).
+            self.assertTrue(resp['response'] == response)
+            self.assertTrue(resp['history'] == history)
+        # The position_ids of the left-padded rows.
+        import torch
+        from transformers import GPT2Config, GPT2LMHeadModel
+
+        class AbsolutePositionModel(GPT2LMHeadModel):
+            """The position_ids are not derived from the attention_mask (e.g. the remote code of qwen)."""
+
+            def prepare_inputs_for_generation(self, *args, **kwargs):
+                model_inputs = super().prepare_inputs_for_generation(
+                    *args, **kwargs)
+                model_inputs['position_ids'] = None
+                return model_inputs
+
+        class NoPositionIdsModel(AbsolutePositionModel):
+
+            def forward(self,
+                        input_ids=None,
+                        past_key_values=None,
+                        attention_mask=None,
+                        **kwargs):
+                return super().forward(
+                    input_ids=input_ids,
+                    past_key_values=past_key_values,
+                    attention_mask=attention_mask,
+                    **kwargs)
+
+        torch.manual_seed(0)
+        config = GPT2Config(
+            vocab_size=model.config.vocab_size,
+            n_embd=64,
+            n_layer=2,
+            n_head=4,
+            eos_token_id=model.config.eos_token_id,
+            pad_token_id=model.config.pad_token_id,
+            initializer_range=1.)  # avoid the degenerate (repeated) outputs
+        random_state = np.random.RandomState(0)
+        # The prompts of different lengths are left-padded in a batch.
+        request_list = [{
+            'query': ''.join(random_state.choice(text_list, n))
+        } for n in [1, 6, 2, 5, 3]]
+        # Falls back to batch_size 1 if `position_ids` are not accepted.
+        for model_cls, batch_size in [(AbsolutePositionModel, 5),
+                                      (NoPositionIdsModel, 1)]:
+            gpt2_model = model_cls(config)
+            gpt2_model.generation_config = model.generation_config
+            batch_size_list = []
+            gpt2_model.register_forward_pre_hook(
+                lambda module, args, kwargs: batch_size_list.append(kwargs[
+                    'input_ids'].shape[0]),
+                with_kwargs=True)
+            resp_list = inference_batch(
+                gpt2_model, template, request_list, batch_size=8)
+            self.assertTrue(max(batch_size_list) == batch_size)
+            for request, resp in zip(request_list, resp_list):
+                response, _ = inference(gpt2_model, template, **request)
+                self.assertTrue(resp['response'] == response)
+
+    def test_kv_cache_session(self):
+        model, template, text_list = _get_tiny_model_template()
+        prefill_len_list = []
+        model.register_forward_pre_hook(
+            lambda module, args, kwargs: prefill_len_list.append(kwargs[
+                'input_ids'].shape[1]),
+            with_kwargs=True)
+        random_state = np.random.RandomState(0)
+        session = KVCacheSession()
+        history = []
+        input_ids_list = []
+        for i in range(6):
+            query = ''.join(
+                random_state.choice(text_list, random_state.randint(1, 5)))
+            # The old turns are dropped in the later turns.
+            old_history, history = limit_history_length(
+                template, query, history, 200)
+            input_ids = template.encode({
+                'query': query,
+                'history': history
+            })['input_ids']
+            response, _ = inference(model, template, query, history)
+            prefill_len_list.clear()
+            response2, history = inference(
+                model, template, query, history, session=session)
+            self.assertTrue(response == response2)
+            if i == 1:
+                # The prompt of the first turn is not prefilled again.
+                self.assertTrue(prefill_len_list[0] <= len(input_ids)
+                                - len(input_ids_list[0]) + 1)
+            input_ids_list.append(input_ids)
+            history = old_history + history
+        # LRU
+        session2 = KVCacheSession()
+        inference(model, template, text_list[0], session=session2)
+        nbytes = session.nbytes
+        set_kv_cache_max_memory(nbytes / 1024**3, nbytes / 1024**3)
+        try:
+            inference(model, template, text_list[1], session=session2)
+            self.assertTrue(session.offload_devices is not None)
+            self.assertTrue(session2.offload_devices is None)
+            response, _ = inference(model, template, query, history)
+            response2, _ = inference(
+                model, template, query, history, session=session)
+            self.assertTrue(response == response2)
+            self.assertTrue(session.offload_devices is None)
+            # session2 is dropped (exceeding max_cpu_memory).
+            set_kv_cache_max_memory(0, 0)
+            inference(model, template, text_list[2], session=session)
+            self.assertTrue(session2.past_key_values is None)
+            self.assertTrue(session.past_key_values is not None)
+        finally:
+            set_kv_cache_max_memory(4)
+
+    def test_prefix_kv_cache(self):
+        model, template, text_list = _get_tiny_model_template()
+        prefill_len_list = []
+        model.register_forward_pre_hook(
+            lambda module, args, kwargs: prefill_len_list.append(kwargs[
+                'input_ids'].shape[1]),
+            with_kwargs=True)
+        system_list = [None, 'You are a helpful assistant.', 'hello world.']
+        response_list = [
+            inference(model, template, text_list[0], system=system)[0]
+            for system in system_list
+        ]
+        model.prefix_kv_cache = PrefixKVCache(max_size=1)
+        prefix_token_ids, _ = model.prefix_kv_cache.add(
+            model, template, pin=True)
+        # The system and the fixed part of the prompt.
+        self.assertTrue(
+            len(prefix_token_ids) > len(
+                template.tokenizer.encode(template.default_system)))
+        try:
+            for system, response in zip(system_list, response_list):
+                input_ids = template.encode({
+                    'query': text_list[0],
+                    'system': system
+                })['input_ids']
+                prefill_len_list.clear()
+                response2, _ = inference(
+                    model, template, text_list[0], system=system)
+                self.assertTrue(response == response2)
+                if system is None:
+                    self.assertTrue(prefill_len_list[0] == len(input_ids)
+                                    - len(prefix_token_ids) - 1)
+            # LRU: The pinned prefix and the last one.
+            self.assertTrue(len(model.prefix_kv_cache.cache) == 2)
+            session = KVCacheSession()
+            response2, _ = inference(
+                model, template, text_list[0], session=session)
+            self.assertTrue(response_list[0] == response2)
+        finally:
+            del model.prefix_kv_cache
+
+    @unittest.skipIf(SKPT_TEST, 'Benchmark')
+    def test_dataset_map_benchmark(self):
+        from swift.utils import test_time
+        model_type = ModelType.qwen_7b_chat
+        _, tokenizer = get_model_tokenizer(model_type, load_model=False)
+        template_type = get_default_template_type(model_type)
+        template = get_template(template_type, tokenizer)
+        dataset = HfDataset.from_list([{
+            'query':
+            f'{i}. write a quick sort algorithm in python.',
+            'response':
+            f'{i}. ' + 'def quick_sort(arr):\n    pass\n' * 20
+        } for i in range(100000)])
+        for num_proc in [1, 2, 4, 8, 16, 32]:
+            if num_proc > os.cpu_count():
+                break
+            print(f'num_proc: {num_proc}')
+            test_time(lambda: dataset_map(
+                dataset, template.encode_batch, num_proc, batched=True))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+
+import numpy as np
+
+from swift.trainers.sampler import (LengthGroupedSampler,
+                                    TokenBudgetBatchSampler,
+                                    WeightedSourceSampler)
+
+
+class TestSampler(unittest.TestCase):
+
+    def test_length_grouped_sampler(self):
+        lengths = np.random.RandomState(0).randint(1, 1000, 1003)
+        batch_size, world_size = 4, 2
+        sampler = LengthGroupedSampler(
+            lengths, batch_size, world_size, mega_batch_mult=8, seed=42)
+        sampler.set_epoch(1)
+        indices = list(sampler)
+        self.assertTrue(sorted(indices) == list(range(len(lengths))))
+        # deterministic resume
+        sampler2 = LengthGroupedSampler(
+            lengths, batch_size, world_size, mega_batch_mult=8, seed=42)
+        sampler2.set_epoch(1)
+        self.assertTrue(list(sampler2) == indices)
+        sampler2.set_epoch(2)
+        self.assertTrue(list(sampler2) != indices)
+        # The longest example is in the first step.
+        global_batch_size = batch_size * world_size
+        self.assertTrue(
+            lengths.max() == lengths[indices[:global_batch_size]].max())
+        # padding
+        padded_len = 0
+        random_indices = np.random.RandomState(0).permutation(len(lengths))
+        random_padded_len = 0
+        for i in range(0, len(indices), batch_size):
+            padded_len += lengths[indices[i:i + batch_size]].max() * batch_size
+            random_padded_len += lengths[
+                random_indices[i:i + batch_size]].max() * batch_size
+        self.assertTrue(padded_len < random_padded_len * 0.8)
+
+    def test_token_budget_batch_sampler(self):
+        lengths = np.random.RandomState(0).randint(1, 500, 1000)
+        lengths[0] = 2000  # longer than max_tokens
+        max_tokens = 1024
+        for shuffle in [True, False]:
+            sampler = TokenBudgetBatchSampler(lengths, max_tokens, shuffle)
+            batches = list(sampler)
+            self.assertTrue(len(batches) == len(sampler))
+            self.assertTrue(
+                sorted(i for batch in batches
+                       for i in batch) == list(range(len(lengths))))
+            for batch in batches:
+                if len(batch) > 1:
+                    self.assertTrue(
+                        lengths[batch].max() * len(batch) <= max_tokens)
+            self.assertTrue(batches[0] == [0])
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens)
+        sampler.set_epoch(1)
+        sampler2 = TokenBudgetBatchSampler(lengths, max_tokens)
+        sampler2.set_epoch(1)
+        self.assertTrue(list(sampler2) == list(sampler))
+
+    def test_token_budget_batch_sampler_ddp(self):
+        from accelerate.data_loader import prepare_data_loader
+        from torch.utils.data import DataLoader
+        lengths = np.random.RandomState(0).randint(1, 500, 200)
+        batches_list = []
+        for process_index in range(2):
+            sampler = TokenBudgetBatchSampler(lengths, 1024)
+            dataloader = DataLoader(
+                list(range(len(lengths))), batch_sampler=sampler)
+            dataloader = prepare_data_loader(
+                dataloader,
+                num_processes=2,
+                process_index=process_index,
+                put_on_device=False)
+            batches = []
+            for epoch in range(2):
+                # Called by the Trainer at the beginning of each epoch.
+                dataloader.set_epoch(epoch)
+                self.assertTrue(sampler.epoch == epoch)
+                batches.append([batch.tolist() for batch in dataloader])
+            self.assertTrue(batches[0] != batches[1])
+            batches_list.append(batches)
+        # The processes get different batches.
+        self.assertTrue(batches_list[0][1] != batches_list[1][1])
+
+    def test_weighted_source_sampler(self):
+        sources = np.array([0] * 900 + [1] * 100 + [2] * 0 + [3] * 10)
+        probs = [0.5, 0.3, 0.1, 0.1]
+        sampler = WeightedSourceSampler(sources, probs, seed=42)
+        sampler.set_epoch(1)
+        indices = list(sampler)
+        self.assertTrue(len(indices) == len(sampler) == len(sources))
+        counts = np.bincount(sources[indices], minlength=4)
+        # The empty source is skipped and the probs are renormalized.
+        self.assertTrue(counts.tolist() == [561, 337, 0, 112])
+        # The examples of a source are used before being repeated.
+        idx_counts = np.bincount(indices, minlength=len(sources))
+        self.assertTrue(set(idx_counts[sources == 1].tolist()) == {3, 4})
+        sampler2 = WeightedSourceSampler(sources, probs, seed=42)
+        sampler2.set_epoch(1)
+        self.assertTrue(list(sampler2) == indices)
+        sampler2.set_epoch(2)
+        self.assertTrue(list(sampler2) != indices)
+
+
+if __name__ == '__main__':
+    unittest.main()